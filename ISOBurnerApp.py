@@ -1,16 +1,41 @@
 import os
 import subprocess
+import sys
 import tkinter as tk
 from tkinter import ttk, simpledialog, filedialog, messagebox
-from threading import Thread
+from threading import Thread, Lock
 import shutil
-import tempfile
+
+from isoburner.devices import list_usb_devices, device_key, describe_device, is_fan_out_target
+from isoburner.topology import LinkScheduler, describe_topology
+from isoburner.benchmark import (BenchmarkStore, run_benchmark, summarize, format_eta,
+                                 PROFILE_READONLY, PROFILE_SCRATCH, THROUGHPUT_FLOOR_MBPS)
+from isoburner.health import HealthStore, run_health_scan, summarize as summarize_health
+from isoburner.events import (EventBus, LogEvent, ProgressEvent, BytesEvent, PhaseEvent,
+                              ResultEvent, CallEvent)
+from isoburner.devices import format_size
+from isoburner.logbuffer import RingLog
+from isoburner.rate import RateMeter, format_rate
+from isoburner.progress import TimingStore
+from isoburner.burner import Burner, is_windows_iso
+from isoburner.engine import image_sizes
+from isoburner.stream import is_stream
+from isoburner.helper import PrivilegedHelper, HELPER_FLAG, main as helper_main
+from isoburner.jobs import JobRunner, DEFAULT_WORKERS, QUEUED, format_stats
+from isoburner import bmap, libwim
+
+# How often the UI drains worker events (ms). Redraw cost is bounded by this
+# rate, not by how much output the workers produce.
+UI_FRAME_MS = 50
+
+RATE_GRAPH_WIDTH = 480
+RATE_GRAPH_HEIGHT = 60
 
 class ISOBurnerApp:
     def __init__(self, root):
         self.root = root
         self.root.title("ISO Burner (Linux)")
-        self.root.geometry("500x680")
+        self.root.geometry("500x920")
         self.root.resizable(False, False)
 
         # Use ttk for a modern look
@@ -19,6 +44,32 @@ class ISOBurnerApp:
 
         # Check for dependencies
         self.missing_deps = self.check_dependencies()
+
+        # Per-device sysfs metadata and stored benchmark results
+        self.device_info = {}
+        self.benchmarks = BenchmarkStore()
+        self.health = HealthStore()
+        self.timings = TimingStore()
+
+        # Concurrent burns are limited per shared USB hub/root port
+        self.link_scheduler = LinkScheduler()
+        self.burn_lock = Lock()
+        self.active_jobs = set()
+
+        # Workers post to this bus; pump_events applies it on the Tk thread
+        self.events = EventBus()
+        # Root helper shared by every burn of this session when not running as root
+        self.helper = PrivilegedHelper()
+        self.burner = Burner(self.events, self.link_scheduler, self.benchmarks, self.health, self.timings,
+                             helper=None if os.geteuid() == 0 else self.helper)
+        # Burns are queued jobs; started on the first burn, once root is available
+        self.runner = JobRunner(self.burner, on_change=self.job_changed)
+        self.progress_by_device = {}
+        self.phase_text = ""
+
+        # Throughput per device, fed from byte counters
+        self.rate_meters = {}
+        self.rate_device = None
         
         # Top Frame (Title & Close Button)
         top_frame = tk.Frame(root, bg="black", height=40)
@@ -48,14 +99,24 @@ class ISOBurnerApp:
         self.device_path = tk.StringVar()
         self.device_dropdown = ttk.Combobox(frame_usb, textvariable=self.device_path, state="readonly")
         self.device_dropdown.pack(fill="x", padx=5, pady=2)
-        ttk.Button(frame_usb, text="Rescan Devices", command=self.update_usb_devices).pack(pady=5)
-        self.update_usb_devices()
+        self.device_dropdown.bind("<<ComboboxSelected>>", lambda e: self.update_device_details())
+        self.device_details_label = tk.Label(frame_usb, text="", fg="gray")
+        self.device_details_label.pack(pady=2)
+        usb_buttons = tk.Frame(frame_usb)
+        usb_buttons.pack(pady=5)
+        ttk.Button(usb_buttons, text="Rescan Devices", command=self.update_usb_devices).pack(side="left", padx=5)
+        self.benchmark_button = ttk.Button(usb_buttons, text="Benchmark Device", command=self.start_benchmark)
+        self.benchmark_button.pack(side="left", padx=5)
+        self.scan_button = ttk.Button(usb_buttons, text="Health Scan", command=self.start_health_scan)
+        self.scan_button.pack(side="left", padx=5)
 
         # ISO Selection
         frame_iso = ttk.LabelFrame(root, text="2. Choose ISO File", padding=10)
         frame_iso.pack(fill="x", padx=10, pady=5)
 
         self.iso_path = tk.StringVar()
+        # Every selected ISO; more than one makes a multiboot stick
+        self.iso_paths = []
         ttk.Button(frame_iso, text="Browse ISO", command=self.select_iso).pack(pady=2)
         self.iso_label = tk.Label(frame_iso, text="No file selected", fg="blue")
         self.iso_label.pack(pady=5)
@@ -72,38 +133,85 @@ class ISOBurnerApp:
         self.uefi_var = tk.BooleanVar(value=True)
         ttk.Checkbutton(frame_options, text="Enable UEFI support (for Windows)", variable=self.uefi_var).pack(anchor="w")
 
+        self.probe_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(frame_options, text="Check for fake capacity before burning", variable=self.probe_var).pack(anchor="w")
+
+        self.persistence_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(frame_options, text="Persistence partition in the free space (Ubuntu/Debian live images)",
+                        variable=self.persistence_var).pack(anchor="w")
+
+        self.multiboot_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(frame_options, text="Multiboot stick (copy ISOs as files, keep the ones already on it)",
+                        variable=self.multiboot_var).pack(anchor="w")
+
+        self.all_devices_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(frame_options, text="Write to all listed USB devices", variable=self.all_devices_var).pack(anchor="w")
+
+        workers_row = tk.Frame(frame_options)
+        workers_row.pack(anchor="w")
+        tk.Label(workers_row, text="Parallel burns:").pack(side="left")
+        self.workers_var = tk.IntVar(value=DEFAULT_WORKERS)
+        ttk.Spinbox(workers_row, from_=1, to=16, width=4, textvariable=self.workers_var,
+                    command=self.set_workers).pack(side="left", padx=5)
+
         # Burn Button
         frame_burn = ttk.LabelFrame(root, text="4. Burn ISO", padding=10)
         frame_burn.pack(fill="x", padx=10, pady=5)
 
-        self.burn_button = ttk.Button(frame_burn, text="Burn ISO", command=self.start_burning, style="TButton")
-        self.burn_button.pack(pady=5)
+        burn_buttons = tk.Frame(frame_burn)
+        burn_buttons.pack(pady=5)
+        self.burn_button = ttk.Button(burn_buttons, text="Burn ISO", command=self.start_burning, style="TButton")
+        self.burn_button.pack(side="left", padx=5)
+        self.cancel_button = ttk.Button(burn_buttons, text="Cancel", command=self.cancel_burning,
+                                        style="TButton", state="disabled")
+        self.cancel_button.pack(side="left", padx=5)
 
         # Progress Bar
         self.progress_var = tk.DoubleVar()
         self.progress_bar = ttk.Progressbar(root, variable=self.progress_var, length=480, mode="determinate")
         self.progress_bar.pack(padx=10, pady=5)
+        self.phase_label = tk.Label(root, text="", fg="gray")
+        self.phase_label.pack()
+        self.queue_label = tk.Label(root, text="", fg="gray")
+        self.queue_label.pack()
+
+        # Live throughput panel. The graph is one line item whose
+        # coordinates are replaced each frame, so drawing cost is fixed.
+        self.rate_label = tk.Label(root, text="", fg="gray")
+        self.rate_label.pack()
+        self.rate_canvas = tk.Canvas(root, width=RATE_GRAPH_WIDTH, height=RATE_GRAPH_HEIGHT, bg="white",
+                                     highlightthickness=1, highlightbackground="gray")
+        self.rate_canvas.pack(padx=10, pady=2)
+        self.rate_line = self.rate_canvas.create_line(0, RATE_GRAPH_HEIGHT, 0, RATE_GRAPH_HEIGHT, fill="blue", width=2)
+        self.rate_peak = self.rate_canvas.create_text(4, 2, anchor="nw", text="", fill="gray", font=("Arial", 8))
 
         # Progress Output (Text Log)
         self.progress_text = tk.Text(root, height=10, width=60, wrap="word")
         self.progress_text.pack(pady=5)
         self.progress_text.config(state="disabled")
+        self.progress_text.tag_configure("success", foreground="green")
+        self.progress_text.tag_configure("error", foreground="red")
+        # Bounded storage behind the log pane; the widget mirrors it line for line
+        self.log = RingLog()
+        self.log_lines = 0
+        # The log file gets every line; only the widget drops lines in a burst
+        self.events.log_sink = self.log.write
+
+        self.update_usb_devices()
+        self.root.after(UI_FRAME_MS, self.pump_events)
 
     def check_dependencies(self):
         """Check for required dependencies"""
         missing = []
         
-        # Check for dd command
-        if shutil.which("dd") is None:
-            missing.append("dd")
-            
-        # Check for wimlib-imagex (needed for Windows ISOs)
-        if shutil.which("wimlib-imagex") is None:
+        # Check for wimlib (splits large install.wim files for FAT32); the
+        # library is used in-process when installed, otherwise the command
+        if shutil.which("wimlib-imagex") is None and not libwim.available():
             missing.append("wimlib-imagex")
             
-        # Check for NTFS utilities
-        if shutil.which("mkfs.ntfs") is None:
-            missing.append("ntfs-3g")
+        # exFAT library partition of multiboot sticks
+        if shutil.which("mkfs.exfat") is None:
+            missing.append("exfatprogs")
             
         return missing
 
@@ -114,17 +222,36 @@ class ISOBurnerApp:
             self.status_label.config(text="Not running as root", fg="blue")
 
     def close_app(self):
+        # Running jobs stop here; queued ones stay in the job store for next time
+        self.burner.cancel()
+        self.helper.close()
+        self.log.close()
         self.root.quit()
         self.root.destroy()
 
     def select_iso(self):
-        file_path = filedialog.askopenfilename(filetypes=[("ISO Files", "*.iso")])
-        if file_path:
+        file_paths = filedialog.askopenfilenames(
+            filetypes=[("ISO Files", "*.iso"), ("Disk images", "*.img *.img.zst"), ("All files", "*")])
+        if len(file_paths) > 1:
+            self.iso_paths = list(file_paths)
+            self.iso_path.set(file_paths[0])
+            self.multiboot_var.set(True)
+            self.iso_label.config(text=f"Selected: {len(file_paths)} ISOs for a multiboot stick")
+            self.iso_type_label.config(text="")
+            self.update_device_details()
+        elif file_paths:
+            file_path = file_paths[0]
+            self.iso_paths = [file_path]
             self.iso_path.set(file_path)
             self.iso_label.config(text=f"Selected: {os.path.basename(file_path)}")
-            
+            if is_stream(file_path):
+                # Reading it to detect its type would consume the stream
+                self.iso_type_label.config(text="Detected: Named pipe (streamed, size unknown)", fg="green")
+                self.update_device_details()
+                return
+
             # Determine ISO type
-            is_windows = self.is_windows_iso(file_path)
+            is_windows = is_windows_iso(file_path, self.update_progress)
             if is_windows:
                 self.iso_type_label.config(text="Detected: Windows Installation ISO", fg="green")
                 
@@ -133,10 +260,21 @@ class ISOBurnerApp:
                     messagebox.showwarning("Missing Dependency", 
                                          "wimlib-imagex is required for Windows ISOs.\nPlease install it first.")
             else:
-                self.iso_type_label.config(text="Detected: Standard ISO", fg="green")
+                text = "Detected: Standard ISO"
+                try:
+                    found = bmap.load_for(file_path)
+                except OSError as e:
+                    found = None
+                    self.update_progress(f"Warning: {e}")
+                if found is not None:
+                    text += f" with a block map ({format_size(found.mapped_bytes)} of data to write)"
+                self.iso_type_label.config(text=text, fg="green")
+
+            self.update_device_details()
 
     def get_usb_devices(self):
-        devices = [f"/dev/{d}" for d in os.listdir("/dev/") if d.startswith("sd") and not d[-1].isdigit()]
+        self.device_info = {info["path"]: info for info in list_usb_devices()}
+        devices = list(self.device_info)
         return devices if devices else ["No devices found"]
 
     def update_usb_devices(self):
@@ -144,51 +282,126 @@ class ISOBurnerApp:
         self.device_dropdown["values"] = devices
         if devices:
             self.device_path.set(devices[0])
+        self.update_device_details()
 
-    def is_windows_iso(self, iso_path):
-        """
-        Improved Windows ISO detection using multiple methods:
-        1. Look for Microsoft signature in ISO header
-        2. Check for Windows boot files structure
-        """
+    def update_device_details(self):
+        """Show the selected device's identity, benchmark speed and burn ETA"""
+        info = self.device_info.get(self.device_path.get())
+        if not info:
+            self.device_details_label.config(text="")
+            return
+
+        text = f"{describe_device(info)}\n{describe_topology(info)}"
+        key = device_key(info)
+        mbps = self.benchmarks.write_mbps(key)
+        if mbps:
+            text += f" - ~{mbps:.1f} MB/s write"
+            eta = self.estimate_burn_seconds(info)
+            if eta is not None:
+                text += f", ETA {format_eta(eta)}"
+        else:
+            text += " - not benchmarked"
+        bad = self.health.bad_regions(key)
+        if bad:
+            text += f" - {len(bad)} bad region(s)"
+        color = "red" if bad or self.benchmarks.below_floor(key) else "gray"
+        self.device_details_label.config(text=text, fg=color)
+
+    def estimate_burn_seconds(self, info):
+        isos = [iso for iso in self.iso_paths if os.path.exists(iso) and not is_stream(iso)]
+        if not isos:
+            return None
+        size = sum(os.path.getsize(iso) for iso in isos)
+        if len(isos) == 1:
+            # Sparse images and block maps only write their data
+            try:
+                size = image_sizes(isos[0])[1]
+            except OSError:
+                pass
+        return self.benchmarks.estimate_seconds(device_key(info), size)
+
+    def start_benchmark(self):
+        info = self.device_info.get(self.device_path.get())
+        if not info:
+            messagebox.showerror("Error", "Please select a USB drive to benchmark.")
+            return
+        if os.geteuid() != 0:
+            messagebox.showerror("Error", "Benchmarking needs direct access to the device. Please run as root.")
+            return
+
+        include_writes = messagebox.askyesnocancel(
+            "Benchmark Device",
+            f"Benchmark {info['path']} ({describe_device(info)})?\n\n"
+            "Yes: also measure writes on a 64 MiB scratch region (its contents are restored afterwards).\n"
+            "No: read-only benchmark.")
+        if include_writes is None:
+            return
+
+        profile = PROFILE_SCRATCH if include_writes else PROFILE_READONLY
+        self.benchmark_button.config(state="disabled")
+        Thread(target=self.benchmark_device, args=(info, profile), daemon=True).start()
+
+    def benchmark_device(self, info, profile):
         try:
-            # Method 1: Header check
-            with open(iso_path, "rb") as f:
-                data = f.read(8192)  # Read a larger chunk for better detection
-                if b"Microsoft Corporation" in data or b"UDF" in data and b"BOOTMGR" in data:
-                    return True
-                    
-            # Method 2: Mount and check content structure
-            with tempfile.TemporaryDirectory() as temp_dir:
-                try:
-                    # Try to mount the ISO
-                    mount_proc = subprocess.run(
-                        ["mount", "-o", "loop,ro", iso_path, temp_dir],
-                        stderr=subprocess.PIPE, stdout=subprocess.PIPE, timeout=5
-                    )
-                    
-                    # Check for Windows-specific files
-                    windows_indicators = [
-                        "sources/install.wim", "sources/install.esd",
-                        "bootmgr", "setup.exe"
-                    ]
-                    
-                    for indicator in windows_indicators:
-                        if os.path.exists(os.path.join(temp_dir, indicator)):
-                            subprocess.run(["umount", temp_dir], stderr=subprocess.DEVNULL)
-                            return True
-                            
-                    subprocess.run(["umount", temp_dir], stderr=subprocess.DEVNULL)
-                except Exception:
-                    # If mounting fails, ignore and continue with other methods
-                    pass
-                    
-            # If neither method identifies as Windows, assume it's not
-            return False
-                
-        except Exception as e:
-            self.update_progress(f"Warning: Could not detect ISO type: {str(e)}")
-            return False
+            result = run_benchmark(info, profile, progress=self.update_progress)
+            self.benchmarks.save(result)
+            for line in summarize(result):
+                self.update_progress(line)
+            if self.benchmarks.below_floor(result["key"]):
+                self.update_progress(f"Warning: write speed is below {THROUGHPUT_FLOOR_MBPS} MB/s, "
+                                     "consider retiring this stick.", success=False)
+            self.update_progress("Benchmark complete.", success=True)
+        except OSError as e:
+            self.update_progress(f"Error: Benchmark failed: {e}")
+        self.call_in_ui(self.update_device_details)
+        self.call_in_ui(self.benchmark_button.config, state="normal")
+
+    def start_health_scan(self):
+        info = self.device_info.get(self.device_path.get())
+        if not info:
+            messagebox.showerror("Error", "Please select a USB drive to scan.")
+            return
+        if os.geteuid() != 0:
+            messagebox.showerror("Error", "Health scans need direct access to the device. Please run as root.")
+            return
+
+        destructive = messagebox.askyesnocancel(
+            "Health Scan",
+            f"Scan {info['path']} ({describe_device(info)}) for bad and slow regions?\n\n"
+            "Yes: write a test pattern and read it back. This will erase all data on the USB drive!\n"
+            "No: read-only scan.")
+        if destructive is None:
+            return
+
+        self.scan_button.config(state="disabled")
+        self.progress_by_device.clear()
+        self.set_progress(info["path"], 0)
+        Thread(target=self.scan_device, args=(info, destructive), daemon=True).start()
+
+    def scan_device(self, info, destructive):
+        self.update_progress(f"Scanning {info['path']}...")
+        try:
+            report = run_health_scan(info, destructive, progress=self.engine_progress(0, 100, info["path"]))
+            self.health.save(report)
+            for line in summarize_health(report):
+                self.update_progress(line)
+            if report["bad_regions"]:
+                self.update_progress(f"Error: {len(report['bad_regions'])} bad region(s) found; "
+                                     "burns to this stick will be skipped.")
+            else:
+                self.update_progress("Health scan complete, no bad regions found.", success=True)
+        except OSError as e:
+            self.update_progress(f"Error: Health scan failed: {e}")
+        self.call_in_ui(self.update_device_details)
+        self.call_in_ui(self.scan_button.config, state="normal")
+
+    def engine_progress(self, start, weight, device):
+        """Progress callback mapping engine byte counts onto start..start+weight."""
+        def report(done, total):
+            self.events.bytes(device, done, total)
+            if total:
+                self.set_progress(device, start + done / total * weight)
+        return report
 
     def start_burning(self):
         iso = self.iso_path.get()
@@ -204,174 +417,261 @@ class ISOBurnerApp:
                                  f"The following dependencies are missing: {', '.join(self.missing_deps)}.\n\nContinue anyway?") is False:
                 return
 
-        confirm = messagebox.askyesno("Confirm", f"Write {iso} to {device}? This will erase all data on the USB drive!")
+        if self.all_devices_var.get():
+            # Never fan out to internal disks or to anything in use
+            devices = [path for path, info in self.device_info.items() if is_fan_out_target(info)]
+            skipped = [path for path in self.device_info if path not in devices]
+            if not devices:
+                messagebox.showerror("Error", "None of the listed devices is an unmounted USB or removable drive.")
+                return
+        else:
+            devices, skipped = [device], []
+        if is_stream(iso) and (len(devices) > 1 or self.multiboot_var.get()):
+            messagebox.showerror("Error", "A named pipe can be read only once, so it can be burned to one device only.")
+            return
+        if self.multiboot_var.get():
+            # A list of images makes the burner build or update a library
+            iso = list(self.iso_paths)
+            message = (f"Copy {len(iso)} ISO(s) to the multiboot library on {', '.join(devices)}? "
+                       "A stick without a library is erased first; ISOs already on it are kept.")
+        elif len(devices) > 1:
+            message = (f"Write {iso} to {len(devices)} devices ({', '.join(devices)})? "
+                       "This will erase all data on every listed USB drive!")
+        else:
+            message = f"Write {iso} to {device}? This will erase all data on the USB drive!"
+
+        if skipped:
+            message += f"\n\nSkipped (not an unmounted USB or removable drive): {', '.join(skipped)}"
+
+        for path in devices:
+            info = self.device_info.get(path)
+            if not info:
+                continue
+            eta = self.estimate_burn_seconds(info)
+            if eta is not None and len(devices) == 1:
+                message += f"\n\nEstimated write time: {format_eta(eta)}"
+            if self.benchmarks.below_floor(device_key(info)):
+                message += (f"\n\nWarning: {path} benchmarked below {THROUGHPUT_FLOOR_MBPS} MB/s "
+                            "and should be retired.")
+
+        confirm = messagebox.askyesno("Confirm", message)
         if confirm:
+            # Only the block engine (root) can continue a cancelled write
+            resume = False
+            info = self.device_info.get(device)
+            single = info and len(devices) == 1 and isinstance(iso, str) and not is_stream(iso)
+            done = self.burner.resume.offset(device_key(info), device, iso) if single else 0
+            if done and os.geteuid() == 0:
+                resume = messagebox.askyesno(
+                    "Resume", f"A cancelled burn of this ISO stopped after {format_size(done)}. "
+                              "Continue from there instead of starting over?")
+
             self.burn_button.config(state="disabled")
-            self.progress_text.config(state="normal")
-            self.progress_text.delete(1.0, tk.END)
-            self.progress_text.insert(tk.END, "Burning started...\n")
-            self.progress_text.config(state="disabled")
+            self.cancel_button.config(state="normal")
+            self.clear_log()
+            self.update_progress("Burning started...")
+            self.progress_by_device.clear()
             self.progress_var.set(0)  # Reset progress bar
 
+            # Snapshot the options here; Tk variables must not be read from workers
+            options = {
+                "verify": self.verify_var.get(),
+                "uefi": self.uefi_var.get(),
+                "probe": self.probe_var.get(),
+                "resume": resume,
+                "persistence": self.persistence_var.get(),
+            }
+            if not self.runner.started:
+                self.runner.workers = self.workers_var.get()
             if os.geteuid() == 0:
-                Thread(target=self.burn_iso, args=(iso, device)).start()
+                self.start_burn_workers(iso, devices, options)
             else:
-                self.request_sudo_and_burn(iso, device)
+                self.request_sudo_and_burn(iso, devices, options)
+
+    def job_changed(self, job_id, state):
+        """JobRunner callback, from its thread, whenever a job finishes or is retried."""
+        if state != QUEUED:
+            with self.burn_lock:
+                self.active_jobs.discard(job_id)
+                done = not self.active_jobs
+            if done:
+                self.call_in_ui(self.burns_finished)
+        self.call_in_ui(self.update_queue_label)
+
+    def burns_finished(self):
+        self.burn_button.config(state="normal")
+        self.cancel_button.config(state="disabled")
+
+    def update_queue_label(self):
+        self.queue_label.config(text=format_stats(self.runner.stats()) if self.runner.started else "")
+
+    def set_workers(self):
+        if self.runner.started:
+            self.runner.set_workers(self.workers_var.get())
+
+    def cancel_burning(self):
+        """Stop every queued and running burn; jobs report back as they wind down."""
+        self.cancel_button.config(state="disabled")
+        self.update_progress("Cancelling...")
+        self.runner.cancel()
 
-    def request_sudo_and_burn(self, iso, device):
-        password = simpledialog.askstring("Root Password", "Enter root password:", show="*")
-        if not password:
-            messagebox.showerror("Error", "No password entered. Burning cancelled.")
-            self.burn_button.config(state="normal")
+    def request_sudo_and_burn(self, iso, devices, options):
+        """
+        Burn through the privileged helper, starting it on first use.
+        pkexec asks for authorisation itself; without it the password
+        is asked for here and handed to sudo once.
+        """
+        if self.helper.alive:
+            self.start_burn_workers(iso, devices, options)
             return
 
-        is_windows = self.is_windows_iso(iso)
-        enable_uefi = self.uefi_var.get()
-        verify = self.verify_var.get()
-        
-        cmd = f"echo {password} | sudo -S "
-        
-        if is_windows:
-            # First format the drive with NTFS
-            self.update_progress("Formatting drive to NTFS...")
-            format_cmd = cmd + f"mkfs.ntfs -f {device}"
-            self.run_command(format_cmd, progress_weight=10)
-            
-            # Setup for UEFI if enabled
-            if enable_uefi:
-                self.update_progress("Setting up UEFI boot support...")
-                uefi_cmd = cmd + f"parted {device} mklabel gpt mkpart primary fat32 1MiB 100MiB set 1 boot on"
-                self.run_command(uefi_cmd, progress_weight=10)
-                
-                format_uefi_cmd = cmd + f"mkfs.fat -F32 {device}1"
-                self.run_command(format_uefi_cmd, progress_weight=5)
-            
-            # Apply Windows image
-            self.update_progress("Applying Windows image (this may take a while)...")
-            wim_cmd = cmd + f"wimlib-imagex apply '{iso}' 1 {device}"
-            self.run_command(wim_cmd, progress_weight=65)
-        else:
-            # Standard ISO burn with dd
-            self.update_progress("Writing ISO to USB drive...")
-            dd_cmd = cmd + f"dd if='{iso}' of='{device}' bs=4M status=progress && sync"
-            self.run_command(dd_cmd, progress_weight=90)
-        
-        # Verify if requested
-        if verify:
-            self.update_progress("Verifying written data...")
-            verify_cmd = cmd + f"cmp -n $(stat -c %s '{iso}') '{iso}' {device}"
-            result = self.run_command(verify_cmd, progress_weight=10)
-            
-            if result == 0:
-                self.update_progress("Verification successful! Data was written correctly.", success=True)
-            else:
-                self.update_progress("Verification failed! The written data does not match the ISO.", success=False)
-        
-        # Final sync to ensure all data is written
-        sync_cmd = cmd + "sync"
-        self.run_command(sync_cmd)
-        
-        self.progress_var.set(100)  # Ensure progress bar shows 100%
-        self.burn_button.config(state="normal")
+        password = None
+        if shutil.which("pkexec") is None:
+            password = simpledialog.askstring("Root Password", "Enter root password:", show="*")
+            if not password:
+                messagebox.showerror("Error", "No password entered. Burning cancelled.")
+                self.burns_finished()
+                return
+        Thread(target=self.start_helper, args=(iso, devices, options, password)).start()
 
-    def burn_iso(self, iso, device):
-        is_windows = self.is_windows_iso(iso)
-        enable_uefi = self.uefi_var.get()
-        verify = self.verify_var.get()
-        
-        if is_windows:
-            # Format USB to NTFS before applying Windows ISO
-            self.update_progress("Formatting drive to NTFS...")
-            subprocess.run(["mkfs.ntfs", "-f", device], 
-                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            self.progress_var.set(10)
-            
-            # Setup for UEFI if enabled
-            if enable_uefi:
-                self.update_progress("Setting up UEFI boot support...")
-                subprocess.run(["parted", device, "mklabel", "gpt", "mkpart", "primary", 
-                              "fat32", "1MiB", "100MiB", "set", "1", "boot", "on"],
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                self.progress_var.set(20)
-                
-                subprocess.run(["mkfs.fat", "-F32", f"{device}1"],
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                self.progress_var.set(25)
-            
-            # Apply Windows image
-            self.update_progress("Applying Windows image (this may take a while)...")
-            cmd = f"wimlib-imagex apply '{iso}' 1 {device}"
-            result = self.run_command(cmd, progress_weight=65)
-        else:
-            # Standard ISO burn with dd
-            self.update_progress("Writing ISO to USB drive...")
-            cmd = f"dd if='{iso}' of='{device}' bs=4M status=progress && sync"
-            result = self.run_command(cmd, progress_weight=90)
-        
-        # Verify if requested
-        if verify and result == 0:
-            self.update_progress("Verifying written data...")
-            verify_cmd = f"cmp -n $(stat -c %s '{iso}') '{iso}' {device}"
-            result = subprocess.run(verify_cmd, shell=True).returncode
-            
-            if result == 0:
-                self.update_progress("Verification successful! Data was written correctly.", success=True)
-            else:
-                self.update_progress("Verification failed! The written data does not match the ISO.", success=False)
-            
-            self.progress_var.set(100)
-        
-        # Final success/failure message
-        if result == 0:
-            self.update_progress("ISO burned successfully!", success=True)
-            messagebox.showinfo("Success", "ISO burned successfully!")
-        else:
-            self.update_progress("Error: Failed to burn ISO.", success=False)
-            messagebox.showerror("Error", "Failed to burn ISO.")
-        
-        self.burn_button.config(state="normal")
+    def start_helper(self, iso, devices, options, password):
+        self.update_progress("Requesting root privileges...")
+        try:
+            self.helper.start(password)
+        except (OSError, subprocess.SubprocessError) as e:
+            self.update_progress(f"Error: Could not get root privileges: {e}", success=False)
+            self.events.post(ResultEvent(None, False, "Error", "Could not get root privileges. Burning cancelled."))
+            self.call_in_ui(self.burns_finished)
+            return
+        self.start_burn_workers(iso, devices, options)
 
-    def run_command(self, cmd, progress_weight=0):
-        """Run a command and update progress. Returns the command's return code."""
-        process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
-        
-        current_progress = self.progress_var.get()
-        target_progress = current_progress + progress_weight
-        
-        for line in process.stdout:
-            self.update_progress(line.strip())
-            
-            # Try to update progress bar based on dd output
-            if "bytes" in line and "copied" in line:
-                try:
-                    percentage = float(line.split("%")[0].split(" ")[-1])
-                    # Scale the percentage to fit within our progress weight
-                    scaled_progress = current_progress + (percentage / 100 * progress_weight)
-                    self.progress_var.set(min(scaled_progress, target_progress))
-                except (ValueError, IndexError):
-                    pass
-        
-        process.wait()
-        self.progress_var.set(target_progress)  # Ensure we reach target progress
-        return process.returncode
+    def start_burn_workers(self, iso, devices, options):
+        """Queue one job per device. Safe to call from any thread."""
+        if not self.runner.started:
+            self.runner.start()
+        with self.burn_lock:
+            for device in devices:
+                self.active_jobs.add(self.runner.submit(iso, device, options))
+        self.call_in_ui(self.update_queue_label)
 
     def update_progress(self, text, success=False):
-        """Update the text progress log only."""
+        """Queue a line for the text progress log. Safe to call from any thread."""
+        self.events.post(LogEvent(text, success))
+
+    def set_progress(self, device, percent):
+        """Queue a progress bar update for one device. Safe to call from any thread."""
+        self.events.post(ProgressEvent(device, percent))
+
+    def set_phase(self, device, name):
+        self.events.post(PhaseEvent(device, name))
+
+    def call_in_ui(self, func, *args, **kwargs):
+        """Run func on the Tk thread during the next event pump."""
+        self.events.post(CallEvent(func, args, kwargs))
+
+    def pump_events(self):
+        """Apply queued worker events; runs on the Tk thread every UI_FRAME_MS."""
+        logs = []
+        rate_changed = False
+        for event in self.events.drain():
+            if isinstance(event, LogEvent):
+                logs.append(event)
+            elif isinstance(event, ProgressEvent):
+                # With several devices burning, the bar shows their average
+                self.progress_by_device[event.device] = event.percent
+                self.progress_var.set(sum(self.progress_by_device.values()) / len(self.progress_by_device))
+            elif isinstance(event, PhaseEvent):
+                self.phase_text = f"{event.device}: {event.name}"
+                self.phase_label.config(text=self.phase_text)
+                self.rate_meters.setdefault(event.device, RateMeter()).reset(event.name)
+                rate_changed = True
+            elif isinstance(event, BytesEvent):
+                self.phase_label.config(text=f"{self.phase_text or event.device} - "
+                                             f"{format_size(event.done)} / {format_size(event.total)}")
+                meter = self.rate_meters.setdefault(event.device, RateMeter())
+                meter.update(event.done, event.total, event.time)
+                self.rate_device = event.device
+                rate_changed = True
+            elif isinstance(event, ResultEvent):
+                # Dialogs run their own event loop; show them after this pump returns
+                show = messagebox.showinfo if event.ok else messagebox.showerror
+                self.root.after_idle(show, event.title, event.message)
+            elif isinstance(event, CallEvent):
+                event.func(*event.args, **event.kwargs)
+        if logs:
+            self.append_log(logs)
+        if rate_changed:
+            self.draw_rate()
+        self.root.after(UI_FRAME_MS, self.pump_events)
+
+    def draw_rate(self):
+        """Refresh the throughput label and graph for the most recently active device."""
+        meter = self.rate_meters.get(self.rate_device)
+        if meter is None or meter.ewma is None:
+            self.rate_label.config(text="")
+            self.rate_canvas.coords(self.rate_line, 0, RATE_GRAPH_HEIGHT, 0, RATE_GRAPH_HEIGHT)
+            self.rate_canvas.itemconfig(self.rate_peak, text="")
+            return
+
+        text = f"{self.rate_device} {meter.phase or ''}: {format_rate(meter.rate)} now, {format_rate(meter.ewma)} avg"
+        eta = meter.eta()
+        if eta is not None:
+            text += f", ETA {format_eta(eta)}"
+        self.rate_label.config(text=text)
+
+        samples = list(meter.history)
+        peak = max(samples) or 1
+        step = RATE_GRAPH_WIDTH / (meter.history.maxlen - 1)
+        usable = RATE_GRAPH_HEIGHT - 14
+        points = []
+        for i, rate in enumerate(samples):
+            points += [i * step, RATE_GRAPH_HEIGHT - rate / peak * usable]
+        if len(samples) == 1:
+            # A canvas line needs at least two points
+            points += points
+        self.rate_canvas.coords(self.rate_line, *points)
+        self.rate_canvas.itemconfig(self.rate_peak, text=f"peak {format_rate(peak)}")
+
+    def append_log(self, events):
+        """
+        Insert a batch of log lines with one widget state change and one
+        scroll. Repeated progress lines overwrite the last row, and rows
+        beyond the ring buffer's capacity are trimmed from the top.
+        """
         self.progress_text.config(state="normal")
-        if success:
-            self.progress_text.insert(tk.END, text + "\n", "success")
-            self.progress_text.tag_configure("success", foreground="green")
-        elif "error" in text.lower() or "failed" in text.lower():
-            self.progress_text.insert(tk.END, text + "\n", "error")
-            self.progress_text.tag_configure("error", foreground="red")
-        else:
-            self.progress_text.insert(tk.END, text + "\n")
+        for event in events:
+            text = event.text
+            if event.success:
+                tag = "success"
+            elif "error" in text.lower() or "failed" in text.lower():
+                tag = "error"
+            else:
+                tag = None
+            if self.log.append(text, tag):
+                self.progress_text.delete(f"{self.log_lines}.0", f"{self.log_lines + 1}.0")
+            else:
+                self.log_lines += 1
+            self.progress_text.insert(tk.END, text + "\n", tag or ())
+
+        excess = self.log_lines - self.log.capacity
+        if excess > 0:
+            self.progress_text.delete("1.0", f"{excess + 1}.0")
+            self.log_lines -= excess
         self.progress_text.yview(tk.END)
         self.progress_text.config(state="disabled")
-        self.root.update_idletasks()  # Force UI update
+
+    def clear_log(self):
+        self.log.clear()
+        self.log_lines = 0
+        self.progress_text.config(state="normal")
+        self.progress_text.delete(1.0, tk.END)
+        self.progress_text.config(state="disabled")
 
 # Run the application
 if __name__ == "__main__":
+    if sys.argv[1:2] == [HELPER_FLAG]:
+        # A frozen build started as the privileged helper
+        sys.exit(helper_main())
     root = tk.Tk()
     app = ISOBurnerApp(root)
     root.mainloop()
\ No newline at end of file
@@ -0,0 +1 @@
+"""Core device, benchmarking and burning logic used by ISOBurnerApp."""
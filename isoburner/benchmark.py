@@ -0,0 +1,178 @@
+import os
+import random
+import time
+
+from . import blockio, storage
+from .devices import device_key
+
+BENCHMARK_FILE = "benchmarks.json"
+
+SEQ_BLOCK = 4 * 1024 * 1024
+RANDOM_BLOCK = 4096
+# The scratch profile saves this much of the stick in memory, benchmarks
+# writes on it and then puts the original contents back.
+SCRATCH_SIZE = 64 * 1024 * 1024
+SEQ_READ_LIMIT = 256 * 1024 * 1024
+PHASE_SECONDS = 3.0
+
+# Sticks whose sequential write speed falls below this are flagged for retirement
+THROUGHPUT_FLOOR_MBPS = 5.0
+
+PROFILE_READONLY = "readonly"
+PROFILE_SCRATCH = "scratch"
+
+
+def _latency_stats(samples):
+    if not samples:
+        return {"avg_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+    ordered = sorted(samples)
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    return {
+        "avg_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p99_ms": round(p99 * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def _sequential(fd, op, buf, start, limit, deadline):
+    done = 0
+    latencies = []
+    began = time.monotonic()
+    while done < limit and time.monotonic() < deadline:
+        t = time.monotonic()
+        n = op(fd, buf, start + done)
+        latencies.append(time.monotonic() - t)
+        if n <= 0:
+            break
+        done += n
+    elapsed = max(time.monotonic() - began, 1e-6)
+    result = {"mbps": round(done / elapsed / 1e6, 2), "bytes": done}
+    result.update(_latency_stats(latencies))
+    return result
+
+
+def _random(fd, op, buf, start, span, deadline, rng):
+    blocks = max(1, span // RANDOM_BLOCK)
+    latencies = []
+    began = time.monotonic()
+    while time.monotonic() < deadline:
+        offset = start + rng.randrange(blocks) * RANDOM_BLOCK
+        t = time.monotonic()
+        op(fd, buf, offset)
+        latencies.append(time.monotonic() - t)
+    elapsed = max(time.monotonic() - began, 1e-6)
+    result = {"iops": round(len(latencies) / elapsed, 1)}
+    result.update(_latency_stats(latencies))
+    return result
+
+
+def run_benchmark(info, profile=PROFILE_READONLY, progress=None, phase_seconds=PHASE_SECONDS):
+    """
+    Measure sequential and random throughput and latency on a device.
+
+    The readonly profile never writes. The scratch profile additionally
+    measures writes on a SCRATCH_SIZE region at the start of the device,
+    restoring the original bytes afterwards. Returns a result dict suitable
+    for BenchmarkStore.
+    """
+    log = progress or (lambda msg: None)
+    rng = random.Random(0x150B)
+    write = profile == PROFILE_SCRATCH
+    fd, direct = blockio.open_device(info["path"], write=write)
+    try:
+        size = blockio.device_size(fd)
+        seq_buf = blockio.aligned_buffer(SEQ_BLOCK)
+        rnd_buf = blockio.aligned_buffer(RANDOM_BLOCK)
+        if not direct:
+            blockio.drop_cache(fd)
+
+        result = {
+            "key": device_key(info),
+            "vendor": info.get("vendor"),
+            "model": info.get("model"),
+            "size": size,
+            "profile": profile,
+            "direct_io": direct,
+            "timestamp": int(time.time()),
+        }
+
+        log("Benchmark: sequential read...")
+        result["seq_read"] = _sequential(fd, blockio.pread_full, seq_buf, 0,
+                                         min(SEQ_READ_LIMIT, size), time.monotonic() + phase_seconds)
+        log("Benchmark: random 4K read...")
+        result["rand_read"] = _random(fd, blockio.pread_full, rnd_buf, 0, size,
+                                      time.monotonic() + phase_seconds, rng)
+
+        if write:
+            scratch = min(SCRATCH_SIZE, blockio.align_down(size, SEQ_BLOCK))
+            saved = blockio.aligned_buffer(scratch)
+            blockio.pread_full(fd, saved, 0)
+            try:
+                log("Benchmark: sequential write (scratch region)...")
+                result["seq_write"] = _sequential(fd, blockio.pwrite_full, seq_buf, 0, scratch,
+                                                  time.monotonic() + phase_seconds)
+                log("Benchmark: random 4K write (scratch region)...")
+                result["rand_write"] = _random(fd, blockio.pwrite_full, rnd_buf, 0, scratch,
+                                               time.monotonic() + phase_seconds, rng)
+            finally:
+                log("Benchmark: restoring scratch region...")
+                blockio.pwrite_full(fd, saved, 0)
+                os.fsync(fd)
+        return result
+    finally:
+        os.close(fd)
+
+
+class BenchmarkStore:
+    """Benchmark results persisted in the config directory, keyed by device_key."""
+
+    def __init__(self, filename=BENCHMARK_FILE):
+        self.filename = filename
+        self.results = storage.load_json(filename)
+
+    def get(self, key):
+        return self.results.get(key)
+
+    def save(self, result):
+        self.results[result["key"]] = result
+        storage.save_json(self.filename, self.results)
+
+    def write_mbps(self, key):
+        """Best known sequential write speed for a device, in MB/s."""
+        result = self.get(key)
+        if not result:
+            return None
+        if "seq_write" in result:
+            return result["seq_write"]["mbps"]
+        # A readonly profile still gives an upper bound; flash writes are
+        # rarely faster than a third of the read speed.
+        return result["seq_read"]["mbps"] / 3
+
+    def estimate_seconds(self, key, num_bytes):
+        mbps = self.write_mbps(key)
+        if not mbps:
+            return None
+        return num_bytes / (mbps * 1e6)
+
+    def below_floor(self, key, floor_mbps=THROUGHPUT_FLOOR_MBPS):
+        result = self.get(key)
+        return bool(result and "seq_write" in result and result["seq_write"]["mbps"] < floor_mbps)
+
+
+def format_eta(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    return f"{seconds // 60}m {seconds % 60:02d}s"
+
+
+def summarize(result):
+    """One log line per metric for displaying a result."""
+    lines = [
+        f"Sequential read: {result['seq_read']['mbps']} MB/s (avg {result['seq_read']['avg_ms']} ms)",
+        f"Random 4K read: {result['rand_read']['iops']} IOPS (p99 {result['rand_read']['p99_ms']} ms)",
+    ]
+    if "seq_write" in result:
+        lines.append(f"Sequential write: {result['seq_write']['mbps']} MB/s (avg {result['seq_write']['avg_ms']} ms)")
+        lines.append(f"Random 4K write: {result['rand_write']['iops']} IOPS (p99 {result['rand_write']['p99_ms']} ms)")
+    return lines
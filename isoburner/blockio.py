@@ -0,0 +1,228 @@
+import ctypes
+import errno
+import fcntl
+import mmap
+import os
+import stat
+import struct
+
+# O_DIRECT needs buffers, offsets and lengths aligned to the logical block
+# size. 4 KiB covers every USB stick we have seen and matches the page size,
+# so mmap-backed buffers are always suitably aligned.
+DIRECT_ALIGNMENT = 4096
+# Granularity of zero detection; matches filesystem blocks and bmap files
+SPARSE_BLOCK = 4096
+_ZERO_BLOCK = bytes(SPARSE_BLOCK)
+# Tell the device a byte range is unused (linux/fs.h)
+BLKDISCARD = 0x1277
+# Make a byte range read back as zeros (linux/fs.h)
+BLKZEROOUT = 0x127f
+SECTOR = 512
+# Largest write of zeros when nothing faster is available
+ZERO_CHUNK = 1024 * 1024
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _fallocate = _libc.fallocate
+    _fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+except (OSError, AttributeError):
+    _fallocate = None
+
+
+def aligned_buffer(size):
+    """Allocate a page-aligned, zero-filled buffer usable with O_DIRECT."""
+    size = align_up(size, DIRECT_ALIGNMENT)
+    return mmap.mmap(-1, size)
+
+
+def align_up(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
+
+
+def align_down(value, alignment):
+    return value // alignment * alignment
+
+
+def fallocate(fd, mode, offset, length):
+    """fallocate(2) itself; os.posix_fallocate cannot punch holes. Returns 0 or an errno."""
+    if _fallocate is None:
+        return errno.ENOSYS
+    return 0 if _fallocate(fd, mode, offset, length) == 0 else ctypes.get_errno()
+
+
+def discard(fd, offset, length):
+    """
+    Tell a block device (BLKDISCARD) or the filesystem under an image
+    file (a punched hole) that a range holds nothing. Best effort: most
+    USB sticks ignore discards. Returns True when all of the range was
+    discarded; what it reads back as afterwards is up to the device (see
+    discard_zeroes()).
+    """
+    start = align_up(offset, DIRECT_ALIGNMENT)
+    end = align_down(offset + length, DIRECT_ALIGNMENT)
+    if end <= start:
+        return False
+    if stat.S_ISBLK(os.fstat(fd).st_mode):
+        try:
+            fcntl.ioctl(fd, BLKDISCARD, struct.pack("QQ", start, end - start))
+        except OSError:
+            return False
+    elif fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, start, end - start) != 0:
+        return False
+    return start == offset and end == offset + length
+
+
+def discard_zeroes(fd):
+    """
+    True when discarded ranges are guaranteed to read back as zeros:
+    holes in a file always do, a block device only if its queue says so.
+    """
+    info = os.fstat(fd)
+    if not stat.S_ISBLK(info.st_mode):
+        return True
+    path = f"/sys/dev/block/{os.major(info.st_rdev)}:{os.minor(info.st_rdev)}/queue/discard_zeroes_data"
+    try:
+        with open(path) as f:
+            return f.read().strip() == "1"
+    except OSError:
+        return False
+
+
+def zero_range(fd, offset, length):
+    """
+    Make a range of a block device or image file read back as zeros:
+    BLKZEROOUT on a device (its write-zeroes command, or zero pages the
+    kernel writes), a punched hole in a file, and plain writes of zeros
+    for whatever those cannot cover. fd must not be opened with O_DIRECT.
+    """
+    end = offset + length
+    if stat.S_ISBLK(os.fstat(fd).st_mode):
+        start, stop = align_up(offset, SECTOR), align_down(end, SECTOR)
+    else:
+        start, stop = offset, end
+    if stop <= start or not _zero_out(fd, start, stop - start):
+        # Nothing was zeroed; write the whole range
+        start = stop = end
+    _write_zeros(fd, offset, start)
+    _write_zeros(fd, stop, end)
+
+
+def _zero_out(fd, offset, length):
+    if stat.S_ISBLK(os.fstat(fd).st_mode):
+        try:
+            fcntl.ioctl(fd, BLKZEROOUT, struct.pack("QQ", offset, length))
+            return True
+        except OSError:
+            return False
+    return fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) == 0
+
+
+def _write_zeros(fd, start, end):
+    zeros = bytes(min(ZERO_CHUNK, max(0, end - start)))
+    while start < end:
+        start += os.pwrite(fd, zeros[:end - start], start)
+
+
+def data_runs(view, block=SPARSE_BLOCK):
+    """
+    (start, end) ranges of view that hold data, in steps of block bytes;
+    blocks that are all zeros are left out.
+    """
+    zero = _ZERO_BLOCK if block == SPARSE_BLOCK else bytes(block)
+    runs = []
+    start = None
+    for offset in range(0, len(view), block):
+        piece = view[offset:offset + block]
+        # tobytes() compares with memcmp; memoryview == compares per element
+        if piece.tobytes() == zero[:len(piece)]:
+            if start is not None:
+                runs.append((start, offset))
+                start = None
+        elif start is None:
+            start = offset
+    if start is not None:
+        runs.append((start, len(view)))
+    return runs
+
+
+def file_extents(fd, size):
+    """
+    (offset, length) ranges of a file that are allocated, from
+    SEEK_DATA/SEEK_HOLE; holes read as zeros and are left out. Files on
+    filesystems without hole support come back as one extent.
+    """
+    if not hasattr(os, "SEEK_DATA"):
+        return [(0, size)]
+    extents = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                # ENXIO: only a hole is left
+                if e.errno == errno.ENXIO:
+                    break
+                raise
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            extents.append((start, end - start))
+            offset = end
+    except OSError as e:
+        if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+            raise
+        return [(0, size)]
+    return extents
+
+
+def open_device(path, write=False, direct=True):
+    """
+    Open a block device (or image file) for unbuffered I/O.
+    Returns (fd, direct) where direct tells whether O_DIRECT was accepted;
+    filesystems such as tmpfs reject it and we fall back to buffered I/O.
+    """
+    flags = os.O_RDWR if write else os.O_RDONLY
+    flags |= getattr(os, "O_CLOEXEC", 0)
+    if direct and hasattr(os, "O_DIRECT"):
+        try:
+            return os.open(path, flags | os.O_DIRECT), True
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+    return os.open(path, flags), False
+
+
+def device_size(fd):
+    """Size in bytes of an open block device or regular file."""
+    size = os.lseek(fd, 0, os.SEEK_END)
+    os.lseek(fd, 0, os.SEEK_SET)
+    return size
+
+
+def drop_cache(fd):
+    """Ask the kernel to forget cached pages so reads hit the device."""
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except (AttributeError, OSError):
+        pass
+
+
+def pread_full(fd, buf, offset):
+    """Read len(buf) bytes at offset into buf, returning the count read."""
+    view = memoryview(buf)
+    done = 0
+    while done < len(view):
+        n = os.preadv(fd, [view[done:]], offset + done)
+        if n == 0:
+            break
+        done += n
+    return done
+
+
+def pwrite_full(fd, buf, offset):
+    view = memoryview(buf)
+    done = 0
+    while done < len(view):
+        done += os.pwritev(fd, [view[done:]], offset + done)
+    return done
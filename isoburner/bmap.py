@@ -0,0 +1,213 @@
+"""
+Block maps: which ranges of a raw image hold data.
+
+A block map next to an image (image.bmap in bmaptool's XML format, or
+image.bmap.json in our compact one) lets a burn write and verify only
+the mapped ranges. The rest of the image is all zeros, and the burn
+zeroes it on the stick rather than copying it. Ranges carry checksums,
+so verification reads the stick back and hashes it without reading the
+image again. generate() builds a map for an image from its
+allocated extents (SEEK_DATA/SEEK_HOLE) and the blocks in them that are
+not all zeros.
+"""
+import hashlib
+import json
+import os
+import xml.etree.ElementTree as ElementTree
+
+from . import blockio
+
+XML_SUFFIX = ".bmap"
+NATIVE_SUFFIX = ".bmap.json"
+# Compressed images share the map of the raw image they hold
+COMPRESSED_SUFFIXES = (".zst",)
+NATIVE_FORMAT = "isoburner-bmap"
+NATIVE_VERSION = 1
+XML_VERSION = "2.0"
+CHECKSUM_TYPE = "sha256"
+
+
+class Bmap:
+    """
+    A parsed block map. ranges are (first block, last block, hexdigest or
+    None), inclusive as in bmaptool's files; checksum_type is a hashlib
+    name, or None when the ranges carry no checksums.
+    """
+
+    def __init__(self, image_size, block_size, ranges, checksum_type=CHECKSUM_TYPE):
+        self.image_size = image_size
+        self.block_size = block_size
+        self.ranges = ranges
+        self.checksum_type = checksum_type if ranges and all(r[2] for r in ranges) else None
+
+    def span(self, first, last):
+        start = first * self.block_size
+        return start, min((last + 1) * self.block_size, self.image_size) - start
+
+    def extents(self):
+        """(offset, length) byte ranges of the mapped data."""
+        return [self.span(first, last) for first, last, _ in self.ranges]
+
+    def checked_ranges(self):
+        """(offset, length, hexdigest) for verify_ranges()."""
+        return [self.span(first, last) + (digest,) for first, last, digest in self.ranges]
+
+    @property
+    def mapped_bytes(self):
+        return sum(length for _, length in self.extents())
+
+
+def sidecars(image):
+    """Paths a block map for image may have, most specific first."""
+    bases = [image]
+    for suffix in COMPRESSED_SUFFIXES:
+        if image.endswith(suffix):
+            bases.append(image[:-len(suffix)])
+    return [base + suffix for base in bases for suffix in (NATIVE_SUFFIX, XML_SUFFIX)]
+
+
+def find(image):
+    """Path of image's block map, or None."""
+    for path in sidecars(image):
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def load(path):
+    """Read a block map in either format. Raises OSError when it is malformed."""
+    with open(path, "rb") as f:
+        data = f.read()
+    try:
+        if data.lstrip().startswith(b"{"):
+            return parse_native(data)
+        return parse_xml(data)
+    except (ValueError, KeyError, TypeError, IndexError, ElementTree.ParseError) as e:
+        raise OSError(f"{path} is not a valid block map: {e}")
+
+
+def load_for(image):
+    """The block map next to image, or None when it has none."""
+    path = find(image)
+    return load(path) if path else None
+
+
+def parse_xml(data):
+    """bmaptool's format, versions 1.x and 2.x."""
+    root = ElementTree.fromstring(data)
+    if root.tag != "bmap":
+        raise ValueError("no <bmap> element")
+    major = int(root.get("version", "1.0").split(".")[0])
+    if major > 2:
+        raise ValueError(f"unsupported version {root.get('version')}")
+
+    def field(name):
+        node = root.find(name)
+        return node.text.strip() if node is not None and node.text else None
+
+    checksum_type = field("ChecksumType") or "sha1"
+    file_checksum = field("BmapFileChecksum") or field("BmapFileSHA1")
+    if file_checksum:
+        # Hashed with the checksum itself replaced by zeros
+        zeroed = data.replace(file_checksum.encode(), b"0" * len(file_checksum), 1)
+        if hashlib.new(checksum_type, zeroed).hexdigest() != file_checksum:
+            raise ValueError("its own checksum does not match; the file is damaged")
+
+    ranges = []
+    for node in root.iter("Range"):
+        first, _, last = node.text.strip().partition("-")
+        ranges.append((int(first), int(last or first), node.get("chksum") or node.get("sha1")))
+    return Bmap(int(field("ImageSize")), int(field("BlockSize")), ranges, checksum_type)
+
+
+def format_xml(bmap):
+    """bmaptool 2.0 XML for bmap, including the file checksum."""
+    blocks = -(-bmap.image_size // bmap.block_size)
+    mapped = sum(last - first + 1 for first, last, _ in bmap.ranges)
+    checksum_type = bmap.checksum_type or CHECKSUM_TYPE
+    placeholder = "0" * hashlib.new(checksum_type).digest_size * 2
+    lines = [
+        '<?xml version="1.0" ?>',
+        f'<bmap version="{XML_VERSION}">',
+        f"    <ImageSize> {bmap.image_size} </ImageSize>",
+        f"    <BlockSize> {bmap.block_size} </BlockSize>",
+        f"    <BlocksCount> {blocks} </BlocksCount>",
+        f"    <MappedBlocksCount> {mapped} </MappedBlocksCount>",
+        f"    <ChecksumType> {checksum_type} </ChecksumType>",
+        f"    <BmapFileChecksum> {placeholder} </BmapFileChecksum>",
+        "    <BlockMap>",
+    ]
+    for first, last, digest in bmap.ranges:
+        text = str(first) if first == last else f"{first}-{last}"
+        attribute = f' chksum="{digest}"' if digest else ""
+        lines.append(f"        <Range{attribute}> {text} </Range>")
+    lines += ["    </BlockMap>", "</bmap>", ""]
+    data = "\n".join(lines)
+    digest = hashlib.new(checksum_type, data.encode()).hexdigest()
+    return data.replace(f"<BmapFileChecksum> {placeholder} ", f"<BmapFileChecksum> {digest} ", 1)
+
+
+def parse_native(data):
+    entry = json.loads(data)
+    if entry.get("format") != NATIVE_FORMAT or entry.get("version", 0) > NATIVE_VERSION:
+        raise ValueError("not an isoburner block map this version understands")
+    ranges = [(first, last, digest) for first, last, digest in entry["ranges"]]
+    return Bmap(entry["image_size"], entry["block_size"], ranges, entry.get("checksum"))
+
+
+def format_native(bmap):
+    """The compact format: one JSON object, ranges as [first, last, digest] triples."""
+    return json.dumps({
+        "format": NATIVE_FORMAT,
+        "version": NATIVE_VERSION,
+        "image_size": bmap.image_size,
+        "block_size": bmap.block_size,
+        "checksum": bmap.checksum_type,
+        "ranges": [list(r) for r in bmap.ranges],
+    }, separators=(",", ":")) + "\n"
+
+
+def save(bmap, path):
+    data = format_native(bmap) if path.endswith(NATIVE_SUFFIX) else format_xml(bmap)
+    with open(path, "w") as f:
+        f.write(data)
+
+
+def generate(image, engine):
+    """
+    Block map of a raw image: its allocated extents, less the blocks in
+    them that are all zeros, with a SHA-256 per range. engine (an Engine)
+    does the reading and carries progress and cancel.
+    """
+    block = blockio.SPARSE_BLOCK
+    fd = os.open(image, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        extents = blockio.file_extents(fd, size)
+    finally:
+        os.close(fd)
+
+    ranges = []
+    # The range being built: first byte, end byte and running hash
+    current = None
+
+    def close():
+        start, end, digest = current
+        ranges.append((start // block, (end - 1) // block, digest.hexdigest()))
+
+    def consume(offset, chunk, runs):
+        nonlocal current
+        view = memoryview(chunk)
+        for start, end in runs:
+            if current is not None and current[1] == offset + start:
+                current[1] = offset + end
+            else:
+                if current is not None:
+                    close()
+                current = [offset + start, offset + end, hashlib.new(CHECKSUM_TYPE)]
+            current[2].update(view[start:end])
+
+    engine.read_image(image, consume, size, extents)
+    if current is not None:
+        close()
+    return Bmap(size, block, ranges)
@@ -0,0 +1,695 @@
+import os
+import subprocess
+import tempfile
+
+from .benchmark import BenchmarkStore
+from .cancel import BurnCancelled, CancelToken, ResumeStore, stop_process
+from . import multiboot, persistence, stream, windows
+from .devices import get_device_info, device_key, partition_path
+from .engine import Engine, image_sizes
+from .events import ProgressEvent, PhaseEvent, ResultEvent
+from .health import HealthStore
+from .probe import probe_capacity, describe_result
+from .progress import ProgressModel, TimingStore, model_key, device_written_bytes
+from .tooloutput import iter_output, parse_line
+from .topology import LinkScheduler
+
+DEFAULT_OPTIONS = {
+    "verify": True,
+    "uefi": True,
+    "probe": True,
+    # Continue a cancelled burn of the same image instead of starting over
+    "resume": False,
+    # Eject the stick once everything else succeeded
+    "eject": False,
+    # Live Linux images: add a persistence partition behind the image
+    "persistence": False,
+    # Bytes for that partition; None takes the rest of the stick
+    "persistence_size": None,
+}
+
+
+def is_windows_iso(iso_path, log=None):
+    """
+    Improved Windows ISO detection using multiple methods:
+    1. Look for Microsoft signature in ISO header
+    2. Check for Windows boot files structure
+    """
+    try:
+        # Method 1: Header check
+        with open(iso_path, "rb") as f:
+            data = f.read(8192)  # Read a larger chunk for better detection
+            if b"Microsoft Corporation" in data or b"UDF" in data and b"BOOTMGR" in data:
+                return True
+
+        # Method 2: Mount and check content structure
+        with tempfile.TemporaryDirectory() as temp_dir:
+            try:
+                # Try to mount the ISO
+                mount = subprocess.run(
+                    ["mount", "-o", "loop,ro", iso_path, temp_dir],
+                    stderr=subprocess.PIPE, stdout=subprocess.PIPE, timeout=5
+                )
+            except Exception:
+                # If mounting fails, ignore and continue with other methods
+                mount = None
+
+            if mount is not None and mount.returncode == 0:
+                # Check for Windows-specific files. The unmount is in a
+                # finally so no loop mount outlives a cancelled burn.
+                windows_indicators = [
+                    "sources/install.wim", "sources/install.esd",
+                    "bootmgr", "setup.exe"
+                ]
+                try:
+                    return any(os.path.exists(os.path.join(temp_dir, indicator))
+                               for indicator in windows_indicators)
+                finally:
+                    subprocess.run(["umount", temp_dir], stderr=subprocess.DEVNULL)
+
+        # If neither method identifies as Windows, assume it's not
+        return False
+
+    except Exception as e:
+        if log:
+            log(f"Warning: Could not detect ISO type: {str(e)}")
+        return False
+
+
+# Every stage a burn can go through, in order; stages() picks those that apply
+STAGES = ("detect", "partition", "write", "sync", "verify", "persistence", "eject")
+
+
+class BurnError(Exception):
+    """A burn stage failed. The message is shown to the user under title."""
+
+    def __init__(self, message, title="Error"):
+        super().__init__(message)
+        self.title = title
+
+
+class BurnJob:
+    """
+    The request for one burn plus what the stages learn along the way.
+    A list of ISOs instead of one path makes it a multiboot job, which
+    copies them all onto the stick's library partition. A stream ("-"
+    or a pipe) has no size until the write stage has read all of it;
+    then size and digest are set for verify.
+    """
+
+    def __init__(self, iso, device, options=None):
+        self.multiboot = not isinstance(iso, str)
+        self.isos = list(iso) if self.multiboot else [iso]
+        self.iso = self.isos[0]
+        self.device = device
+        self.options = dict(DEFAULT_OPTIONS, **(options or {}))
+        self.stream = not self.multiboot and stream.is_stream(iso)
+        self.digest = None
+        if self.multiboot:
+            self.size = self.data_size = sum(os.path.getsize(path) for path in self.isos)
+        elif self.stream:
+            self.size = self.data_size = 0
+        else:
+            # Images with a block map or data map only write their data
+            self.size, self.data_size = image_sizes(iso)
+        self.is_windows = None
+        self.model = None
+        self.written_before = None
+
+
+class Burner:
+    """
+    Burn, verify and preflight logic shared by the GUI and the CLI.
+
+    Everything is reported through `events`, an EventBus or anything with
+    the same post/log/bytes methods, so this module never needs Tk.
+    One Burner can drive several devices at once from separate threads;
+    the LinkScheduler keeps them from saturating a shared USB link.
+
+    When the process is not root, set `helper` to a started
+    PrivilegedHelper and every privileged step is sent to it.
+
+    A burn is a sequence of stages (see STAGES), each a stage_<name>
+    method on a shared BurnJob, so a job runner can schedule and retry
+    them one at a time; burn() simply runs them all in order.
+
+    cancel() stops a burn at the next chunk boundary, or kills the
+    running tool's process group. Where a cancelled write stopped is
+    kept in a ResumeStore so the "resume" option can continue it.
+    """
+
+    def __init__(self, events, scheduler=None, benchmarks=None, health=None, timings=None, helper=None):
+        self.events = events
+        self.helper = helper
+        self.scheduler = scheduler or LinkScheduler()
+        self.benchmarks = benchmarks or BenchmarkStore()
+        self.health = health or HealthStore()
+        self.timings = timings or TimingStore()
+        self.resume = ResumeStore()
+        self.checksums = multiboot.ChecksumStore()
+        self.tokens = {}
+
+    def log(self, text, success=False):
+        self.events.log(text, success)
+
+    def set_progress(self, device, percent):
+        self.events.post(ProgressEvent(device, percent))
+
+    def set_phase(self, device, name):
+        self.events.post(PhaseEvent(device, name))
+
+    def device_info(self, device):
+        return get_device_info(device) if device.startswith("/dev/") else {"path": device}
+
+    def cancel(self, device=None):
+        """Cancel the burn on one device, or every running burn. Safe from any thread."""
+        for path, token in list(self.tokens.items()):
+            if device is None or path == device:
+                token.cancel()
+
+    def plan(self, iso, device, options=None):
+        """Detect what kind of image this is and set up the job's progress model."""
+        job = BurnJob(iso, device, options)
+        # Detection would read, and so lose, the start of a stream
+        job.is_windows = not job.multiboot and not job.stream and is_windows_iso(iso, self.log)
+        job.model = self.progress_model(job)
+        return job
+
+    def stages(self, job):
+        """Names of the stages that apply to this job, in order."""
+        names = ["detect"]
+        if job.multiboot:
+            # Copies are hashed and read back as they go; no separate verify
+            return names + ["partition", "write"] + (["eject"] if job.options["eject"] else [])
+        if job.is_windows:
+            names.append("partition")
+        names.append("write")
+        if self.helper is not None:
+            names.append("sync")
+        if job.options["verify"]:
+            names.append("verify")
+        if job.options["persistence"] and not job.is_windows:
+            # After verify: the new partition changes the image's tables
+            names.append("persistence")
+        if job.options["eject"]:
+            names.append("eject")
+        return names
+
+    def run_stage(self, job, name):
+        """Run one stage. Raises BurnError on failure and BurnCancelled when cancelled."""
+        self.tokens[job.device].check()
+        getattr(self, f"stage_{name}")(job)
+
+    def burn(self, iso, device, options=None):
+        """
+        Run every stage of a burn of iso to device. Without a helper the
+        process must already be root. Posts a ResultEvent and returns
+        True on success.
+        """
+        self.tokens[device] = CancelToken()
+        try:
+            job = self.plan(iso, device, options)
+            names = self.stages(job)
+            # Preflight checks do not need the USB link to themselves
+            self.run_stage(job, names[0])
+            with self.device_slot(device):
+                for name in names[1:]:
+                    self.run_stage(job, name)
+        except BurnCancelled:
+            self.report_cancelled(device)
+            return False
+        except BurnError as e:
+            self.report_failure(device, e)
+            return False
+        finally:
+            self.tokens.pop(device, None)
+
+        # Final success message, outside the slot so a dialog left open
+        # does not hold up burns queued behind the same hub
+        self.report_success(job)
+        return True
+
+    def report_success(self, job):
+        self.set_progress(job.device, 100)
+        self.timings.save()
+        self.set_phase(job.device, "Done")
+        self.log("ISO burned successfully!", success=True)
+        self.events.post(ResultEvent(job.device, True, "Success", "ISO burned successfully!"))
+
+    def report_failure(self, device, error):
+        self.set_phase(device, "Failed")
+        self.log(f"Error: {error}", success=False)
+        self.events.post(ResultEvent(device, False, error.title, str(error)))
+
+    def report_cancelled(self, device):
+        self.set_phase(device, "Cancelled")
+        self.log(f"Burn to {device} cancelled.", success=False)
+        self.events.post(ResultEvent(device, False, "Cancelled", f"Burn to {device} was cancelled."))
+
+    def has_bad_regions(self, device):
+        """True (and logged) when a previous health scan found bad regions on the device"""
+        bad = self.health.bad_regions(device_key(self.device_info(device)))
+        if bad:
+            self.log(f"Skipping {device}: health scan found {len(bad)} bad region(s).", success=False)
+        return bool(bad)
+
+    def device_slot(self, device):
+        """Slot on the device's shared USB links; waits while its hub is saturated"""
+        info = self.device_info(device)
+        mbps = self.benchmarks.write_mbps(device_key(info))
+        return self.scheduler.slot(
+            info, mbps * 1e6 if mbps else None,
+            on_wait=lambda: self.log(f"{device}: waiting for a shared USB link to free up..."))
+
+    def check_capacity(self, device):
+        """
+        Quick counterfeit check before a long burn. Returns False when
+        the stick cannot hold what it reports, or cannot be probed at all;
+        the helper gives the same verdict.
+        """
+        self.log(f"Checking {device} for fake capacity...")
+        if self.helper is None:
+            try:
+                result = probe_capacity(device, progress=self.log)
+            except OSError as e:
+                self.log(f"Capacity check failed: {e}", success=False)
+                return False
+            ok = result["ok"]
+            self.log(describe_result(result), success=ok)
+        else:
+            job = self.helper.probe(device)
+            for records in job.output():
+                for line in records:
+                    self.log(line)
+            ok = job.returncode == 0
+
+        return ok
+
+    def progress_model(self, job):
+        """
+        Phases of this burn with the bytes each one moves. Their weights
+        come from how fast previous burns on the same stick model went.
+        """
+        size = job.data_size
+        if job.multiboot:
+            return ProgressModel(model_key(self.device_info(job.device)), [("partition", 0), ("files", size)],
+                                 self.timings)
+        if job.is_windows:
+            phases = [("partition", 0), ("files", size)]
+        else:
+            phases = [("copy", size)]
+        if self.helper is not None:
+            phases.append(("sync", size))
+        if job.options["verify"]:
+            phases.append(("verify", size))
+        if job.options["persistence"] and not job.is_windows:
+            phases.append(("persistence", 0))
+        return ProgressModel(model_key(self.device_info(job.device)), phases, self.timings)
+
+    def begin_phase(self, model, device, phase):
+        model.start(phase)
+        self.set_phase(device, phase.capitalize())
+
+    def end_phase(self, model, device, phase, record=True):
+        self.set_progress(device, model.finish(phase, record))
+
+    def engine(self, device, model, phase):
+        """Engine advancing a model phase, stopped by the device's cancel token."""
+        return Engine(progress=self.engine_progress(device, model, phase), cancel=self.tokens.get(device))
+
+    def engine_progress(self, device, model, phase):
+        """Progress callback advancing a model phase from engine byte counts."""
+        def report(done, total):
+            self.events.bytes(device, done, total)
+            self.set_progress(device, model.update(phase, done))
+        return report
+
+    def stage_detect(self, job):
+        """
+        Preflight: refuse sticks with known bad regions or fake capacity,
+        persistence for images that cannot use it, and multiboot ISOs
+        that would overwrite each other in the library.
+        """
+        if self.has_bad_regions(job.device):
+            raise BurnError(f"{job.device} has bad regions from its last health scan.")
+        clashes = multiboot.duplicate_names(job.isos) if job.multiboot else []
+        if clashes:
+            raise BurnError(f"Several selected ISOs are named {', '.join(clashes)}, and the library keeps one "
+                            "file per name. Rename them apart first.", "Duplicate ISO Names")
+        if job.options["persistence"] and job.stream:
+            raise BurnError("A streamed image cannot get a persistence partition.", "Persistence Unsupported")
+        if job.options["persistence"] and not job.multiboot and persistence.live_flavor(job.iso) is None:
+            raise BurnError(f"{os.path.basename(job.iso)} is not an Ubuntu or Debian live image, "
+                            "so it cannot use a persistence partition.", "Persistence Unsupported")
+        if job.options["probe"] and not self.check_capacity(job.device):
+            raise BurnError(f"{job.device} does not hold the capacity it reports. Burning cancelled.",
+                            "Counterfeit Stick")
+
+    def stage_partition(self, job):
+        """
+        Windows images: one FAT32 partition, on GPT when UEFI support is
+        enabled. Multiboot: boot and library partitions, unless the stick
+        already has them.
+        """
+        device, model = job.device, job.model
+        self.begin_phase(model, device, "partition")
+        if job.multiboot and multiboot.has_layout(device):
+            self.log(f"{device} already has a multiboot library; only new or changed ISOs are copied.")
+            self.end_phase(model, device, "partition", record=False)
+            return
+        self.log("Creating the partition layout...")
+        if self.helper is None:
+            try:
+                if job.multiboot:
+                    multiboot.layout_stick(device, log=self.log)
+                else:
+                    windows.prepare_stick(device, job.options["uefi"], log=self.log)
+                ok = True
+            except OSError as e:
+                self.log(f"Error: {e}")
+                ok = False
+        else:
+            request = self.helper.partition(device, job.options["uefi"], job.multiboot)
+            self.read_output(request.output(), None, model, "partition", device, None)
+            ok = request.returncode == 0
+        self.end_phase(model, device, "partition", record=ok)
+        if not ok:
+            raise BurnError("Could not partition the drive.")
+
+    def stage_write(self, job):
+        """
+        Put the image on the device: a file copy for Windows, the block
+        engine otherwise, in-process as root or in the helper.
+        """
+        iso, device, model = job.iso, job.device, job.model
+        job.written_before = device_written_bytes(device)
+        if job.multiboot:
+            self.log(f"Copying {len(job.isos)} ISO(s) to the multiboot library...")
+            if not self.library_files(job):
+                raise BurnError("Failed to copy the ISOs.")
+        elif job.is_windows:
+            self.log("Copying Windows installer files (this may take a while)...")
+            if not self.windows_files(job, "copy"):
+                raise BurnError("Failed to burn ISO.")
+        elif job.stream:
+            self.log("Writing the streamed image to USB drive...")
+            self.stream_write(job)
+        elif self.helper is not None:
+            self.log("Writing image to USB drive...")
+            if not self.helper_image(job, "write"):
+                raise BurnError("Failed to burn ISO.")
+        else:
+            # Standard ISO burn through the block engine
+            key = device_key(self.device_info(device))
+            start = self.resume.offset(key, device, iso) if job.options["resume"] else 0
+            self.begin_phase(model, device, "copy")
+            if start:
+                self.log(f"Resuming write at {start / job.size:.0%} of the ISO...")
+            else:
+                self.log("Writing ISO to USB drive...")
+            try:
+                self.engine(device, model, "copy").write_image(iso, device, start)
+            except BurnCancelled as e:
+                # Everything below e.done is on the device; a resume starts there
+                self.resume.record(key, device, iso, e.done)
+                raise
+            except OSError as e:
+                self.end_phase(model, device, "copy", record=False)
+                raise BurnError(f"Write failed: {e}")
+            self.end_phase(model, device, "copy", record=not start)
+            self.resume.clear(key)
+
+    def stage_sync(self, job):
+        """
+        Sync before verifying so it reads the device rather than the
+        page cache. Progress is what actually reaches the device.
+        """
+        model, device = job.model, job.device
+        self.log("Flushing data to the USB drive...")
+        written = device_written_bytes(device)
+        if written is not None and job.written_before is not None:
+            model.set_work("sync", max(0, job.data_size - (written - job.written_before)))
+        self.run_phase(model, "sync", device, ["sync"], written_baseline=written)
+
+    def stage_verify(self, job):
+        """Read the device back and compare it with the image."""
+        iso, device, model = job.iso, job.device, job.model
+        self.log("Verifying written data...")
+        if job.is_windows:
+            ok = self.windows_files(job, "verify")
+        elif job.stream and self.helper is None:
+            self.begin_phase(model, device, "verify")
+            try:
+                ranges = [(0, job.size, job.digest)]
+                ok = self.engine(device, model, "verify").verify_ranges(device, ranges, stream.DIGEST) is None
+            except OSError as e:
+                self.log(f"Error: Could not read back device: {e}")
+                ok = False
+            self.end_phase(model, device, "verify", record=ok)
+        elif self.helper is not None:
+            ok = self.helper_image(job, "verify")
+        else:
+            self.begin_phase(model, device, "verify")
+            try:
+                ok = self.engine(device, model, "verify").verify(iso, device) is None
+            except OSError as e:
+                self.log(f"Error: Could not read back device: {e}")
+                ok = False
+            self.end_phase(model, device, "verify", record=ok)
+
+        if not ok:
+            self.log("Verification failed! The written data does not match the ISO.", success=False)
+            raise BurnError("Failed to burn ISO.")
+        self.log("Verification successful! Data was written correctly.", success=True)
+
+    def windows_files(self, job, op):
+        """
+        Copy ("copy") or compare ("verify") the Windows ISO's files on the
+        stick's partition, in-process as root or in the helper otherwise.
+        Returns True on success.
+        """
+        iso, device, model = job.iso, job.device, job.model
+        phase = "files" if op == "copy" else "verify"
+        partition = partition_path(device, 1)
+        token = self.tokens[device]
+        self.begin_phase(model, device, phase)
+        if self.helper is None:
+            func = windows.copy_iso_tree if op == "copy" else windows.verify_iso_tree
+            try:
+                result = func(iso, partition, progress=self.engine_progress(device, model, phase),
+                              log=self.log, cancel=token)
+                ok = op == "copy" or not result
+            except OSError as e:
+                self.log(f"Error: {e}")
+                ok = False
+        else:
+            request = self.helper.windows(op, iso, partition)
+            with token.watch(request.cancel):
+                self.read_output(request.output(), "wimlib", model, phase, device, None)
+            token.check()
+            ok = request.returncode == 0
+        self.end_phase(model, device, phase, record=ok)
+        return ok
+
+    def stream_write(self, job):
+        """
+        Write a streamed image, hashing it on the way, and set the job's
+        size and digest from what it turned out to be.
+        """
+        device, model = job.device, job.model
+        if job.iso == stream.STDIN and self.helper is not None:
+            raise BurnError("Standard input can only be streamed when running as root.")
+        if self.helper is not None:
+            if not self.helper_image(job, "write"):
+                raise BurnError("Failed to burn ISO.")
+        else:
+            self.begin_phase(model, device, "copy")
+            src = stream.PipeSource(job.iso)
+            try:
+                self.engine(device, model, "copy").write_stream(src, device)
+            except OSError as e:
+                self.end_phase(model, device, "copy", record=False)
+                raise BurnError(f"Write failed: {e}")
+            finally:
+                src.close()
+            job.size, job.digest = src.size, src.digest
+            self.end_phase(model, device, "copy", record=False)
+        if not job.size:
+            raise BurnError("The stream ended without any data.")
+        job.data_size = job.size
+        model.set_work("verify", job.size)
+        self.log(f"Wrote {job.size} bytes from the stream (SHA-256 {job.digest}).")
+
+    def helper_image(self, job, op):
+        """
+        Write ("write") or verify ("verify") an image through the block
+        engine in the helper. A streamed write reports the stream's size
+        and digest, and its verify checks the device against them.
+        Returns True on success.
+        """
+        device, model = job.device, job.model
+        phase = "copy" if op == "write" else "verify"
+        token = self.tokens[device]
+        self.begin_phase(model, device, phase)
+        if job.stream and op == "verify":
+            request = self.helper.image(op, job.iso, device, job.size, job.digest)
+        else:
+            request = self.helper.image(op, job.iso, device)
+
+        def without_digest(output):
+            for records in output:
+                lines = []
+                for line in records:
+                    found = stream.parse_digest(line)
+                    if found:
+                        job.size, job.digest = found
+                    else:
+                        lines.append(line)
+                yield lines
+
+        # Streams report progress in dd's format, which has no total
+        with token.watch(request.cancel):
+            self.read_output(without_digest(request.output()), "dd" if job.stream and op == "write" else "wimlib",
+                             model, phase, device, None)
+        token.check()
+        ok = request.returncode == 0
+        self.end_phase(model, device, phase, record=ok and not job.stream)
+        return ok
+
+    def library_files(self, job):
+        """
+        Copy a multiboot job's ISOs onto the library partition, in-process
+        as root or in the helper otherwise. Checksums the copy computed go
+        into the checksum cache. Returns True on success.
+        """
+        device, model = job.device, job.model
+        partition = partition_path(device, 2)
+        token = self.tokens[device]
+        digests = {iso: self.checksums.get(iso) for iso in job.isos}
+        self.begin_phase(model, device, "files")
+        if self.helper is None:
+            try:
+                found = multiboot.sync_library(job.isos, partition, digests,
+                                               progress=self.engine_progress(device, model, "files"),
+                                               log=self.log, cancel=token, verify=job.options["verify"])
+                ok = True
+            except OSError as e:
+                self.log(f"Error: {e}")
+                found, ok = {}, False
+        else:
+            found = {}
+            request = self.helper.library(job.isos, partition, digests, job.options["verify"])
+
+            def without_checksums(output):
+                for records in output:
+                    lines = []
+                    for line in records:
+                        parsed = multiboot.parse_checksum(line)
+                        if parsed:
+                            found[parsed[0]] = parsed[1]
+                        else:
+                            lines.append(line)
+                    yield lines
+
+            with token.watch(request.cancel):
+                self.read_output(without_checksums(request.output()), "wimlib", model, "files", device, None)
+            token.check()
+            ok = request.returncode == 0
+        for iso, digest in found.items():
+            if digest and digest != digests.get(iso):
+                self.checksums.put(iso, digest)
+        self.end_phase(model, device, "files", record=ok)
+        return ok
+
+    def stage_persistence(self, job):
+        """
+        Add a persistence partition behind the live image just written, as
+        root or in the same helper session that wrote it.
+        """
+        device, model = job.device, job.model
+        size = job.options["persistence_size"]
+        self.begin_phase(model, device, "persistence")
+        self.log("Creating the persistence partition...")
+        if self.helper is None:
+            try:
+                persistence.add_persistence(job.iso, device, size, log=self.log)
+                ok = True
+            except OSError as e:
+                self.log(f"Error: {e}")
+                ok = False
+        else:
+            request = self.helper.persistence(job.iso, device, size)
+            self.read_output(request.output(), None, model, "persistence", device, None)
+            ok = request.returncode == 0
+        self.end_phase(model, device, "persistence", record=ok)
+        if not ok:
+            raise BurnError("Could not create the persistence partition. The live image itself was written.")
+
+    def stage_eject(self, job):
+        """Flush and release the stick so it can be pulled. Failure is only a warning."""
+        self.set_phase(job.device, "Eject")
+        if self.run_command(["eject", job.device], device=job.device) != 0:
+            self.log(f"Warning: Could not eject {job.device}; unmount it before removing.")
+
+    def run_phase(self, model, phase, device, cmd, total_bytes=None, written_baseline=None):
+        """Run one command (an argv list) as a model phase. Returns the command's return code."""
+        self.begin_phase(model, device, phase)
+        result = self.run_command(cmd, model, phase, device, total_bytes, written_baseline)
+        self.end_phase(model, device, phase, record=result == 0)
+        return result
+
+    def run_command(self, cmd, model=None, phase=None, device=None, total_bytes=None, written_baseline=None):
+        """
+        Run a command, given as an argv list and never through a shell,
+        and update progress. Returns the command's return code.
+        Output is logged as it arrives. With written_baseline the phase
+        follows the bytes the kernel has sent to the device since then,
+        which is the only progress a silent command like sync has.
+        With a helper the command runs there as root.
+        """
+        def poll_device():
+            written = device_written_bytes(device)
+            if written is not None:
+                self.events.bytes(device, written - written_baseline, model.work.get(phase) or 0)
+                self.set_progress(device, model.update(phase, written - written_baseline))
+
+        poll = poll_device if model and written_baseline is not None else None
+        token = self.tokens.get(device) or CancelToken()
+        if self.helper is not None:
+            job = self.helper.run(cmd)
+            output = job.output(poll=poll)
+            stop = job.cancel
+        else:
+            # Own session, so cancelling kills the tool and whatever it started
+            process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT, start_new_session=True)
+            output = iter_output(process.stdout, poll=poll)
+            stop = lambda: stop_process(process)
+        with token.watch(stop):
+            self.read_output(output, None, model, phase, device, total_bytes)
+        if self.helper is not None:
+            returncode = job.returncode
+        else:
+            process.stdout.close()
+            returncode = process.wait()
+        token.check()
+        return returncode
+
+    def read_output(self, output, tool, model, phase, device, total_bytes):
+        """Log tool output records and turn progress records into model updates."""
+        for records in output:
+            latest = None
+            for line in records:
+                self.log(line)
+                latest = parse_line(tool, line) or latest
+
+            # Only the newest progress record of each read matters
+            if latest is None or model is None:
+                continue
+            total = latest.total or total_bytes
+            if latest.done is not None and device:
+                self.events.bytes(device, latest.done, total or 0)
+            if latest.done is not None and total:
+                self.set_progress(device, model.update_fraction(phase, latest.done / total))
+            elif latest.percent is not None:
+                self.set_progress(device, model.update_fraction(phase, latest.percent / 100))
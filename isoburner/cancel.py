@@ -0,0 +1,125 @@
+import os
+import signal
+import time
+from threading import Event, Lock, Timer
+
+from . import storage
+
+RESUME_FILE = "resume.json"
+# Seconds a tool gets to exit after SIGTERM before its group is killed
+KILL_GRACE = 3.0
+
+
+class BurnCancelled(Exception):
+    """Raised inside a burn once its CancelToken is cancelled."""
+
+    def __init__(self, done=0):
+        super().__init__("cancelled")
+        # Bytes from the start of the image known to be on the device
+        self.done = done
+
+
+class CancelToken:
+    """
+    Cancellation flag for one burn. Engine loops poll it between chunks;
+    running tools register a stop callback with watch() so cancel() can
+    kill them straight away instead of waiting for them to finish.
+    """
+
+    def __init__(self):
+        self.event = Event()
+        self.lock = Lock()
+        self.stops = set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def cancel(self):
+        with self.lock:
+            self.event.set()
+            stops = list(self.stops)
+        for stop in stops:
+            stop()
+
+    def check(self, done=0):
+        if self.event.is_set():
+            raise BurnCancelled(done)
+
+    def watch(self, stop):
+        """Context manager registering stop() for the duration of a step."""
+        token = self
+
+        class Watch:
+            def __enter__(self):
+                with token.lock:
+                    token.stops.add(stop)
+                    cancelled = token.event.is_set()
+                if cancelled:
+                    stop()
+
+            def __exit__(self, *exc):
+                with token.lock:
+                    token.stops.discard(stop)
+
+        return Watch()
+
+
+def stop_process(process, grace=KILL_GRACE):
+    """
+    SIGTERM the process group of a Popen started with start_new_session,
+    then SIGKILL it if it is still running after `grace` seconds. Returns
+    at once so it can be called from the UI thread.
+    """
+    def kill(sig):
+        if process.poll() is None:
+            try:
+                os.killpg(process.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    kill(signal.SIGTERM)
+    timer = Timer(grace, kill, args=(signal.SIGKILL,))
+    timer.daemon = True
+    timer.start()
+
+
+class ResumeStore:
+    """Where cancelled burns stopped, keyed by device_key, so a later burn can continue."""
+
+    def __init__(self, filename=RESUME_FILE):
+        self.filename = filename
+        self.entries = storage.load_json(filename)
+
+    def record(self, key, device, iso, done):
+        stat = os.stat(iso)
+        self.entries[key] = {
+            "device": device,
+            "iso": os.path.abspath(iso),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "done": done,
+            "time": time.time(),
+        }
+        storage.save_json(self.filename, self.entries)
+
+    def offset(self, key, device, iso):
+        """Bytes already written for this exact image, or 0."""
+        entry = self.entries.get(key)
+        if not entry:
+            return 0
+        if ":port-" in key and entry["device"] != device:
+            # Without a serial number the key only names a port, so the
+            # device path must match as well
+            return 0
+        try:
+            stat = os.stat(iso)
+        except OSError:
+            return 0
+        if (entry["iso"], entry["size"], entry["mtime"]) != (os.path.abspath(iso), stat.st_size, stat.st_mtime):
+            return 0
+        return entry["done"]
+
+    def clear(self, key):
+        if self.entries.pop(key, None) is not None:
+            storage.save_json(self.filename, self.entries)
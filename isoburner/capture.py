@@ -0,0 +1,71 @@
+"""
+Device-to-image capture: the reverse of a burn.
+
+The device is read through the block engine in large direct reads.
+Blocks that are all zeros become holes in a raw image, or are left out
+of the data map of a .zst image, so empty space on a golden-master
+stick costs no disk space. A burn zeroes those ranges rather than
+copying them, so the duplicate matches the master even on a used stick.
+"""
+import os
+
+from . import compressed
+from .engine import Engine
+
+# Large reads: one request per chunk keeps a stick streaming
+CAPTURE_CHUNK = 16 * 1024 * 1024
+
+
+def merge_extent(extents, start, end):
+    """Append [start, end) to sorted (offset, length) extents, joining it to the last one if they touch."""
+    if extents and extents[-1][0] + extents[-1][1] == start:
+        extents[-1] = (extents[-1][0], end - extents[-1][0])
+    else:
+        extents.append((start, end - start))
+
+
+def capture(device, output, progress=None, cancel=None, threads=-1):
+    """
+    Read device into output: a sparse raw image, or a zstd-compressed one
+    when output ends in .zst (threads compression workers, -1 for one per
+    CPU). Returns (size, data bytes). Raises OSError, and BurnCancelled
+    when cancelled; a partial output is removed either way.
+    """
+    engine = Engine(chunk_size=CAPTURE_CHUNK, progress=progress, cancel=cancel)
+    extents = []
+    partial = output + ".part"
+    try:
+        with open(partial, "wb") as f:
+            if output.endswith(".zst"):
+                writer = compressed.compressor(threads).stream_writer(f, closefd=False)
+
+                def consume(offset, chunk, runs):
+                    writer.write(chunk)
+                    for start, end in runs:
+                        merge_extent(extents, offset + start, offset + end)
+
+                size = engine.read_image(device, consume)
+                writer.flush(compressed.zstandard.FLUSH_FRAME)
+                compressed.write_map(f, size, extents)
+            else:
+                fd = f.fileno()
+
+                def consume(offset, chunk, runs):
+                    view = memoryview(chunk)
+                    for start, end in runs:
+                        os.pwrite(fd, view[start:end], offset + start)
+                        merge_extent(extents, offset + start, offset + end)
+
+                size = engine.read_image(device, consume)
+                # Whatever was never written stays a hole
+                f.truncate(size)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(partial, output)
+    except BaseException:
+        try:
+            os.unlink(partial)
+        except OSError:
+            pass
+        raise
+    return size, sum(length for _, length in extents)
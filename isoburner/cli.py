@@ -0,0 +1,296 @@
+"""
+Headless front end: burn, verify and inspect devices without Tk.
+
+    python -m isoburner --iso image.iso --device /dev/sdb
+    python -m isoburner --iso a.iso --iso b.iso --device /dev/sdb
+    xz -dc image.img.xz | python -m isoburner --iso - --device /dev/sdb --yes
+    python -m isoburner --batch jobs.txt --json
+    python -m isoburner --device /dev/sdb --capture master.img.zst
+    python -m isoburner --make-bmap appliance.img
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from threading import Event
+
+from . import bmap
+from .burner import Burner, is_windows_iso
+from .stream import STDIN, is_stream
+from .capture import capture
+from .devices import list_usb_devices, describe_device, format_size
+from .engine import Engine
+from .events import EventBus, LogEvent, ProgressEvent, BytesEvent, PhaseEvent, ResultEvent, CallEvent
+from .jobs import JobRunner, JobStore, MEMORY_STORE, DEFAULT_WORKERS, QUEUED, DONE
+
+# Seconds between progress reports on the console
+REPORT_INTERVAL = 0.5
+
+
+def parse_batch(path):
+    """
+    Read (image, device, priority) jobs from a file: either JSON lines
+    with "iso", "device" and optional "priority" keys, or "image device"
+    pairs separated by whitespace. Blank lines and lines starting with #
+    are ignored.
+    """
+    jobs = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                entry = json.loads(line)
+                jobs.append((entry["iso"], entry["device"], int(entry.get("priority", 0))))
+                continue
+            parts = line.split()
+            if len(parts) != 2:
+                raise ValueError(f"{path}:{number}: expected 'image device', got {line!r}")
+            jobs.append((parts[0], parts[1], 0))
+    return jobs
+
+
+class Reporter:
+    """Print EventBus events as text or as one JSON object per line."""
+
+    def __init__(self, as_json=False, stream=sys.stdout):
+        self.as_json = as_json
+        self.stream = stream
+        self.percent = {}
+
+    def emit(self, record):
+        self.stream.write(json.dumps(record) + "\n")
+        self.stream.flush()
+
+    def handle(self, events):
+        for event in events:
+            if isinstance(event, LogEvent):
+                if self.as_json:
+                    self.emit({"event": "log", "text": event.text, "success": event.success})
+                else:
+                    print(event.text, file=self.stream)
+            elif isinstance(event, ProgressEvent):
+                self.percent[event.device] = event.percent
+                if self.as_json:
+                    self.emit({"event": "progress", "device": event.device, "percent": round(event.percent, 1)})
+            elif isinstance(event, BytesEvent):
+                if self.as_json:
+                    self.emit({"event": "bytes", "device": event.device, "done": event.done, "total": event.total})
+                else:
+                    # The stage percent lags a batch of byte events, so use
+                    # the bytes themselves when the total is known
+                    if event.total:
+                        percent = 100.0 * event.done / event.total
+                    else:
+                        percent = self.percent.get(event.device, 0.0)
+                    print(f"{event.device}: {percent:5.1f}% {format_size(event.done)}"
+                          + (f" of {format_size(event.total)}" if event.total else ""), file=self.stream)
+            elif isinstance(event, PhaseEvent):
+                if self.as_json:
+                    self.emit({"event": "phase", "device": event.device, "name": event.name})
+                else:
+                    print(f"{event.device}: {event.name}", file=self.stream)
+            elif isinstance(event, ResultEvent):
+                if self.as_json:
+                    self.emit({"event": "result", "device": event.device, "ok": event.ok, "message": event.message})
+                else:
+                    print(f"{event.device}: {event.title}: {event.message}", file=self.stream)
+            elif isinstance(event, CallEvent):
+                event.func(*event.args, **event.kwargs)
+        self.stream.flush()
+
+
+def run_jobs(jobs, options, reporter, workers=DEFAULT_WORKERS):
+    """Burn every job through a JobRunner, reporting until all finish. Returns True if all succeeded."""
+    events = EventBus()
+    outcome = {}
+    finished = Event()
+
+    def changed(job_id, state):
+        if state != QUEUED:
+            outcome[job_id] = state
+            if len(outcome) == len(jobs):
+                finished.set()
+
+    # Kept in memory: the jobs of a command-line run must never be
+    # restored (and their sticks erased) by a later GUI session
+    runner = JobRunner(Burner(events), JobStore(MEMORY_STORE), workers=workers, on_change=changed)
+    runner.start(restore=False)
+    for iso, device, priority in jobs:
+        runner.submit(iso, device, options, priority)
+    while not finished.is_set():
+        try:
+            finished.wait(REPORT_INTERVAL)
+        except KeyboardInterrupt:
+            # Ctrl-C cancels cleanly; keep reporting while the burns wind down
+            events.log("Cancelling...")
+            runner.cancel()
+        reporter.handle(events.drain())
+    reporter.handle(events.drain())
+    return all(state == DONE for state in outcome.values())
+
+
+def capture_device(device, output, reporter):
+    """Read a device into an image file, reporting progress. Returns True on success."""
+    events = EventBus()
+    reported = time.monotonic()
+
+    def progress(done, total):
+        nonlocal reported
+        events.post(ProgressEvent(device, 100.0 * done / total if total else 100.0))
+        events.bytes(device, done, total)
+        if time.monotonic() - reported >= REPORT_INTERVAL:
+            reporter.handle(events.drain())
+            reported = time.monotonic()
+
+    events.log(f"Capturing {device} to {output}...")
+    try:
+        size, data = capture(device, output, progress=progress)
+    except OSError as e:
+        events.post(ResultEvent(device, False, "Error", f"Capture failed: {e}"))
+        ok = False
+    else:
+        events.post(ResultEvent(device, True, "Captured",
+                                f"{format_size(size)} image with {format_size(data)} of data saved to {output}"))
+        ok = True
+    reporter.handle(events.drain())
+    return ok
+
+
+def make_bmap(image, native, reporter):
+    """Write a block map next to image. Returns True on success."""
+    events = EventBus()
+    path = image + (bmap.NATIVE_SUFFIX if native else bmap.XML_SUFFIX)
+    events.log(f"Mapping the data in {image}...")
+
+    def progress(done, total):
+        events.post(ProgressEvent(image, 100.0 * done / total if total else 100.0))
+        events.bytes(image, done, total)
+
+    try:
+        found = bmap.generate(image, Engine(progress=progress))
+        bmap.save(found, path)
+    except OSError as e:
+        events.post(ResultEvent(image, False, "Error", f"Could not map {image}: {e}"))
+        ok = False
+    else:
+        events.post(ResultEvent(image, True, "Mapped",
+                                f"{format_size(found.mapped_bytes)} of {format_size(found.image_size)} "
+                                f"holds data; block map saved to {path}"))
+        ok = True
+    reporter.handle(events.drain())
+    return ok
+
+
+def list_devices(as_json):
+    devices = list_usb_devices()
+    if as_json:
+        print(json.dumps(devices))
+        return
+    if not devices:
+        print("No USB devices found.")
+    for info in devices:
+        print(describe_device(info))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="isoburner", description="Burn ISO images to USB drives without the GUI.")
+    parser.add_argument("--iso", action="append", help="image to write, or - to stream it from standard input; "
+                        "repeat for a multiboot stick")
+    parser.add_argument("--multiboot", action="store_true",
+                        help="copy the images as files onto a multiboot library partition")
+    parser.add_argument("--device", help="target block device, e.g. /dev/sdb")
+    parser.add_argument("--batch", metavar="FILE", help="file of 'image device' pairs to burn concurrently")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="burns to run at once")
+    parser.add_argument("--eject", action="store_true", help="eject each device after a successful burn")
+    parser.add_argument("--verify", dest="verify", action="store_true", default=True,
+                        help="read back and compare after writing (default)")
+    parser.add_argument("--no-verify", dest="verify", action="store_false")
+    parser.add_argument("--no-uefi", dest="uefi", action="store_false", help="skip the UEFI partition for Windows images")
+    parser.add_argument("--skip-probe", dest="probe", action="store_false", help="skip the fake capacity check")
+    parser.add_argument("--resume", action="store_true", help="continue a cancelled burn of the same image")
+    parser.add_argument("--persistence", action="store_true",
+                        help="add a persistence partition behind an Ubuntu or Debian live image")
+    parser.add_argument("--persistence-size", type=int, metavar="MIB",
+                        help="size of the persistence partition (default: the rest of the stick)")
+    parser.add_argument("--json", action="store_true", help="print progress as JSON lines")
+    parser.add_argument("--yes", action="store_true", help="do not ask before erasing devices")
+    parser.add_argument("--list", action="store_true", help="list USB devices and exit")
+    parser.add_argument("--detect", metavar="ISO", help="print whether an image is a Windows installer and exit")
+    parser.add_argument("--capture", metavar="IMAGE",
+                        help="read --device into a sparse image (zstd-compressed for .zst) and exit")
+    parser.add_argument("--make-bmap", metavar="IMAGE", help="write a block map next to a raw image and exit")
+    parser.add_argument("--native-bmap", action="store_true",
+                        help="write the block map in the compact .bmap.json format instead of bmaptool's XML")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if args.list:
+        list_devices(args.json)
+        return 0
+    if args.detect:
+        windows = is_windows_iso(args.detect)
+        print(json.dumps({"iso": args.detect, "windows": windows}) if args.json
+              else ("Windows Installation ISO" if windows else "Standard ISO"))
+        return 0
+
+    if args.make_bmap:
+        return 0 if make_bmap(args.make_bmap, args.native_bmap, Reporter(as_json=args.json)) else 1
+    if args.capture:
+        if not args.device:
+            parser.error("--capture needs --device")
+        if os.geteuid() != 0:
+            parser.error("must be run as root")
+        return 0 if capture_device(args.device, args.capture, Reporter(as_json=args.json)) else 1
+
+    if args.batch:
+        try:
+            jobs = parse_batch(args.batch)
+        except (OSError, ValueError, KeyError) as e:
+            parser.error(f"cannot read batch file: {e}")
+    elif args.iso and args.device:
+        multiple = args.multiboot or len(args.iso) > 1
+        jobs = [(args.iso if multiple else args.iso[0], args.device, 0)]
+    else:
+        parser.error("either --iso and --device, or --batch, is required")
+
+    devices = [device for _, device, _ in jobs]
+    if len(set(devices)) != len(devices):
+        parser.error("each device may appear only once")
+    streams = []
+    for isos, _, _ in jobs:
+        for iso in [isos] if isinstance(isos, str) else isos:
+            if is_stream(iso):
+                if not isinstance(isos, str):
+                    parser.error(f"a multiboot stick cannot be built from a stream: {iso}")
+                streams.append(iso)
+            elif not os.path.isfile(iso):
+                parser.error(f"no such image: {iso}")
+    # A stream is read once, so it can feed only one device
+    if len(set(streams)) != len(streams):
+        parser.error("each stream may be burned to only one device")
+    if STDIN in streams and not args.yes:
+        parser.error("--yes is required when the image comes from standard input")
+    if os.geteuid() != 0:
+        parser.error("must be run as root")
+
+    if not args.yes:
+        answer = input(f"Erase all data on {', '.join(devices)}? [y/N] ")
+        if answer.strip().lower() not in ("y", "yes"):
+            return 1
+
+    options = {"verify": args.verify, "uefi": args.uefi, "probe": args.probe,
+               "resume": args.resume, "eject": args.eject, "persistence": args.persistence,
+               "persistence_size": args.persistence_size * 2 ** 20 if args.persistence_size else None}
+    reporter = Reporter(as_json=args.json)
+    return 0 if run_jobs(jobs, options, reporter, max(1, args.workers)) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
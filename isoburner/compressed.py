@@ -0,0 +1,164 @@
+"""
+zstd-compressed images (.img.zst), through the optional zstandard module.
+
+Captured images are one ordinary zstd frame holding the whole raw image,
+so `zstd -d` restores it, followed by a skippable frame (which zstd
+ignores) with the image size and the ranges that hold data. With that
+map the engine writes and verifies only the data and zeroes the rest,
+which is all zeros in the image; zero runs in the stream are RLE blocks
+that cost next to nothing to compress.
+"""
+import json
+import struct
+from threading import Lock
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compression level for captures; multi-threaded zstd keeps up with USB at this level
+LEVEL = 3
+# Any of 0x184D2A50..0x184D2A5F marks a frame decoders skip
+SKIPPABLE_MAGIC = 0x184D2A5E
+SKIPPABLE_MASK = 0xFFFFFFF0
+# Frame header descriptor bit for a trailing 4-byte content checksum
+CHECKSUM_FLAG = 0x04
+# Longest possible frame header
+MAX_HEADER = 18
+# Trails the map frame so it can be found from the end of the file
+MAP_TAG = b"ISOBMAP1"
+READ_SIZE = 4 * 1024 * 1024
+
+
+def available():
+    return zstandard is not None
+
+
+def require():
+    if zstandard is None:
+        raise OSError("zstd images need the zstandard Python module (pip install zstandard)")
+
+
+def compressor(threads=-1):
+    """Multi-threaded compressor; threads=-1 uses every CPU."""
+    require()
+    return zstandard.ZstdCompressor(level=LEVEL, threads=threads, write_content_size=True)
+
+
+def write_map(f, size, extents):
+    """Append the skippable frame carrying the image size and data extents."""
+    body = json.dumps({"size": size, "extents": extents}, separators=(",", ":")).encode()
+    payload = body + struct.pack("<I", len(body)) + MAP_TAG
+    f.write(struct.pack("<II", SKIPPABLE_MAGIC, len(payload)) + payload)
+
+
+def read_map(f):
+    """(size, extents) from a captured image's map frame, or None when it has none."""
+    end = f.seek(0, 2)
+    if end < 12:
+        return None
+    f.seek(end - 12)
+    length, tag = struct.unpack("<I8s", f.read(12))
+    if tag != MAP_TAG or length > end - 12:
+        return None
+    f.seek(end - 12 - length)
+    try:
+        entry = json.loads(f.read(length))
+        return entry["size"], [tuple(extent) for extent in entry["extents"]]
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def content_size(f):
+    """
+    Decompressed size of all the frames in f together, for files made of
+    several frames (pzstd, concatenated .zst files). None when a frame
+    does not record its size.
+    """
+    end = f.seek(0, 2)
+    offset = total = 0
+    while offset < end:
+        f.seek(offset)
+        header = f.read(MAX_HEADER)
+        magic, = struct.unpack_from("<I", header)
+        if magic & SKIPPABLE_MASK == SKIPPABLE_MAGIC & SKIPPABLE_MASK:
+            offset += 8 + struct.unpack_from("<I", header, 4)[0]
+            continue
+        size = zstandard.frame_content_size(header)
+        if size < 0:
+            return None
+        total += size
+        checksum = 4 if header[4] & CHECKSUM_FLAG else 0
+        offset += zstandard.frame_header_size(header)
+        # Step over the blocks by their 3-byte headers: last flag, type, size
+        while True:
+            f.seek(offset)
+            block = int.from_bytes(f.read(3), "little")
+            kind, length = (block >> 1) & 3, block >> 3
+            # An RLE block stores its byte once
+            offset += 3 + (1 if kind == 1 else length)
+            if block & 1:
+                break
+        offset += checksum
+    return total
+
+
+class ZstdSource:
+    """
+    Image source that decompresses a .zst image front to back. Reads
+    further ahead skip forward in the stream; going back reopens it.
+    """
+
+    sequential = True
+
+    def __init__(self, path):
+        require()
+        self.file = open(path, "rb")
+        self.lock = Lock()
+        found = read_map(self.file)
+        self.file.seek(0)
+        if found:
+            self.size, self.extents = found
+        else:
+            self.extents = None
+            try:
+                self.size = content_size(self.file)
+            except (zstandard.ZstdError, struct.error, IndexError) as e:
+                self.file.close()
+                raise OSError(f"{path} is not a valid zstd file: {e}")
+            self.file.seek(0)
+            if self.size is None:
+                self.file.close()
+                raise OSError(f"{path} does not record its uncompressed size")
+        self.reader = None
+        self.position = 0
+
+    def _open(self):
+        if self.reader is not None:
+            self.reader.close()
+        self.file.seek(0)
+        self.reader = zstandard.ZstdDecompressor().stream_reader(self.file, read_size=READ_SIZE, closefd=False,
+                                                                 read_across_frames=True)
+        self.position = 0
+
+    def read_into(self, view, offset):
+        with self.lock:
+            if self.reader is None or offset < self.position:
+                self._open()
+            if offset > self.position:
+                self.position = self.reader.seek(offset)
+            view = memoryview(view)
+            done = 0
+            while done < len(view):
+                n = self.reader.readinto(view[done:])
+                if not n:
+                    break
+                done += n
+            self.position += done
+            return done
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+        self.file.close()
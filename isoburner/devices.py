@@ -0,0 +1,154 @@
+import os
+
+SYS_BLOCK = "/sys/block"
+MOUNTS = "/proc/self/mounts"
+
+
+def read_sysfs(path, default=""):
+    """Read a single sysfs attribute, returning default if it is missing."""
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+
+def read_sysfs_int(path, default=0):
+    try:
+        return int(read_sysfs(path, str(default)))
+    except ValueError:
+        return default
+
+
+def find_usb_parent(block_name):
+    """
+    Walk up from a block device's sysfs node to the USB device that owns it.
+    Returns the sysfs directory holding idVendor/idProduct, or None for
+    devices that are not attached over USB.
+    """
+    path = os.path.realpath(os.path.join(SYS_BLOCK, block_name, "device"))
+    while path and path != "/":
+        if os.path.exists(os.path.join(path, "idVendor")):
+            return path
+        path = os.path.dirname(path)
+    return None
+
+
+def get_device_info(device):
+    """
+    Collect the sysfs metadata for a whole-disk block device such as /dev/sdb:
+    identity (vendor, product, serial), size and the queue limits that the
+    benchmark, ETA and alignment code depend on.
+    """
+    name = os.path.basename(device)
+    block = os.path.join(SYS_BLOCK, name)
+    queue = os.path.join(block, "queue")
+
+    info = {
+        "path": f"/dev/{name}",
+        "name": name,
+        "vendor": read_sysfs(os.path.join(block, "device", "vendor")),
+        "model": read_sysfs(os.path.join(block, "device", "model")),
+        # /sys/block/*/size is always in 512-byte sectors
+        "size": read_sysfs_int(os.path.join(block, "size")) * 512,
+        "removable": read_sysfs(os.path.join(block, "removable")) == "1",
+        "read_only": read_sysfs(os.path.join(block, "ro")) == "1",
+        "logical_block_size": read_sysfs_int(os.path.join(queue, "logical_block_size"), 512),
+        "physical_block_size": read_sysfs_int(os.path.join(queue, "physical_block_size"), 512),
+        "optimal_io_size": read_sysfs_int(os.path.join(queue, "optimal_io_size")),
+        "discard_granularity": read_sysfs_int(os.path.join(queue, "discard_granularity")),
+        "rotational": read_sysfs(os.path.join(queue, "rotational")) == "1",
+        "id_vendor": "",
+        "id_product": "",
+        "serial": read_sysfs(os.path.join(block, "serial")),
+        "usb_path": None,
+    }
+
+    usb = find_usb_parent(name)
+    if usb:
+        info["usb_path"] = usb
+        info["id_vendor"] = read_sysfs(os.path.join(usb, "idVendor"))
+        info["id_product"] = read_sysfs(os.path.join(usb, "idProduct"))
+        info["serial"] = read_sysfs(os.path.join(usb, "serial")) or info["serial"]
+        info["vendor"] = read_sysfs(os.path.join(usb, "manufacturer")) or info["vendor"]
+        info["model"] = read_sysfs(os.path.join(usb, "product")) or info["model"]
+
+    return info
+
+
+def device_key(info):
+    """
+    Stable vendor:product:serial key used to store per-stick results. Sticks
+    without a serial number use the USB port they are plugged into and their
+    size instead, so identical serial-less sticks don't share benchmark,
+    health and resume history; such a stick starts afresh on another port.
+    """
+    serial = info.get("serial")
+    if not serial:
+        port = os.path.basename(info.get("usb_path") or "") or info.get("name") or "unknown"
+        serial = f"port-{port}-{info.get('size') or 0}"
+    return f"{info.get('id_vendor') or 'unknown'}:{info.get('id_product') or 'unknown'}:{serial}"
+
+
+def list_usb_devices():
+    """Return device info for every whole-disk sd* device, sorted by name."""
+    devices = []
+    try:
+        names = sorted(os.listdir(SYS_BLOCK))
+    except OSError:
+        names = sorted(d for d in os.listdir("/dev/") if d.startswith("sd"))
+    for name in names:
+        if name.startswith("sd") and not name[-1].isdigit():
+            devices.append(get_device_info(name))
+    return devices
+
+
+def mounted_partitions(device):
+    """Mounted filesystems on a whole-disk device or its partitions, as device paths."""
+    name = os.path.basename(device)
+    try:
+        with open(MOUNTS) as f:
+            sources = [line.split()[0] for line in f if line.strip()]
+    except OSError:
+        return []
+    holders = {name}
+    try:
+        holders.update(os.listdir(os.path.join(SYS_BLOCK, name)))
+    except OSError:
+        pass
+    # Partitions show up as subdirectories named after the disk
+    return [source for source in sources
+            if source.startswith("/dev/") and os.path.basename(source) in holders
+            and os.path.basename(source).startswith(name)]
+
+
+def is_fan_out_target(info):
+    """
+    True for a device that "write to all devices" may erase: attached
+    over USB or marked removable, with nothing on it mounted.
+    """
+    return bool(info.get("usb_path") or info.get("removable")) and not mounted_partitions(info["path"])
+
+
+def describe_device(info):
+    """Short human readable label, e.g. 'SanDisk Cruzer Blade (14.3 GiB)'."""
+    label = " ".join(part for part in (info.get("vendor"), info.get("model")) if part) or info["name"]
+    return f"{label} ({format_size(info.get('size', 0))})"
+
+
+def format_size(num_bytes):
+    size = float(num_bytes)
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if size < 1024 or unit == "TiB":
+            return f"{size:.1f} {unit}" if unit != "B" else f"{int(size)} B"
+        size /= 1024
+
+
+def partition_path(device, number):
+    """/dev/sdb -> /dev/sdb1, but /dev/nvme0n1 or /dev/mmcblk0 -> ...p1."""
+    return f"{device}p{number}" if device[-1].isdigit() else f"{device}{number}"
+
+
+def partition_start(partition):
+    """Start of a partition on its disk in 512-byte sectors, or 0 if it is not a partition."""
+    return read_sysfs_int(os.path.join("/sys/class/block", os.path.basename(partition), "start"))
@@ -0,0 +1,474 @@
+import hashlib
+import os
+import queue
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from . import blockio, bmap
+
+CHUNK_SIZE = 4 * 1024 * 1024
+# Number of chunk I/Os kept in flight. USB mass storage gains little past
+# a handful, but a single outstanding request leaves the stick idle between
+# the completion of one write and the submission of the next.
+QUEUE_DEPTH = 4
+SECTOR = 512
+
+
+class FileSource:
+    """
+    Image source backed by a file. write_image() and verify() also accept
+    any object with the same size, read_into() and close(), such as a
+    filesystem image built on the fly. A source may also have:
+
+    extents     sorted (offset, length) ranges that hold data; the rest
+                of the image is skipped when writing and verifying
+    sequential  True when read_into() only works front to back, so the
+                engine reads it in order from the calling thread
+    """
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY)
+        info = os.fstat(self.fd)
+        self.size = info.st_size
+        # A sparse image's holes only read as zeros; learn where its data is
+        self.extents = blockio.file_extents(self.fd, self.size) if is_sparse(info) else None
+        try:
+            os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except (AttributeError, OSError):
+            pass
+
+    def read_into(self, view, offset):
+        return blockio.pread_full(self.fd, view, offset)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def is_sparse(info):
+    """True for an os.stat() result of a regular file with fewer blocks allocated than its size."""
+    return stat.S_ISREG(info.st_mode) and info.st_blocks * 512 < info.st_size
+
+
+def open_source(source):
+    """
+    A FileSource (ZstdSource for .zst) for a path, limited to the ranges
+    of its block map when it has one; image objects are used as they are.
+    """
+    if hasattr(source, "read_into"):
+        return source
+    if source.endswith(".zst"):
+        from .compressed import ZstdSource
+        src = ZstdSource(source)
+    else:
+        src = FileSource(source)
+    try:
+        found = bmap.load_for(source)
+        if found is not None and found.image_size != src.size:
+            raise OSError(f"the block map next to {source} is for a {found.image_size} byte image, "
+                          f"not {src.size} bytes")
+    except OSError:
+        src.close()
+        raise
+    if found is not None:
+        src.bmap = found
+        src.extents = found.extents()
+    return src
+
+
+def image_sizes(path):
+    """(image size once decompressed, bytes of it that hold data) for a path."""
+    src = open_source(path)
+    try:
+        extents = getattr(src, "extents", None)
+        return src.size, src.size if extents is None else sum(length for _, length in extents)
+    finally:
+        src.close()
+
+
+class Engine:
+    """
+    Chunked block I/O with several requests in flight.
+
+    Burning, verification and health scans all go through here so they
+    share the same buffering, O_DIRECT handling and progress reporting.
+    progress is called from the calling thread as progress(done, total).
+    With a CancelToken no new chunk is started once it is cancelled; the
+    few already in flight finish, so stopping takes at most `depth` chunks.
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE, depth=QUEUE_DEPTH, progress=None, cancel=None):
+        self.chunk_size = chunk_size
+        self.depth = depth
+        self.progress = progress or (lambda done, total: None)
+        self.cancel = cancel
+
+    def _map(self, jobs, work, buffer_size, prepare=None):
+        """
+        Run work(job, buf) for every job with at most `depth` outstanding,
+        yielding results as they complete. prepare(job, buf), if given, runs
+        in the calling thread first, which keeps sequential source reads in
+        order while the device writes overlap.
+        """
+        buffers = queue.Queue()
+        for _ in range(self.depth):
+            buffers.put(blockio.aligned_buffer(buffer_size))
+
+        def run(job, buf):
+            try:
+                return work(job, buf)
+            finally:
+                buffers.put(buf)
+
+        with ThreadPoolExecutor(max_workers=self.depth) as pool:
+            pending = set()
+            for job in jobs:
+                if self.cancel is not None and self.cancel.cancelled:
+                    break
+                # Waiting for a free buffer is what bounds the queue depth
+                while buffers.empty() and pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                buf = buffers.get()
+                if prepare:
+                    job = prepare(job, buf)
+                pending.add(pool.submit(run, job, buf))
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+    def _chunks(self, total, start=0):
+        for offset in range(start, total, self.chunk_size):
+            yield offset, min(self.chunk_size, total - offset)
+
+    def _data_chunks(self, src, total):
+        """Chunks of the source's first total bytes that hold data: its extents, or all of it."""
+        extents = getattr(src, "extents", None)
+        if extents is None:
+            return list(self._chunks(total))
+        return self._extent_chunks(extents, total)
+
+    def _extent_chunks(self, extents, total):
+        jobs = []
+        end = 0
+        for first, length in extents:
+            # O_DIRECT needs aligned offsets; widening an extent only adds zeros
+            stop = min(blockio.align_up(first + length, blockio.DIRECT_ALIGNMENT), total)
+            first = max(blockio.align_down(first, blockio.DIRECT_ALIGNMENT), end)
+            end = max(stop, end)
+            for offset in range(first, end, self.chunk_size):
+                jobs.append((offset, min(self.chunk_size, end - offset)))
+        return jobs
+
+    def _gaps(self, jobs, start, total):
+        """(offset, length) ranges from start to total that no job covers."""
+        position = start
+        for offset, length in jobs:
+            if offset > position:
+                yield position, offset - position
+            position = max(position, offset + length)
+        if position < total:
+            yield position, total - position
+
+    def write_image(self, source, device, start=0):
+        """
+        Copy the source image onto the device, beginning at byte `start` to
+        resume an earlier burn. Ranges outside the source's extents are
+        made to read as zeros: discarded where the device guarantees that
+        reads zeros, zeroed otherwise. Progress counts only the data.
+        Returns bytes written.
+        When cancelled, raises BurnCancelled carrying how much of the image
+        is on the device without gaps.
+        """
+        src = open_source(source)
+        dst, direct = blockio.open_device(device, write=True)
+        tail_fd = None
+        try:
+            total = src.size
+            every = self._data_chunks(src, total)
+            # A resume rewrites the chunk it stopped in
+            skipped = [job for job in every if job[0] + job[1] <= start]
+            jobs = every[len(skipped):]
+            before = sum(length for _, length in skipped)
+            data = before + sum(length for _, length in jobs)
+
+            def prepare(job, buf):
+                offset, length = job
+                src.read_into(memoryview(buf)[:length], offset)
+                return job
+
+            if direct and total % blockio.DIRECT_ALIGNMENT:
+                # O_DIRECT cannot write a partial block; the image's
+                # unaligned tail goes through the page cache
+                tail_fd = os.open(device, os.O_WRONLY)
+
+            def work(job, buf):
+                offset, length = job
+                view = memoryview(buf)
+                aligned = blockio.align_down(length, blockio.DIRECT_ALIGNMENT) if direct else length
+                if aligned:
+                    blockio.pwrite_full(dst, view[:aligned], offset)
+                if aligned < length:
+                    # From the buffer: reading a sequential source again would restart it
+                    os.pwrite(tail_fd, view[aligned:length], offset + aligned)
+                return offset, length
+
+            done = 0
+            # Chunks complete out of order; everything before the first
+            # unfinished chunk is the resume point
+            pending = 0
+            finished = set()
+            for offset, length in self._map(iter(jobs), work, self.chunk_size, prepare):
+                done += length
+                finished.add(offset)
+                while pending < len(jobs) and jobs[pending][0] in finished:
+                    finished.discard(jobs[pending][0])
+                    pending += 1
+                self.progress(before + done, data)
+
+            if getattr(src, "extents", None) is not None:
+                # A cancelled burn never got here, so a resume zeroes every gap
+                zeroes = blockio.discard_zeroes(dst)
+                for offset, length in self._gaps(every, 0, total):
+                    if self.cancel is not None and self.cancel.cancelled:
+                        break
+                    if not (blockio.discard(dst, offset, length) and zeroes):
+                        tail_fd = tail_fd or os.open(device, os.O_WRONLY)
+                        self._zero_gap(tail_fd, offset, length)
+            os.fsync(dst)
+            if tail_fd is not None:
+                os.fsync(tail_fd)
+            if self.cancel is not None:
+                self.cancel.check(jobs[pending][0] if pending < len(jobs) else total)
+            return done
+        finally:
+            if src is not source:
+                src.close()
+            os.close(dst)
+            if tail_fd is not None:
+                os.close(tail_fd)
+
+    def _zero_gap(self, fd, offset, length):
+        """Zero a range in chunk-sized steps so a cancel is seen between them."""
+        step = self.chunk_size * self.depth
+        for position in range(offset, offset + length, step):
+            if self.cancel is not None and self.cancel.cancelled:
+                return
+            blockio.zero_range(fd, position, min(step, offset + length - position))
+
+    def write_stream(self, src, device):
+        """
+        Copy a source of unknown size that can only be read once, front to
+        back (a stream.PipeSource), onto the device. Progress is reported
+        with a total of 0 since none is known. Returns bytes written; a
+        cancelled stream cannot be resumed.
+        """
+        dst, direct = blockio.open_device(device, write=True)
+        # The stream's last chunk is rarely block aligned
+        tail_fd = os.open(device, os.O_WRONLY)
+        try:
+            def jobs():
+                offset = 0
+                while not src.finished:
+                    yield offset
+                    offset += self.chunk_size
+
+            def prepare(offset, buf):
+                return offset, src.read_into(memoryview(buf)[:self.chunk_size], offset)
+
+            def work(job, buf):
+                offset, length = job
+                view = memoryview(buf)
+                aligned = blockio.align_down(length, blockio.DIRECT_ALIGNMENT) if direct else length
+                if aligned:
+                    blockio.pwrite_full(dst, view[:aligned], offset)
+                if aligned < length:
+                    os.pwrite(tail_fd, view[aligned:length], offset + aligned)
+                return length
+
+            done = 0
+            for length in self._map(jobs(), work, self.chunk_size, prepare):
+                done += length
+                self.progress(done, 0)
+            os.fsync(dst)
+            os.fsync(tail_fd)
+            if self.cancel is not None:
+                self.cancel.check(0)
+            return done
+        finally:
+            os.close(dst)
+            os.close(tail_fd)
+
+    def verify(self, source, device, length=None):
+        """
+        Compare the device against the source image, only where the source
+        has data. Returns the offset of the first mismatching chunk, or
+        None if everything matches.
+        """
+        src = open_source(source)
+        bmap = getattr(src, "bmap", None)
+        if bmap is not None and bmap.checksum_type and length is None:
+            # The block map's checksums stand in for the image: read only the device
+            if src is not source:
+                src.close()
+            return self.verify_ranges(device, bmap.checked_ranges(), bmap.checksum_type)
+        dev, direct = blockio.open_device(device)
+        try:
+            total = src.size if length is None else length
+            jobs = self._data_chunks(src, total)
+            data = sum(size for _, size in jobs)
+            if not direct:
+                blockio.drop_cache(dev)
+            half = self.chunk_size
+            sequential = getattr(src, "sequential", False)
+
+            def prepare(job, buf):
+                offset, size = job
+                src.read_into(memoryview(buf)[half:half + size], offset)
+                return job
+
+            def work(job, buf):
+                offset, size = job
+                view = memoryview(buf)
+                want = blockio.align_up(size, blockio.DIRECT_ALIGNMENT)
+                got = blockio.pread_full(dev, view[:want], offset)
+                if not sequential:
+                    src.read_into(view[half:half + size], offset)
+                same = got >= size and view[:size] == view[half:half + size]
+                return offset, size, same
+
+            done = 0
+            first_bad = None
+            for offset, size, same in self._map(iter(jobs), work, 2 * half, prepare if sequential else None):
+                if not same and (first_bad is None or offset < first_bad):
+                    first_bad = offset
+                done += size
+                self.progress(done, data)
+            if self.cancel is not None:
+                self.cancel.check(total)
+            return first_bad
+        finally:
+            if src is not source:
+                src.close()
+            os.close(dev)
+
+    def verify_ranges(self, device, ranges, algorithm):
+        """
+        Hash (offset, length, hexdigest) ranges of the device with hashlib's
+        algorithm. Returns the offset of the first range that does not
+        match, or None if all of them do.
+        """
+        ranges = sorted(ranges)
+        index = 0
+        digest = hashlib.new(algorithm)
+        first_bad = None
+
+        def consume(offset, chunk, runs):
+            nonlocal index, digest, first_bad
+            view = memoryview(chunk)
+            end = offset + len(chunk)
+            # A chunk can end inside a range or hold the ends of several
+            while index < len(ranges) and ranges[index][0] < end:
+                start, length, expected = ranges[index]
+                stop = start + length
+                digest.update(view[max(start, offset) - offset:min(stop, end) - offset])
+                if stop > end:
+                    return
+                if digest.hexdigest() != expected and first_bad is None:
+                    first_bad = start
+                index += 1
+                digest = hashlib.new(algorithm)
+
+        self.read_image(device, consume, extents=[(start, length) for start, length, _ in ranges])
+        return first_bad
+
+    def read_image(self, device, consume, length=None, extents=None):
+        """
+        Read the device (or its first length bytes, or only the extents) in
+        large direct reads with several in flight, and hand each chunk to
+        consume(offset, data, runs) in offset order from the calling thread.
+        runs are the (start, end) ranges of data that are not all zeros.
+        Returns the bytes read.
+        """
+        dev, direct = blockio.open_device(device)
+        try:
+            total = blockio.device_size(dev) if length is None else length
+            jobs = list(self._chunks(total)) if extents is None else self._extent_chunks(extents, total)
+            if not direct:
+                blockio.drop_cache(dev)
+
+            def work(job, buf):
+                offset, size = job
+                view = memoryview(buf)
+                got = blockio.pread_full(dev, view[:blockio.align_up(size, blockio.DIRECT_ALIGNMENT)], offset)
+                if got < size:
+                    raise OSError(f"short read at byte {offset + got} of {device}")
+                # The buffer is reused as soon as this returns
+                return offset, view[:size].tobytes(), blockio.data_runs(view[:size])
+
+            done = 0
+            data = sum(size for _, size in jobs)
+            position = 0
+            # Chunks complete out of order; hold the early ones back
+            ready = {}
+            for offset, chunk, runs in self._map(iter(jobs), work, self.chunk_size):
+                ready[offset] = (chunk, runs)
+                while position < len(jobs) and jobs[position][0] in ready:
+                    chunk, runs = ready.pop(jobs[position][0])
+                    consume(jobs[position][0], chunk, runs)
+                    position += 1
+                    done += len(chunk)
+                    self.progress(done, data)
+            if self.cancel is not None:
+                self.cancel.check(done)
+            return done
+        finally:
+            os.close(dev)
+
+    def scan(self, device, write_pattern=False):
+        """
+        Time every chunk of the device. Reads only by default; with
+        write_pattern each chunk is overwritten with an offset-derived
+        pattern and read back (destroying the device contents).
+        Yields (offset, length, seconds, error) in completion order, where
+        error is None, "io" or "mismatch".
+        """
+        dev, direct = blockio.open_device(device, write=write_pattern)
+        try:
+            total = blockio.align_down(blockio.device_size(dev), SECTOR)
+            if not direct:
+                blockio.drop_cache(dev)
+            half = self.chunk_size
+
+            def work(job, buf):
+                offset, size = job
+                view = memoryview(buf)
+                started = time.monotonic()
+                error = None
+                try:
+                    if write_pattern:
+                        pattern = offset.to_bytes(8, "little") * (size // 8)
+                        view[half:half + len(pattern)] = pattern
+                        blockio.pwrite_full(dev, view[half:half + size], offset)
+                        if not direct:
+                            os.fdatasync(dev)
+                            blockio.drop_cache(dev)
+                        got = blockio.pread_full(dev, view[:size], offset)
+                        if got < size or view[:size] != view[half:half + size]:
+                            error = "mismatch"
+                    else:
+                        blockio.pread_full(dev, view[:size], offset)
+                except OSError:
+                    error = "io"
+                return offset, size, time.monotonic() - started, error
+
+            done = 0
+            buffer_size = 2 * half if write_pattern else half
+            for offset, size, seconds, error in self._map(self._chunks(total), work, buffer_size):
+                done += size
+                self.progress(done, total)
+                yield offset, size, seconds, error
+        finally:
+            os.close(dev)
@@ -0,0 +1,77 @@
+import queue
+import time
+from collections import namedtuple
+
+# Worker threads never touch Tk directly. They post these events to an
+# EventBus and the UI drains it on a fixed timer.
+LogEvent = namedtuple("LogEvent", "text success")
+ProgressEvent = namedtuple("ProgressEvent", "device percent")
+BytesEvent = namedtuple("BytesEvent", "device done total time")
+PhaseEvent = namedtuple("PhaseEvent", "device name")
+ResultEvent = namedtuple("ResultEvent", "device ok title message")
+CallEvent = namedtuple("CallEvent", "func args kwargs")
+
+# Most log lines applied per UI frame; older lines in a burst are dropped
+# and replaced by a single "lines skipped" note.
+MAX_LOG_LINES_PER_FRAME = 200
+
+
+class EventBus:
+    """
+    Thread-safe queue between workers and the UI.
+
+    drain() returns one frame's worth of events with progress coalesced:
+    only the latest ProgressEvent, BytesEvent and PhaseEvent per device
+    survive. Everything else keeps its original order. log_sink, if set,
+    is called with the text of every LogEvent before any are dropped, so
+    a log file gets the lines a burst skips on screen.
+    """
+
+    def __init__(self, max_log_lines=MAX_LOG_LINES_PER_FRAME, log_sink=None):
+        self.queue = queue.SimpleQueue()
+        self.max_log_lines = max_log_lines
+        self.log_sink = log_sink
+
+    def post(self, event):
+        self.queue.put(event)
+
+    def log(self, text, success=None):
+        self.post(LogEvent(text, success))
+
+    def bytes(self, device, done, total):
+        """Post a byte counter, stamped now so rates do not depend on UI timing."""
+        self.post(BytesEvent(device, done, total, time.monotonic()))
+
+    def drain(self):
+        events = []
+        while True:
+            try:
+                events.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if self.log_sink is not None:
+            for event in events:
+                if isinstance(event, LogEvent):
+                    self.log_sink(event.text)
+        return self.coalesce(events)
+
+    def coalesce(self, events):
+        latest = {}
+        for i, event in enumerate(events):
+            if isinstance(event, (ProgressEvent, BytesEvent, PhaseEvent)):
+                latest[(type(event), event.device)] = i
+        keep_last = set(latest.values())
+
+        logs = sum(1 for e in events if isinstance(e, LogEvent))
+        skip = max(0, logs - self.max_log_lines)
+        result = []
+        if skip:
+            result.append(LogEvent(f"... {skip} log lines skipped ...", None))
+        for i, event in enumerate(events):
+            if isinstance(event, (ProgressEvent, BytesEvent, PhaseEvent)) and i not in keep_last:
+                continue
+            if isinstance(event, LogEvent) and skip:
+                skip -= 1
+                continue
+            result.append(event)
+        return result
@@ -0,0 +1,348 @@
+"""
+In-memory FAT32 image builder.
+
+Lays out a complete FAT32 filesystem for a file tree: boot sectors,
+FSInfo, both FATs, every directory and the file data, each file in one
+contiguous run of clusters. Only the metadata is held in memory; file
+data is read from the tree as the image is read, so the image streams to
+a partition through the Engine as one sequential write instead of the
+scattered FAT and directory updates a mounted filesystem would make.
+
+The image ends after the last used cluster; the rest of the partition
+is free space and is not written.
+"""
+import bisect
+import os
+import struct
+import time
+
+SECTOR = 512
+FAT_COUNT = 2
+MIN_RESERVED = 32
+BACKUP_BOOT_SECTOR = 6
+# FAT32 needs at least this many clusters, and can address at most the second
+MIN_CLUSTERS = 65525
+MAX_CLUSTERS = 0x0FFFFFF5
+END_OF_CHAIN = 0x0FFFFFFF
+MAX_FILE = 4 * 1024 ** 3 - 1
+# Start the data region on an erase-block boundary of the partition
+DATA_ALIGN = 1024 * 1024
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_VOLUME_ID = 0x08
+ATTR_LONG_NAME = 0x0F
+# NT reserved byte flags: base name / extension stored in lower case
+LOWER_BASE = 0x08
+LOWER_EXT = 0x10
+SHORT_CHARS = set("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!#$%&'()-@^_`{}~")
+LFN_CHARS = 13
+
+
+def cluster_size(volume_size):
+    """Default cluster size for a volume, as Windows formats FAT32."""
+    for limit, size in ((8 * 1024 ** 3, 4096), (16 * 1024 ** 3, 8192), (32 * 1024 ** 3, 16384)):
+        if volume_size <= limit:
+            return size
+    return 32768
+
+
+def fat_date_time(timestamp):
+    t = time.localtime(max(timestamp, 315532800))
+    date = ((max(t.tm_year, 1980) - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    clock = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    return date, clock
+
+
+def short_name(name):
+    """
+    (11-byte 8.3 name, case flags) when name fits 8.3 as it is, else None.
+    Lower-case 8.3 names need no long name entries, just the NT case flags.
+    """
+    base, dot, ext = name.rpartition(".")
+    if not dot:
+        base, ext = name, ""
+    if not base or len(base) > 8 or len(ext) > 3 or (dot and not ext):
+        return None
+    flags = 0
+    for part, lower in ((base, LOWER_BASE), (ext, LOWER_EXT)):
+        if part != part.upper():
+            if part != part.lower():
+                return None
+            flags |= lower
+    if not set((base + ext).upper()) <= SHORT_CHARS:
+        return None
+    return (base.upper().ljust(8) + ext.upper().ljust(3)).encode("ascii"), flags
+
+
+def generated_name(name, taken):
+    """Unique BASIS~N.EXT short name for a name that needs long name entries."""
+    base, dot, ext = name.rpartition(".")
+    if not dot or not base:
+        base, ext = name, ""
+
+    def clean(text):
+        return "".join(c if c in SHORT_CHARS else "_" for c in text.upper().replace(" ", "").replace(".", ""))
+
+    base, ext = clean(base) or "_", clean(ext)[:3]
+    for n in range(1, 1000000):
+        tail = f"~{n}"
+        candidate = (base[:8 - len(tail)] + tail).ljust(8) + ext.ljust(3)
+        if candidate not in taken:
+            taken.add(candidate)
+            return candidate.encode("ascii")
+    raise OSError(f"too many similar names next to {name}")
+
+
+def lfn_checksum(short):
+    total = 0
+    for byte in short:
+        total = (((total & 1) << 7) + (total >> 1) + byte) & 0xFF
+    return total
+
+
+def lfn_entries(name, short):
+    """Long name entries for name, in on-disk order (last part first)."""
+    units = name.encode("utf-16-le")
+    chars = [units[i:i + 2] for i in range(0, len(units), 2)]
+    if len(chars) > 255:
+        raise OSError(f"file name too long for FAT32: {name}")
+    if len(chars) % LFN_CHARS:
+        chars.append(b"\0\0")
+    chars += [b"\xff\xff"] * (-len(chars) % LFN_CHARS)
+    checksum = lfn_checksum(short)
+    parts = [b"".join(chars[i:i + LFN_CHARS]) for i in range(0, len(chars), LFN_CHARS)]
+    entries = []
+    for index, part in enumerate(parts, 1):
+        order = index | (0x40 if index == len(parts) else 0)
+        entries.append(struct.pack("<B10sBBB12sH4s", order, part[:10], ATTR_LONG_NAME, 0, checksum,
+                                   part[10:22], 0, part[22:26]))
+    return entries[::-1]
+
+
+def dir_entry(name11, attr, cluster, size, mtime, flags=0):
+    date, clock = fat_date_time(mtime)
+    return struct.pack("<11sBBBHHHHHHHI", name11, attr, flags, 0, clock, date, date,
+                       cluster >> 16, clock, date, cluster & 0xFFFF, size)
+
+
+class Node:
+    def __init__(self, name, path, is_dir, size, mtime):
+        self.name = name
+        self.path = path
+        self.is_dir = is_dir
+        self.size = size
+        self.mtime = mtime
+        self.parent = None
+        self.children = []
+        self.cluster = 0
+        self.entry_count = 0
+        # 8.3 name, NT case flags and long name entries, set by allocate()
+        self.short = None
+        self.flags = 0
+        self.long = []
+
+
+class Fat32Image:
+    """
+    FAT32 filesystem image of a directory tree, readable with read_into()
+    like an Engine image source.
+
+    volume_size is the partition size in bytes and hidden_sectors its
+    start on the disk in sectors. skip holds relative paths left out of
+    the image, e.g. WIMs that are split onto the mounted volume later.
+    Raises OSError if the tree does not fit or a file is too large.
+    """
+
+    def __init__(self, root, volume_size, label="NO NAME", hidden_sectors=0, skip=()):
+        self.label = label.upper()[:11].ljust(11).encode("ascii", "replace")
+        self.hidden_sectors = hidden_sectors
+        self.total_sectors = volume_size // SECTOR
+        self.plan_geometry(volume_size)
+        self.root = self.scan(root, set(skip))
+        self.allocate()
+        self.build_regions()
+
+    def plan_geometry(self, volume_size):
+        size = cluster_size(volume_size)
+        while True:
+            spc = size // SECTOR
+            fat_sectors = -(-(self.total_sectors - MIN_RESERVED) // ((256 * spc + FAT_COUNT) // 2))
+            reserved = MIN_RESERVED
+            data_start = reserved + FAT_COUNT * fat_sectors
+            reserved += -data_start % (DATA_ALIGN // SECTOR)
+            data_start = reserved + FAT_COUNT * fat_sectors
+            clusters = (self.total_sectors - data_start) // spc
+            if clusters >= MIN_CLUSTERS or spc == 1:
+                break
+            size //= 2
+        if not MIN_CLUSTERS <= clusters <= MAX_CLUSTERS:
+            raise OSError(f"a {volume_size} byte partition cannot hold a FAT32 filesystem")
+        self.cluster_bytes = size
+        self.sectors_per_cluster = spc
+        self.fat_sectors = fat_sectors
+        self.reserved = reserved
+        self.data_start = data_start * SECTOR
+        self.clusters = clusters
+
+    def scan(self, root, skip):
+        top = Node("", root, True, 0, os.stat(root).st_mtime)
+        nodes = {root: top}
+        for directory, dirs, names in os.walk(root):
+            dirs.sort()
+            parent = nodes[directory]
+            for name in dirs:
+                path = os.path.join(directory, name)
+                node = Node(name, path, True, 0, os.stat(path).st_mtime)
+                nodes[path] = node
+                parent.children.append(node)
+            for name in sorted(names):
+                path = os.path.join(directory, name)
+                if os.path.relpath(path, root) in skip:
+                    continue
+                st = os.stat(path)
+                if st.st_size > MAX_FILE:
+                    raise OSError(f"{os.path.relpath(path, root)} is too large for FAT32")
+                parent.children.append(Node(name, path, False, st.st_size, st.st_mtime))
+        return top
+
+    def directories(self):
+        """Directories in walk order, the root first."""
+        pending = [self.root]
+        while pending:
+            node = pending.pop(0)
+            yield node
+            pending[0:0] = [child for child in node.children if child.is_dir]
+
+    def allocate(self):
+        """Name every entry, then give directories and then files their clusters in tree order."""
+        self.next_cluster = 2
+        files = []
+        for node in self.directories():
+            taken = set()
+            for child in node.children:
+                short = short_name(child.name)
+                if short and short[0].decode("ascii") not in taken:
+                    child.short, child.flags = short
+                    taken.add(short[0].decode("ascii"))
+            # Generated names must not clash with names that fit 8.3 as they are
+            count = 1 if node is self.root else 2
+            for child in node.children:
+                child.parent = node
+                if child.short is None:
+                    child.short = generated_name(child.name, taken)
+                    child.long = lfn_entries(child.name, child.short)
+                count += 1 + len(child.long)
+            node.entry_count = count
+            node.cluster = self.take(max(1, count * 32))
+            files.extend(child for child in node.children if not child.is_dir)
+        for node in files:
+            if node.size:
+                node.cluster = self.take(node.size)
+        if self.next_cluster - 2 > self.clusters:
+            raise OSError("the files do not fit on the partition")
+
+    def take(self, num_bytes):
+        count = -(-num_bytes // self.cluster_bytes)
+        first = self.next_cluster
+        self.next_cluster += count
+        return first
+
+    def chain_length(self, node):
+        num_bytes = node.entry_count * 32 if node.is_dir else node.size
+        return -(-num_bytes // self.cluster_bytes)
+
+    def cluster_offset(self, cluster):
+        return self.data_start + (cluster - 2) * self.cluster_bytes
+
+    def build_regions(self):
+        """Byte regions of the image: (offset, length, bytes or file path or None for zeros)."""
+        used = self.next_cluster
+        fat = bytearray(used * 4)
+        struct.pack_into("<II", fat, 0, 0x0FFFFFF8, END_OF_CHAIN)
+        metadata_nodes = list(self.directories())
+        file_nodes = [n for d in metadata_nodes for n in d.children if not n.is_dir and n.size]
+        for node in metadata_nodes + file_nodes:
+            length = self.chain_length(node) or 1
+            for i in range(length - 1):
+                struct.pack_into("<I", fat, (node.cluster + i) * 4, node.cluster + i + 1)
+            struct.pack_into("<I", fat, (node.cluster + length - 1) * 4, END_OF_CHAIN)
+
+        fat_bytes = self.fat_sectors * SECTOR
+        regions = [(0, self.reserved * SECTOR, self.boot_region())]
+        for copy in range(FAT_COUNT):
+            offset = (self.reserved + copy * self.fat_sectors) * SECTOR
+            regions.append((offset, len(fat), bytes(fat)))
+            regions.append((offset + len(fat), fat_bytes - len(fat), None))
+        for node in metadata_nodes:
+            data = self.directory_bytes(node)
+            padded = self.chain_length(node) * self.cluster_bytes
+            regions.append((self.cluster_offset(node.cluster), padded, data.ljust(padded, b"\0")))
+        for node in file_nodes:
+            offset = self.cluster_offset(node.cluster)
+            regions.append((offset, node.size, node.path))
+            slack = self.chain_length(node) * self.cluster_bytes - node.size
+            if slack:
+                regions.append((offset + node.size, slack, None))
+        self.regions = regions
+        self.starts = [region[0] for region in regions]
+        self.size = self.cluster_offset(self.next_cluster)
+
+    def directory_bytes(self, node):
+        entries = []
+        if node is self.root:
+            entries.append(dir_entry(self.label, ATTR_VOLUME_ID, 0, 0, node.mtime))
+        else:
+            entries.append(dir_entry(b".          ", ATTR_DIRECTORY, node.cluster, 0, node.mtime))
+            parent = 0 if node.parent is self.root else node.parent.cluster
+            entries.append(dir_entry(b"..         ", ATTR_DIRECTORY, parent, 0, node.mtime))
+        for child in node.children:
+            entries.extend(child.long)
+            attr = ATTR_DIRECTORY if child.is_dir else ATTR_ARCHIVE
+            entries.append(dir_entry(child.short, attr, child.cluster, 0 if child.is_dir else child.size,
+                                     child.mtime, child.flags))
+        return b"".join(entries)
+
+    def boot_region(self):
+        boot = bytearray(SECTOR)
+        struct.pack_into("<3s8sHBHBHHBHHHIIIHHIHH12sBBBI11s8s", boot, 0,
+                         b"\xeb\x58\x90", b"MSWIN4.1", SECTOR, self.sectors_per_cluster, self.reserved,
+                         FAT_COUNT, 0, 0, 0xF8, 0, 63, 255, self.hidden_sectors, self.total_sectors,
+                         self.fat_sectors, 0, 0, 2, 1, BACKUP_BOOT_SECTOR, bytes(12),
+                         0x80, 0, 0x29, int.from_bytes(os.urandom(4), "little"), self.label, b"FAT32   ")
+        boot[510:512] = b"\x55\xaa"
+        info = bytearray(SECTOR)
+        struct.pack_into("<I", info, 0, 0x41615252)
+        struct.pack_into("<III", info, 484, 0x61417272, self.clusters - (self.next_cluster - 2), self.next_cluster)
+        struct.pack_into("<I", info, 508, 0xAA550000)
+        spare = bytearray(SECTOR)
+        spare[510:512] = b"\x55\xaa"
+        record = bytes(boot + info + spare)
+        region = bytearray(self.reserved * SECTOR)
+        region[0:len(record)] = record
+        region[BACKUP_BOOT_SECTOR * SECTOR:BACKUP_BOOT_SECTOR * SECTOR + len(record)] = record
+        return bytes(region)
+
+    def read_into(self, view, offset):
+        """Fill view with the image bytes at offset; returns the count filled."""
+        view = memoryview(view)
+        length = max(0, min(len(view), self.size - offset))
+        end = offset + length
+        view[:length] = bytes(length) if length else b""
+        index = max(0, bisect.bisect_right(self.starts, offset) - 1)
+        while index < len(self.regions) and self.regions[index][0] < end:
+            start, size, data = self.regions[index]
+            index += 1
+            lo, hi = max(start, offset), min(start + size, end)
+            if lo >= hi or data is None:
+                continue
+            target = view[lo - offset:hi - offset]
+            if isinstance(data, bytes):
+                target[:] = data[lo - start:hi - start]
+            else:
+                with open(data, "rb") as f:
+                    f.seek(lo - start)
+                    f.readinto(target)
+        return length
+
+    def close(self):
+        pass
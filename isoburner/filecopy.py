@@ -0,0 +1,148 @@
+import errno
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from .blockio import fallocate
+from .cancel import BurnCancelled, CancelToken
+
+# Files at least this large are streamed by the large-file workers;
+# everything smaller goes to the small-file pool
+LARGE_FILE = 64 * 1024 * 1024
+# A couple of big sequential streams keep a stick busy; more only seek
+LARGE_STREAMS = 2
+# Small files are dominated by metadata round trips, so several overlap
+SMALL_WORKERS = 4
+COPY_CHUNK = 8 * 1024 * 1024
+# Seconds between progress reports from the calling thread
+REPORT_INTERVAL = 0.2
+
+
+def preallocate(fd, size):
+    """
+    Reserve size bytes for a new file so FAT32/exFAT/NTFS can place it in
+    one run of clusters. Uses fallocate(2) directly: glibc's
+    posix_fallocate would fall back to writing every block, doubling the
+    I/O on filesystems without native support. Returns False where the
+    filesystem cannot preallocate; other errors, such as ENOSPC, raise
+    OSError.
+    """
+    if size <= 0:
+        return False
+    err = fallocate(fd, 0, 0, size)
+    if err == 0:
+        return True
+    if err not in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+        raise OSError(err, os.strerror(err))
+    return False
+
+
+class FileCopier:
+    """
+    Copies files with large and small ones on separate pools.
+
+    Large files (ISOs on a multiboot library) are streamed in chunks by
+    LARGE_STREAMS workers, biggest first, each preallocated first, while a
+    pool of SMALL_WORKERS drains the small files in the order given. The
+    large streams keep the device busy with sequential writes while the
+    small files' metadata round trips overlap with each other.
+
+    progress(done, total) is called from the calling thread; cancel is the
+    burn's CancelToken. Workers poll a private token of their own, so one
+    failed copy stops the others without cancelling the whole burn.
+    """
+
+    def __init__(self, progress=None, cancel=None, large_file=LARGE_FILE,
+                 large_streams=LARGE_STREAMS, small_workers=SMALL_WORKERS, chunk_size=COPY_CHUNK):
+        self.progress = progress or (lambda done, total: None)
+        self.cancel = cancel or CancelToken()
+        self.large_file = large_file
+        self.large_streams = large_streams
+        self.small_workers = small_workers
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.done = 0
+        self.stop = CancelToken()
+
+    def add(self, num_bytes):
+        with self.lock:
+            self.done += num_bytes
+
+    def copy(self, files, handler=None):
+        """
+        Copy files, a list of (source, target, size). handler(source,
+        target, cancel, report), if given, copies each file instead of a
+        plain copy, e.g. to hash it on the way; it may call report(done)
+        with how much of the file it has handled, and the rest counts as
+        done when it returns. Returns bytes copied.
+        """
+        total = sum(size for _, _, size in files)
+        self.done = 0
+        self.stop = CancelToken()
+
+        large = sorted((f for f in files if f[2] >= self.large_file), key=lambda f: f[2], reverse=True)
+        small = [f for f in files if f[2] < self.large_file]
+
+        with self.cancel.watch(self.stop.cancel), \
+                ThreadPoolExecutor(self.large_streams) as large_pool, \
+                ThreadPoolExecutor(self.small_workers) as small_pool:
+            pending = set()
+            for source, target, size in large:
+                pending.add(large_pool.submit(self.copy_one, source, target, size, handler, self.copy_large))
+            for source, target, size in small:
+                pending.add(small_pool.submit(self.copy_one, source, target, size, handler, self.copy_small))
+            try:
+                while pending:
+                    finished, pending = wait(pending, timeout=REPORT_INTERVAL, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        future.result()
+                    self.progress(self.done, total)
+            except (BurnCancelled, OSError):
+                # Drop queued copies; running ones stop at their next chunk
+                self.stop.cancel()
+                for future in pending:
+                    future.cancel()
+                raise
+        self.cancel.check()
+        self.progress(total, total)
+        return total
+
+    def copy_one(self, source, target, size, handler, plain):
+        self.stop.check()
+        if handler is None:
+            plain(source, target)
+            return
+        reported = 0
+
+        def report(done):
+            nonlocal reported
+            done = min(done, size)
+            self.add(done - reported)
+            reported = done
+
+        handler(source, target, self.stop, report)
+        self.add(size - reported)
+
+    def copy_large(self, source, target):
+        with open(source, "rb") as src, open(target, "wb") as dst:
+            preallocate(dst.fileno(), os.fstat(src.fileno()).st_size)
+            try:
+                os.posix_fadvise(src.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except (AttributeError, OSError):
+                pass
+            while True:
+                self.stop.check()
+                chunk = src.read(self.chunk_size)
+                if not chunk:
+                    break
+                dst.write(chunk)
+                self.add(len(chunk))
+
+    def copy_small(self, source, target):
+        with open(source, "rb") as src:
+            data = src.read()
+        with open(target, "wb") as dst:
+            if data:
+                preallocate(dst.fileno(), len(data))
+            dst.write(data)
+        self.add(len(data))
@@ -0,0 +1,106 @@
+import statistics
+import time
+
+from . import storage
+from .devices import device_key, format_size
+from .engine import Engine
+
+HEALTH_FILE = "health.json"
+SCAN_CHUNK = 1024 * 1024
+SCAN_DEPTH = 8
+
+# A chunk is "slow" when it takes this many times the median chunk time,
+# and at least SLOW_MIN_MS, so uniformly slow sticks are not all flagged.
+SLOW_FACTOR = 8
+SLOW_MIN_MS = 100
+
+# Upper bounds (ms) of the latency histogram buckets; the last is open ended
+HISTOGRAM_BOUNDS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+
+def _merge(offsets, chunk):
+    """Collapse sorted chunk offsets into [start, end) byte ranges."""
+    regions = []
+    for offset in sorted(offsets):
+        if regions and regions[-1][1] == offset:
+            regions[-1][1] = offset + chunk
+        else:
+            regions.append([offset, offset + chunk])
+    return regions
+
+
+def histogram(latencies_ms):
+    counts = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+    for ms in latencies_ms:
+        for i, bound in enumerate(HISTOGRAM_BOUNDS_MS):
+            if ms < bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+    labels = [f"<{b}ms" for b in HISTOGRAM_BOUNDS_MS] + [f">={HISTOGRAM_BOUNDS_MS[-1]}ms"]
+    return dict(zip(labels, counts))
+
+
+def run_health_scan(info, destructive=False, progress=None):
+    """
+    Scan the whole device through the burn engine and build a report with
+    bad regions (I/O errors or pattern mismatches), slow regions and a
+    per-chunk latency histogram.
+    """
+    engine = Engine(chunk_size=SCAN_CHUNK, depth=SCAN_DEPTH, progress=progress)
+    samples = []
+    bad = []
+    started = time.monotonic()
+    for offset, size, seconds, error in engine.scan(info["path"], write_pattern=destructive):
+        samples.append((offset, seconds * 1000))
+        if error:
+            bad.append(offset)
+
+    latencies = [ms for _, ms in samples]
+    median = statistics.median(latencies) if latencies else 0
+    threshold = max(median * SLOW_FACTOR, SLOW_MIN_MS)
+    slow = [offset for offset, ms in samples if ms >= threshold and offset not in bad]
+
+    return {
+        "key": device_key(info),
+        "timestamp": int(time.time()),
+        "destructive": destructive,
+        "chunk_size": SCAN_CHUNK,
+        "scanned_bytes": len(samples) * SCAN_CHUNK,
+        "seconds": round(time.monotonic() - started, 1),
+        "median_ms": round(median, 3),
+        "bad_regions": _merge(bad, SCAN_CHUNK),
+        "slow_regions": _merge(slow, SCAN_CHUNK),
+        "histogram": histogram(latencies),
+    }
+
+
+def summarize(report):
+    lines = [f"Scanned {format_size(report['scanned_bytes'])} in {report['seconds']}s "
+             f"(median chunk {report['median_ms']} ms)"]
+    for start, end in report["bad_regions"]:
+        lines.append(f"Bad region: {format_size(start)} - {format_size(end)}")
+    for start, end in report["slow_regions"]:
+        lines.append(f"Slow region: {format_size(start)} - {format_size(end)}")
+    lines.append("Latency: " + ", ".join(f"{k} {v}" for k, v in report["histogram"].items() if v))
+    return lines
+
+
+class HealthStore:
+    """Health scan reports persisted in the config directory, keyed by device_key."""
+
+    def __init__(self, filename=HEALTH_FILE):
+        self.filename = filename
+        self.reports = storage.load_json(filename)
+
+    def get(self, key):
+        return self.reports.get(key)
+
+    def save(self, report):
+        self.reports[report["key"]] = report
+        storage.save_json(self.filename, self.reports)
+
+    def bad_regions(self, key):
+        report = self.get(key)
+        return report["bad_regions"] if report else []
@@ -0,0 +1,375 @@
+"""
+Privileged helper: one root process per session instead of one
+`sudo -S` shell per burn step.
+
+The app starts the helper once through pkexec (or sudo with the password
+written once to its stdin) with one end of a socketpair as the helper's
+stdin and stdout. Requests and replies are JSON objects, one per line:
+
+    -> {"id": 1, "op": "run", "argv": ["eject", "/dev/sdb"]}
+    -> {"id": 2, "op": "probe", "device": "/dev/sdb"}
+    -> {"id": 3, "op": "windows_copy", "iso": "...", "partition": "/dev/sdb1"}
+    -> {"id": 4, "op": "image_write", "iso": "image.img.zst", "device": "/dev/sdb"}
+    -> {"id": 5, "op": "cancel", "target": 1}
+    <- {"id": 4, "records": ["Writing: 12% (123 of 1024 MiB)"]}
+    <- {"id": 1, "returncode": 0}
+
+Requests run concurrently, so one helper serves every device of a
+multi-device burn. Output is split into records in the helper exactly as
+iter_output() does locally, so the caller parses it the same way.
+"""
+import json
+import os
+import queue
+import socket
+import subprocess
+import sys
+import time
+from threading import Thread, Lock
+
+from .cancel import BurnCancelled, CancelToken, stop_process
+from .engine import Engine
+from .stream import DIGEST, PipeSource, format_digest, format_progress as format_stream_progress, is_stream
+from .probe import probe_capacity, describe_result
+from .tooloutput import iter_output
+from .multiboot import format_checksum, layout_stick, sync_library
+from .persistence import add_persistence
+from .windows import copy_iso_tree, verify_iso_tree, format_progress, prepare_stick
+
+# Directory that contains the isoburner package; sudo and pkexec reset PYTHONPATH
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# argv[1] that makes a frozen ISOBurnerApp build act as the helper
+HELPER_FLAG = "--privileged-helper"
+# Seconds to wait for `sudo -v` to accept the password
+AUTH_TIMEOUT = 30
+# Seconds each running request gets to wind down when the app disconnects
+SHUTDOWN_TIMEOUT = 10
+# The only programs a "run" request may start; images go through the block engine
+COMMANDS = ("sync", "eject")
+
+
+def helper_command():
+    """argv that runs the helper with this interpreter or frozen build."""
+    if getattr(sys, "frozen", False):
+        return [sys.executable, HELPER_FLAG]
+    return ["env", f"PYTHONPATH={PACKAGE_ROOT}", sys.executable, "-m", "isoburner.helper"]
+
+
+class HelperJob:
+    """One request in flight. Iterate output() for record lists, then read returncode."""
+
+    def __init__(self, job_id, replies, helper):
+        self.id = job_id
+        self.replies = replies
+        self.helper = helper
+        self.returncode = None
+
+    def cancel(self):
+        """Ask the helper to kill this request's process group."""
+        self.helper.request("cancel", target=self.id)
+
+    def output(self, poll=None, timeout=0.2):
+        while True:
+            try:
+                message = self.replies.get(timeout=timeout)
+            except queue.Empty:
+                if poll:
+                    poll()
+                continue
+            if message is None:
+                # The helper went away mid-request
+                self.returncode = -1
+                return
+            if "records" in message:
+                yield message["records"]
+            if "returncode" in message:
+                self.returncode = message["returncode"]
+                return
+
+
+class PrivilegedHelper:
+    """Client side of the helper: starts it, sends requests, routes replies."""
+
+    def __init__(self):
+        self.process = None
+        self.sock = None
+        self.send_lock = Lock()
+        self.jobs = {}
+        self.next_id = 1
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self, password=None):
+        """
+        Start the helper as root: through sudo when a password is given,
+        otherwise through pkexec, which asks for authorisation itself.
+        Raises PermissionError when authentication fails.
+        """
+        if password is not None:
+            # Check the password first: on a wrong password sudo would
+            # otherwise wait on the socket for another attempt
+            check = subprocess.run(["sudo", "-S", "-p", "", "-v"], input=password + "\n",
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                   text=True, timeout=AUTH_TIMEOUT)
+            if check.returncode != 0:
+                raise PermissionError("sudo rejected the password")
+            launcher = ["sudo", "-S", "-p", ""]
+        else:
+            launcher = ["pkexec"]
+
+        self.sock, child = socket.socketpair()
+        self.process = subprocess.Popen(launcher + helper_command(), stdin=child, stdout=child)
+        child.close()
+        if password is not None:
+            # Read by sudo if it still asks, otherwise skipped by the helper as non-JSON
+            self.sock.sendall((password + "\n").encode())
+
+        self.replies = self.sock.makefile("r", encoding="utf-8")
+        ready = self.replies.readline()
+        if not ready:
+            self.process.wait()
+            self.process = None
+            raise PermissionError("could not start the privileged helper")
+        Thread(target=self.read_replies, daemon=True).start()
+
+    def read_replies(self):
+        for line in self.replies:
+            message = json.loads(line)
+            job = self.jobs.get(message.get("id"))
+            if job is None:
+                continue
+            job.replies.put(message)
+            if "returncode" in message:
+                self.jobs.pop(job.id, None)
+        # EOF: wake anyone still waiting on a reply
+        for job in list(self.jobs.values()):
+            job.replies.put(None)
+        self.jobs.clear()
+
+    def request(self, op, **fields):
+        with self.send_lock:
+            job = HelperJob(self.next_id, queue.SimpleQueue(), self)
+            self.next_id += 1
+            self.jobs[job.id] = job
+            data = json.dumps(dict(fields, id=job.id, op=op)) + "\n"
+            try:
+                self.sock.sendall(data.encode())
+            except OSError:
+                self.jobs.pop(job.id, None)
+                job.replies.put(None)
+        return job
+
+    def run(self, argv):
+        """Run a command from COMMANDS as root; argv is never seen by a shell."""
+        return self.request("run", argv=list(argv))
+
+    def probe(self, device):
+        """Run the counterfeit capacity probe as root."""
+        return self.request("probe", device=device)
+
+    def partition(self, device, uefi, multiboot=False):
+        """Partition a stick for a Windows installer, or for a multiboot library, as root."""
+        return self.request("partition", device=device, uefi=uefi, multiboot=multiboot)
+
+    def persistence(self, iso, device, size=None):
+        """Add a persistence partition behind a live image written to device, as root."""
+        return self.request("persistence", iso=iso, device=device, size=size)
+
+    def library(self, isos, partition, digests, verify):
+        """Copy ISOs onto a multiboot library partition as root."""
+        return self.request("library", isos=isos, partition=partition, digests=digests, verify=verify)
+
+    def image(self, op, iso, device, size=None, digest=None):
+        """
+        Write ("write") or verify ("verify") an image with the block engine
+        as root. A stream is verified against its size and digest.
+        """
+        return self.request(f"image_{op}", iso=iso, device=device, size=size, digest=digest)
+
+    def windows(self, op, iso, partition):
+        """Copy ("copy") or verify ("verify") a Windows ISO's files as root."""
+        return self.request(f"windows_{op}", iso=iso, partition=partition)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                pass
+            self.process = None
+
+
+def handle(request, send, stops):
+    """Run one request; stops maps running request ids to a callable that cancels them."""
+    job_id = request.get("id")
+    op = request.get("op")
+
+    def records(lines):
+        send({"id": job_id, "records": lines})
+
+    try:
+        if op == "cancel":
+            stop = stops.get(request.get("target"))
+            if stop is not None:
+                stop()
+            returncode = 0
+        elif op == "run" and (not isinstance(request.get("argv"), list) or not request["argv"]
+                              or request["argv"][0] not in COMMANDS):
+            records([f"Error: the helper does not run {request.get('argv')!r}"])
+            returncode = 1
+        elif op == "run":
+            # Own session, so cancelling kills the tool and whatever it started
+            process = subprocess.Popen([str(arg) for arg in request["argv"]], stdin=subprocess.DEVNULL,
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                       start_new_session=True)
+            stops[job_id] = lambda: stop_process(process)
+            try:
+                for lines in iter_output(process.stdout):
+                    records(lines)
+                process.stdout.close()
+                returncode = process.wait()
+            finally:
+                stops.pop(job_id, None)
+        elif op in ("windows_copy", "windows_verify"):
+            token = CancelToken()
+            stops[job_id] = token.cancel
+            verb = "Copying" if op == "windows_copy" else "Verifying"
+            try:
+                func = copy_iso_tree if op == "windows_copy" else verify_iso_tree
+                result = func(request["iso"], request["partition"], cancel=token,
+                              progress=lambda done, total: records([format_progress(verb, done, total)]),
+                              log=lambda text: records([text]))
+                returncode = 1 if op == "windows_verify" and result else 0
+            except BurnCancelled:
+                returncode = 1
+            finally:
+                stops.pop(job_id, None)
+        elif op in ("image_write", "image_verify"):
+            token = CancelToken()
+            stops[job_id] = token.cancel
+            verb = "Writing" if op == "image_write" else "Verifying"
+            engine = Engine(progress=lambda done, total: records([format_progress(verb, done, total)]),
+                            cancel=token)
+            try:
+                if op == "image_write" and is_stream(request["iso"]):
+                    started = time.monotonic()
+                    engine.progress = lambda done, total: records(
+                        [format_stream_progress(done, time.monotonic() - started)])
+                    src = PipeSource(request["iso"])
+                    try:
+                        engine.write_stream(src, request["device"])
+                    finally:
+                        src.close()
+                    records([format_digest(src.size, src.digest)])
+                    returncode = 0
+                elif op == "image_write":
+                    engine.write_image(request["iso"], request["device"])
+                    returncode = 0
+                else:
+                    if request.get("digest"):
+                        ranges = [(0, request["size"], request["digest"])]
+                        bad = engine.verify_ranges(request["device"], ranges, DIGEST)
+                    else:
+                        bad = engine.verify(request["iso"], request["device"])
+                    if bad is not None:
+                        records([f"Mismatch at byte {bad}"])
+                    returncode = 0 if bad is None else 1
+            except BurnCancelled:
+                returncode = 1
+            finally:
+                stops.pop(job_id, None)
+        elif op == "partition":
+            if request.get("multiboot"):
+                layout_stick(request["device"], log=lambda text: records([text]))
+            else:
+                prepare_stick(request["device"], request["uefi"], log=lambda text: records([text]))
+            returncode = 0
+        elif op == "persistence":
+            add_persistence(request["iso"], request["device"], request.get("size"),
+                            log=lambda text: records([text]))
+            returncode = 0
+        elif op == "library":
+            token = CancelToken()
+            stops[job_id] = token.cancel
+            try:
+                digests = sync_library(request["isos"], request["partition"], request["digests"], cancel=token,
+                                       progress=lambda done, total: records([format_progress("Copying", done, total)]),
+                                       log=lambda text: records([text]), verify=request["verify"])
+                records([format_checksum(iso, digest) for iso, digest in digests.items()])
+                returncode = 0
+            except BurnCancelled:
+                returncode = 1
+            finally:
+                stops.pop(job_id, None)
+        elif op == "probe":
+            result = probe_capacity(request["device"], progress=lambda text: records([text]))
+            records([describe_result(result)])
+            returncode = 0 if result["ok"] else 1
+        else:
+            records([f"Error: unknown helper request {op!r}"])
+            returncode = 1
+    except (OSError, KeyError) as e:
+        records([f"Error: {e}"])
+        returncode = 1
+    except Exception as e:
+        # The caller waits for a returncode; it must get one whatever happened
+        records([f"Error: unexpected {e!r}"])
+        returncode = 1
+    send({"id": job_id, "returncode": returncode})
+
+
+def serve():
+    # Keep the protocol on private descriptors so nothing else can write
+    # to it; stray prints from libraries end up in /dev/null
+    rfile = os.fdopen(os.dup(0), "r", encoding="utf-8")
+    wfile = os.fdopen(os.dup(1), "w", encoding="utf-8")
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+
+    lock = Lock()
+
+    def send(message):
+        with lock:
+            wfile.write(json.dumps(message) + "\n")
+            wfile.flush()
+
+    stops = {}
+    threads = []
+    send({"ready": True, "pid": os.getpid()})
+    for line in rfile:
+        try:
+            request = json.loads(line)
+        except ValueError:
+            continue
+        # A numeric sudo password is valid JSON too
+        if not isinstance(request, dict):
+            continue
+        thread = Thread(target=handle, args=(request, send, stops), daemon=True)
+        thread.start()
+        threads = [t for t in threads if t.is_alive()] + [thread]
+
+    # The app went away: do not leave tools writing to its devices, and
+    # give in-process copies the chance to unmount before exiting
+    for stop in list(stops.values()):
+        stop()
+    for thread in threads:
+        thread.join(timeout=SHUTDOWN_TIMEOUT)
+    return 0
+
+
+def main():
+    if os.geteuid() != 0:
+        print("isoburner.helper must run as root", file=sys.stderr)
+        return 1
+    return serve()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,318 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from threading import Event, Lock, Thread
+
+from . import storage
+from .burner import BurnError, STAGES
+from .cancel import BurnCancelled, CancelToken
+from .devices import device_key
+from .stream import is_stream
+
+JOBS_FILE = "jobs.sqlite3"
+# JobStore path for a queue that is not kept across sessions
+MEMORY_STORE = ":memory:"
+DEFAULT_WORKERS = 2
+# Extra attempts a failed job gets before it is marked failed
+DEFAULT_RETRIES = 1
+# Seconds before a job whose device is busy is offered to the workers again
+BUSY_RETRY_SECONDS = 1.0
+# A failed verify means the write was bad, so a retry writes again
+RETRY_FROM = {"verify": "write"}
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    iso TEXT NOT NULL,
+    device TEXT NOT NULL,
+    device_key TEXT NOT NULL,
+    options TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL,
+    stage TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stage_times (
+    job_id INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    ok INTEGER NOT NULL
+);
+"""
+
+
+class JobStore:
+    """Burn jobs and their stage timings in SQLite, so a restart picks the queue back up."""
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(storage.config_dir(), JOBS_FILE)
+        self.lock = Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock, self.db:
+            self.db.executescript(_SCHEMA)
+
+    def add(self, iso, device, key, options, priority=0):
+        """Store a job; iso is an image path, or a list of them for a multiboot job."""
+        now = time.time()
+        if not isinstance(iso, str):
+            iso = json.dumps(list(iso))
+        with self.lock, self.db:
+            cursor = self.db.execute(
+                "INSERT INTO jobs (iso, device, device_key, options, priority, state, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (iso, device, key, json.dumps(options), priority, QUEUED, now, now))
+        return cursor.lastrowid
+
+    def get(self, job_id):
+        with self.lock:
+            return self.db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def update(self, job_id, **fields):
+        fields["updated"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self.lock, self.db:
+            self.db.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def unfinished(self):
+        """Jobs that were queued or running when the last session ended, best first."""
+        with self.lock:
+            return self.db.execute("SELECT * FROM jobs WHERE state IN (?, ?) ORDER BY priority DESC, id",
+                                   (QUEUED, RUNNING)).fetchall()
+
+    def record_stage(self, job_id, stage, seconds, ok):
+        with self.lock, self.db:
+            self.db.execute("INSERT INTO stage_times (job_id, stage, seconds, ok) VALUES (?, ?, ?, ?)",
+                            (job_id, stage, seconds, int(ok)))
+
+    def stage_latency(self):
+        """{stage: (count, mean seconds)} over every successful run of each stage."""
+        with self.lock:
+            rows = self.db.execute("SELECT stage, COUNT(*), AVG(seconds) FROM stage_times "
+                                   "WHERE ok = 1 GROUP BY stage").fetchall()
+        return {stage: (count, mean) for stage, count, mean in rows}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class JobRunner:
+    """
+    Runs burn jobs as a pipeline on an asyncio loop in a background thread.
+
+    Each job goes through the Burner's stages one at a time; a pool of
+    `workers` coroutines takes jobs from a priority queue, so several
+    devices are in different stages at once while each device only ever
+    has one job running. Blocking stage work runs in threads. Every state
+    change is written to the JobStore, so jobs left unfinished by a crash
+    or restart continue from the stage they were in.
+
+    submit(), cancel(), set_workers() and stats() are safe from any thread.
+    on_change(job_id, state), if given, is called from the runner thread
+    whenever a job finishes, fails, is cancelled or is retried.
+    """
+
+    def __init__(self, burner, store=None, workers=DEFAULT_WORKERS, retries=DEFAULT_RETRIES, on_change=None):
+        self.burner = burner
+        self.store = store or JobStore()
+        self.workers = workers
+        self.retries = retries
+        self.on_change = on_change or (lambda job_id, state: None)
+        self.loop = None
+        self.queue = None
+        self.tasks = set()
+        self.idle = set()
+        self.running = {}
+        self.busy_devices = set()
+
+    @property
+    def started(self):
+        return self.loop is not None
+
+    def start(self, restore=True):
+        """Start the runner thread; with restore, unfinished jobs from the store are queued again."""
+        ready = Event()
+        Thread(target=self._thread, args=(ready, restore), daemon=True).start()
+        ready.wait()
+
+    def _thread(self, ready, restore):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.queue = asyncio.PriorityQueue()
+        if restore:
+            unfinished = []
+            for row in self.store.unfinished():
+                if is_stream(row["iso"]):
+                    # The stream was consumed by the last session
+                    self.store.update(row["id"], state=FAILED, error="a streamed image cannot be burned again")
+                else:
+                    unfinished.append(row)
+            for row in unfinished:
+                self.store.update(row["id"], state=QUEUED)
+                self.queue.put_nowait((-row["priority"], row["id"]))
+            if unfinished:
+                self.burner.log(f"Resuming {len(unfinished)} unfinished job(s) from the last session.")
+        self._resize(self.workers)
+        ready.set()
+        self.loop.run_forever()
+
+    def submit(self, iso, device, options=None, priority=0):
+        """Queue a burn; higher priority runs first. Returns the job id."""
+        key = device_key(self.burner.device_info(device))
+        job_id = self.store.add(iso, device, key, options or {}, priority)
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (-priority, job_id))
+        return job_id
+
+    def cancel(self, job_id=None):
+        """Cancel one job, or every queued and running job."""
+        rows = [self.store.get(job_id)] if job_id is not None else self.store.unfinished()
+        for row in rows:
+            if row is None:
+                continue
+            if row["id"] in self.running:
+                self.burner.cancel(row["device"])
+            elif row["state"] == QUEUED:
+                self.store.update(row["id"], state=CANCELLED)
+                self.on_change(row["id"], CANCELLED)
+
+    def set_workers(self, count):
+        """Change how many jobs may run at once."""
+        self.loop.call_soon_threadsafe(self._resize, max(1, count))
+
+    def stats(self):
+        """Queue depth, jobs running per stage and mean per-stage latency."""
+        return {
+            "queued": self.queue.qsize() if self.queue else 0,
+            "running": dict(self.running),
+            "workers": self.workers,
+            "latency": self.store.stage_latency(),
+        }
+
+    def _resize(self, count):
+        self.workers = count
+        while len(self.tasks) < count:
+            self.tasks.add(self.loop.create_task(self._worker()))
+        # Idle workers go now; busy ones leave after their current job
+        for task in list(self.idle)[:max(0, len(self.tasks) - count)]:
+            task.cancel()
+
+    async def _worker(self):
+        me = asyncio.current_task()
+        try:
+            while len(self.tasks) <= self.workers:
+                self.idle.add(me)
+                try:
+                    item = await self.queue.get()
+                finally:
+                    self.idle.discard(me)
+                await self._dispatch(item)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.tasks.discard(me)
+
+    async def _dispatch(self, item):
+        row = self.store.get(item[1])
+        if row is None or row["state"] != QUEUED:
+            return
+        if row["device"] in self.busy_devices:
+            # Never two jobs on one device; offer this one again shortly
+            self.loop.call_later(BUSY_RETRY_SECONDS, self.queue.put_nowait, item)
+            return
+        self.busy_devices.add(row["device"])
+        try:
+            await self._run_job(row)
+        finally:
+            self.busy_devices.discard(row["device"])
+
+    async def _run_job(self, row):
+        job_id, device = row["id"], row["device"]
+        burner = self.burner
+        burner.tokens[device] = CancelToken()
+        stage = row["stage"]
+        try:
+            if device_key(burner.device_info(device)) != row["device_key"]:
+                raise BurnError(f"{device} is no longer the stick this job was queued for.")
+            options = json.loads(row["options"])
+            if stage in ("write", "verify"):
+                # Continue an interrupted write where a cancel left it
+                options["resume"] = True
+            iso = row["iso"]
+            if iso.startswith("["):
+                iso = json.loads(iso)
+            job = await asyncio.to_thread(burner.plan, iso, device, options)
+            names = burner.stages(job)
+            start = names.index(stage) if stage in names else 0
+            for stage in names[start:]:
+                self.store.update(job_id, state=RUNNING, stage=stage)
+                self.running[job_id] = stage
+                started = time.monotonic()
+                ok = False
+                try:
+                    await asyncio.to_thread(self._run_stage, job, stage)
+                    ok = True
+                finally:
+                    self.store.record_stage(job_id, stage, time.monotonic() - started, ok)
+        except BurnCancelled:
+            self.store.update(job_id, state=CANCELLED)
+            burner.report_cancelled(device)
+            self.on_change(job_id, CANCELLED)
+        except (BurnError, OSError) as e:
+            self._failed(row, stage, e)
+        except Exception as e:
+            # A bug must not leave the job "running", or a restart would burn it again unasked
+            self._failed(row, stage, BurnError(f"Unexpected error in the {stage or 'detect'} stage: {e!r}"))
+        else:
+            self.store.update(job_id, state=DONE)
+            burner.report_success(job)
+            self.on_change(job_id, DONE)
+        finally:
+            self.running.pop(job_id, None)
+            burner.tokens.pop(device, None)
+
+    def _run_stage(self, job, stage):
+        if stage == "detect":
+            # Preflight checks do not need the USB link to themselves
+            self.burner.run_stage(job, stage)
+            return
+        with self.burner.device_slot(job.device):
+            self.burner.run_stage(job, stage)
+
+    def _failed(self, row, stage, error):
+        attempts = row["attempts"] + 1
+        # A stream has been read already; it cannot be written again
+        if attempts <= self.retries and not is_stream(row["iso"]):
+            stage = RETRY_FROM.get(stage, stage)
+            self.store.update(row["id"], state=QUEUED, stage=stage, attempts=attempts, error=str(error))
+            self.burner.log(f"{row['device']}: {error} Retrying from the {stage} stage "
+                            f"(attempt {attempts + 1} of {self.retries + 1}).")
+            self.queue.put_nowait((-row["priority"], row["id"]))
+            self.on_change(row["id"], QUEUED)
+            return
+        self.store.update(row["id"], state=FAILED, attempts=attempts, error=str(error))
+        if not isinstance(error, BurnError):
+            error = BurnError(str(error))
+        self.burner.report_failure(row["device"], error)
+        self.on_change(row["id"], FAILED)
+
+
+def format_stats(stats):
+    """One-line summary of JobRunner.stats() for the UI."""
+    text = f"Queue: {stats['queued']} waiting, {len(stats['running'])} running, {stats['workers']} worker(s)"
+    latency = stats["latency"]
+    parts = [f"{stage} {latency[stage][1]:.1f}s" for stage in STAGES if stage in latency]
+    if parts:
+        text += "\nMean stage time: " + ", ".join(parts)
+    return text
@@ -0,0 +1,127 @@
+"""
+Optional in-process binding to libwim (wimlib) through ctypes.
+
+Calling the library directly gives byte-level progress through wimlib's
+progress callback and lets a cancel abort the operation from inside
+that callback. When libwim is not installed, available() is False and
+callers fall back to the wimlib-imagex command.
+"""
+import ctypes
+import ctypes.util
+import os
+from threading import Lock
+
+# enum wimlib_progress_msg values we listen for
+PROGRESS_WRITE_STREAMS = 12
+PROGRESS_SPLIT_BEGIN_PART = 19
+PROGRESS_SPLIT_END_PART = 20
+STATUS_CONTINUE = 0
+STATUS_ABORT = 1
+
+PROGRESS_FUNC = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p)
+
+
+class SplitInfo(ctypes.Structure):
+    """union wimlib_progress_info.split"""
+    _fields_ = [
+        ("total_bytes", ctypes.c_uint64),
+        ("completed_bytes", ctypes.c_uint64),
+        ("cur_part_number", ctypes.c_uint32),
+        ("total_parts", ctypes.c_uint32),
+        ("part_name", ctypes.c_char_p),
+    ]
+
+
+class WriteStreamsInfo(ctypes.Structure):
+    """union wimlib_progress_info.write_streams"""
+    _fields_ = [
+        ("total_bytes", ctypes.c_uint64),
+        ("total_streams", ctypes.c_uint64),
+        ("completed_bytes", ctypes.c_uint64),
+        ("completed_streams", ctypes.c_uint64),
+        ("num_threads", ctypes.c_uint32),
+        ("compression_type", ctypes.c_int32),
+        ("total_parts", ctypes.c_uint32),
+        ("completed_parts", ctypes.c_uint32),
+        ("completed_compressed_bytes", ctypes.c_uint64),
+    ]
+
+
+_lib = None
+_load_lock = Lock()
+_load_failed = False
+
+
+def load():
+    """The libwim CDLL with its prototypes set, or None if it is not installed."""
+    global _lib, _load_failed
+    with _load_lock:
+        if _lib is None and not _load_failed:
+            name = ctypes.util.find_library("wim")
+            try:
+                lib = ctypes.CDLL(name) if name else None
+            except OSError:
+                lib = None
+            if lib is None:
+                _load_failed = True
+                return None
+            lib.wimlib_global_init.argtypes = (ctypes.c_int,)
+            lib.wimlib_open_wim_with_progress.argtypes = (
+                ctypes.c_char_p, ctypes.c_int, ctypes.POINTER(ctypes.c_void_p), PROGRESS_FUNC, ctypes.c_void_p)
+            lib.wimlib_split.argtypes = (ctypes.c_void_p, ctypes.c_char_p, ctypes.c_uint64, ctypes.c_int)
+            lib.wimlib_free.argtypes = (ctypes.c_void_p,)
+            lib.wimlib_free.restype = None
+            lib.wimlib_get_error_string.argtypes = (ctypes.c_int,)
+            lib.wimlib_get_error_string.restype = ctypes.c_char_p
+            if lib.wimlib_global_init(0) != 0:
+                _load_failed = True
+                return None
+            _lib = lib
+        return _lib
+
+
+def available():
+    return load() is not None
+
+
+def error_text(lib, code):
+    text = lib.wimlib_get_error_string(code)
+    return text.decode(errors="replace") if text else f"error {code}"
+
+
+def split(source, swm_name, part_size, cancel, report=None):
+    """
+    Split the WIM at source into swm_name, then swm_name with 2, 3, ...
+    before its extension, each at most part_size bytes. report(bytes)
+    is called from wimlib's progress callback; a cancel aborts the split
+    there and raises BurnCancelled. Raises OSError on wimlib errors.
+    """
+    lib = load()
+    report = report or (lambda done: None)
+    # Bytes of the parts finished before the current one
+    base = 0
+
+    def progress(msg, info, context):
+        nonlocal base
+        if cancel.cancelled:
+            return STATUS_ABORT
+        if msg in (PROGRESS_SPLIT_BEGIN_PART, PROGRESS_SPLIT_END_PART):
+            base = SplitInfo.from_address(info).completed_bytes
+            report(base)
+        elif msg == PROGRESS_WRITE_STREAMS:
+            report(base + WriteStreamsInfo.from_address(info).completed_bytes)
+        return STATUS_CONTINUE
+
+    # Keep the callback object alive for as long as wimlib may call it
+    callback = PROGRESS_FUNC(progress)
+    wim = ctypes.c_void_p()
+    code = lib.wimlib_open_wim_with_progress(os.fsencode(source), 0, ctypes.byref(wim), callback, None)
+    if code != 0:
+        raise OSError(f"wimlib could not open {source}: {error_text(lib, code)}")
+    try:
+        code = lib.wimlib_split(wim, os.fsencode(swm_name), part_size, 0)
+    finally:
+        lib.wimlib_free(wim)
+    cancel.check()
+    if code != 0:
+        raise OSError(f"wimlib split failed: {error_text(lib, code)}")
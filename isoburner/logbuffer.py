@@ -0,0 +1,78 @@
+import os
+import re
+import time
+from collections import deque
+
+from . import storage
+
+LOG_CAPACITY = 500
+
+# A number with its unit, so "512 kB" and "1.2 GB" give the same key
+_NUMBER = re.compile(r"\d+(?:[.,]\d+)?(?:\s*(?:[kKMGTP]i?B|B)\b)?")
+
+
+def progress_key(text):
+    """
+    Key identifying repeated progress lines such as dd's
+    '1073741824 bytes (1.1 GB, 1.0 GiB) copied, 12 s, 89 MB/s' or
+    wimlib's 'Extracting file data: 1 GiB of 4 GiB (25%) done'.
+    Lines without a counter return None and are never merged.
+    """
+    if "%" not in text and not ("bytes" in text and "copied" in text):
+        return None
+    return _NUMBER.sub("#", text)
+
+
+class RingLog:
+    """
+    Fixed-size log storage. Appending past capacity drops the oldest line,
+    and a progress line that repeats the previous line's progress_key
+    replaces it instead of adding a row. write() streams lines to a log
+    file on disk; it is fed from EventBus.log_sink so the file keeps
+    every line, including those the screen skips in a burst.
+    """
+
+    def __init__(self, capacity=LOG_CAPACITY, path=None):
+        self.lines = deque(maxlen=capacity)
+        self.capacity = capacity
+        self.last_key = None
+        self.path = path
+        self.file = None
+
+    def open_file(self):
+        if self.path is None:
+            directory = os.path.join(storage.config_dir(), "logs")
+            os.makedirs(directory, exist_ok=True)
+            self.path = os.path.join(directory, time.strftime("isoburner-%Y%m%d-%H%M%S.log"))
+        # Line buffered so the file is readable while a burn is running
+        self.file = open(self.path, "a", buffering=1)
+
+    def write(self, text):
+        """Add a line to the log file."""
+        if self.file is None:
+            try:
+                self.open_file()
+            except OSError:
+                self.path = os.devnull
+                self.file = open(os.devnull, "a")
+        self.file.write(f"{time.strftime('%H:%M:%S')} {text}\n")
+
+    def append(self, text, tag=None):
+        """Store a line. Returns True if it replaced the previous line in place."""
+        key = progress_key(text)
+        replace = key is not None and key == self.last_key and bool(self.lines)
+        if replace:
+            self.lines[-1] = (text, tag)
+        else:
+            self.lines.append((text, tag))
+        self.last_key = key
+        return replace
+
+    def clear(self):
+        self.lines.clear()
+        self.last_key = None
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
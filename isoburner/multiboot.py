@@ -0,0 +1,251 @@
+"""
+Multiboot sticks: many ISOs as plain files on one exFAT data partition.
+
+The stick is laid out once with a small FAT32 boot partition (for a boot
+loader that loop-mounts the ISOs) and an exFAT partition taking the
+rest. After that, adding or updating an image is one file copy: a
+manifest on the stick records each ISO's size and SHA-256, and images
+whose checksum already matches are skipped. Checksums of the host's
+ISOs are cached by path, size and mtime so they are computed only once.
+"""
+import hashlib
+import json
+import os
+import re
+import subprocess
+import tempfile
+from threading import Lock
+
+from . import partition, storage
+from .cancel import CancelToken
+from .devices import partition_path, partition_start
+from .engine import Engine
+from .fat32 import Fat32Image
+from .filecopy import FileCopier, preallocate
+from .windows import mounted
+
+CHECKSUM_FILE = "checksums.json"
+BOOT_LABEL = "ISOBOOT"
+DATA_LABEL = "ISOLIBRARY"
+BOOT_SIZE = 256 * 1024 * 1024
+LIBRARY_DIR = "isos"
+MANIFEST = ".isoburner-manifest.json"
+# Large sequential reads and writes; USB sticks want big requests
+COPY_CHUNK = 16 * 1024 * 1024
+
+_CHECKSUM_RE = re.compile(r"^sha256 ([0-9a-f]{64}) (.+)$")
+
+
+class ChecksumStore:
+    """SHA-256 of ISO files, keyed by path and valid while size and mtime are unchanged."""
+
+    def __init__(self, filename=CHECKSUM_FILE):
+        self.filename = filename
+        self.entries = storage.load_json(filename)
+
+    def get(self, path):
+        entry = self.entries.get(os.path.abspath(path))
+        if not entry:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if (entry["size"], entry["mtime"]) != (stat.st_size, stat.st_mtime):
+            return None
+        return entry["sha256"]
+
+    def put(self, path, digest):
+        stat = os.stat(path)
+        self.entries[os.path.abspath(path)] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": digest}
+        storage.save_json(self.filename, self.entries)
+
+
+def format_checksum(path, digest):
+    """Output record carrying a checksum back from the helper."""
+    return f"sha256 {digest} {path}"
+
+
+def parse_checksum(line):
+    """(path, digest) from a format_checksum() record, or None."""
+    match = _CHECKSUM_RE.match(line)
+    return (match.group(2), match.group(1)) if match else None
+
+
+def label_of(path):
+    # lsblk reads the udev database, so this works without root
+    result = subprocess.run(["lsblk", "-dno", "LABEL", path],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    return result.stdout.strip()
+
+
+def has_layout(device):
+    """True when device already carries a multiboot layout from an earlier run."""
+    return label_of(partition_path(device, 2)) == DATA_LABEL
+
+
+def layout_stick(device, log=None):
+    """
+    Partition device (GPT) into a FAT32 boot partition and an exFAT
+    data partition, and create both filesystems. Raises OSError.
+    """
+    log = log or (lambda text: None)
+    boot, data = partition.disk_layout(device, [BOOT_SIZE, None])
+    parts = [
+        partition.Partition(boot[0], boot[1], partition.EFI_SYSTEM_GUID, partition.MBR_EFI, BOOT_LABEL, True),
+        partition.Partition(data[0], data[1], partition.BASIC_DATA_GUID, partition.MBR_EXFAT, DATA_LABEL, False),
+    ]
+    log(f"Writing the multiboot layout: {boot[1] // 2 ** 20} MiB boot partition, "
+        f"{data[1] // 2 ** 20} MiB exFAT data partition...")
+    partition.write_table(device, parts)
+    partition.settle(device, 1, 2)
+
+    boot_path = partition_path(device, 1)
+    with tempfile.TemporaryDirectory(prefix="isoburner-") as empty:
+        image = Fat32Image(empty, boot[1], BOOT_LABEL, partition_start(boot_path))
+        Engine().write_image(image, boot_path)
+    result = subprocess.run(["mkfs.exfat", "-n", DATA_LABEL, partition_path(device, 2)],
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if result.returncode != 0:
+        raise OSError(f"mkfs.exfat failed: {result.stdout.strip()}")
+
+
+def file_digest(path, cancel, report=None, drop_cache=False):
+    """SHA-256 of a file; with drop_cache it is read back from the device rather than the page cache."""
+    report = report or (lambda done: None)
+    sha = hashlib.sha256()
+    done = 0
+    with open(path, "rb") as f:
+        if drop_cache:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        while True:
+            cancel.check()
+            chunk = f.read(COPY_CHUNK)
+            if not chunk:
+                break
+            sha.update(chunk)
+            done += len(chunk)
+            report(done)
+    return sha.hexdigest()
+
+
+def copy_iso(source, target, digest, cancel, report=None, verify=True):
+    """
+    Copy one ISO onto the library in large sequential writes into a
+    preallocated file, hashing it on the way. The source must match
+    digest when one is known; with verify the copy is read back and
+    hashed too. The file only gets its final name once it checks out.
+    Returns the source's SHA-256.
+    """
+    report = report or (lambda done: None)
+    size = os.path.getsize(source)
+    partial = target + ".part"
+    sha = hashlib.sha256()
+    done = 0
+    with open(source, "rb") as src, open(partial, "wb") as dst:
+        preallocate(dst.fileno(), size)
+        try:
+            os.posix_fadvise(src.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except (AttributeError, OSError):
+            pass
+        while True:
+            cancel.check()
+            chunk = src.read(COPY_CHUNK)
+            if not chunk:
+                break
+            sha.update(chunk)
+            dst.write(chunk)
+            done += len(chunk)
+            report(done)
+        dst.flush()
+        os.fsync(dst.fileno())
+    actual = sha.hexdigest()
+    name = os.path.basename(source)
+    if digest and actual != digest:
+        os.unlink(partial)
+        raise OSError(f"{name} does not match its cached checksum; it could not be read correctly")
+    if verify and file_digest(partial, cancel, drop_cache=True) != actual:
+        os.unlink(partial)
+        raise OSError(f"the copy of {name} on the stick does not match the original")
+    os.replace(partial, target)
+    return actual
+
+
+def duplicate_names(isos):
+    """
+    Library names that more than one of isos would get. exFAT ignores
+    case, so names that differ only in case collide too.
+    """
+    paths = {}
+    for iso in isos:
+        paths.setdefault(os.path.basename(iso).lower(), set()).add(os.path.realpath(iso))
+    return sorted(name for name, found in paths.items() if len(found) > 1)
+
+
+def sync_library(isos, data_partition, digests=None, progress=None, log=None, cancel=None, verify=True):
+    """
+    Bring the library on data_partition up to date with isos. Images
+    whose size and checksum match the stick's manifest are skipped; the
+    rest are copied by a FileCopier, two large streams at a time. digests
+    maps paths to known checksums; returns the checksum of every
+    ISO, including the ones computed here, for the caller to cache.
+    """
+    clashes = duplicate_names(isos)
+    if clashes:
+        raise OSError(f"more than one ISO is named {', '.join(clashes)}; rename them apart first")
+    # The same file chosen twice is copied once
+    isos = list(dict.fromkeys(isos))
+    digests = dict(digests or {})
+    progress = progress or (lambda done, total: None)
+    log = log or (lambda text: None)
+    cancel = cancel or CancelToken()
+    sizes = {iso: os.path.getsize(iso) for iso in isos}
+    total = sum(sizes.values())
+    done = 0
+    with mounted(data_partition, "rw") as root:
+        library = os.path.join(root, LIBRARY_DIR)
+        os.makedirs(library, exist_ok=True)
+        manifest_path = os.path.join(library, MANIFEST)
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+
+        copies = []
+        for iso in isos:
+            name = os.path.basename(iso)
+            target = os.path.join(library, name)
+            entry = manifest.get(name)
+            on_stick = os.path.exists(target) and os.path.getsize(target) == sizes[iso]
+            if entry and on_stick and entry["size"] == sizes[iso]:
+                if not digests.get(iso):
+                    log(f"Checking {name} against the copy on the stick...")
+                    digests[iso] = file_digest(iso, cancel)
+                if digests[iso] == entry["sha256"]:
+                    log(f"{name} is up to date.")
+                    done += sizes[iso]
+                    progress(done, total)
+                    continue
+            copies.append((iso, target, sizes[iso]))
+
+        # Copies finish in any order; each one updates the manifest when it checks out
+        lock = Lock()
+
+        def copy(source, target, stop, report):
+            name = os.path.basename(source)
+            log(f"Copying {name}...")
+            digest = copy_iso(source, target, digests.get(source), stop, report, verify)
+            with lock:
+                digests[source] = digest
+                manifest[name] = {"size": sizes[source], "sha256": digest}
+                with open(manifest_path, "w") as f:
+                    json.dump(manifest, f, indent=2, sort_keys=True)
+
+        if copies:
+            base = done
+            copier = FileCopier(lambda copied, _: progress(base + copied, total), cancel, chunk_size=COPY_CHUNK)
+            copier.copy(copies, copy)
+        log("Flushing files to the USB drive...")
+        os.sync()
+    return digests
@@ -0,0 +1,341 @@
+"""
+In-process GPT and MBR partition table writer.
+
+Builds a protective MBR, the primary and backup GPT headers and entry
+arrays (with their CRC32s), or a plain MBR, and writes them with a few
+pwrites instead of running wipefs and parted. Partitions are aligned to
+the stick's erase block as far as sysfs tells us about it.
+"""
+import ctypes
+import errno
+import fcntl
+import math
+import os
+import struct
+import subprocess
+import time
+import uuid
+import zlib
+from collections import namedtuple
+
+from .devices import get_device_info, partition_path
+
+# Never align to less than this; it is what parted and Windows use
+MIN_ALIGN = 1024 * 1024
+# Queue limits above this are not erase blocks, just odd firmware values
+MAX_ALIGN = 64 * 1024 * 1024
+GPT_ENTRIES = 128
+GPT_ENTRY_SIZE = 128
+GPT_HEADER_SIZE = 92
+GPT_REVISION = 0x00010000
+BASIC_DATA_GUID = uuid.UUID("EBD0A0A2-B9E5-4433-87C0-68B6B72699C7")
+EFI_SYSTEM_GUID = uuid.UUID("C12A7328-F81F-11D2-BA4B-00A0C93EC93B")
+LINUX_DATA_GUID = uuid.UUID("0FC63DAF-8483-4772-8E79-3D69D8477DE4")
+MBR_PROTECTIVE = 0xEE
+MBR_FAT32_LBA = 0x0C
+MBR_EXFAT = 0x07
+MBR_EFI = 0xEF
+MBR_LINUX = 0x83
+# Re-read the partition table (linux/fs.h)
+BLKRRPART = 0x125F
+# Add one partition to the kernel's view of a disk (linux/blkpg.h)
+BLKPG = 0x1269
+BLKPG_ADD_PARTITION = 1
+# Attempts at BLKRRPART while udev or an automounter holds the device
+REREAD_ATTEMPTS = 10
+# Seconds to wait for udev to create the new partition nodes
+SETTLE_TIMEOUT = 10.0
+
+Partition = namedtuple("Partition", "start size type_guid mbr_type name bootable")
+
+
+def alignment(info):
+    """Partition alignment in bytes from the stick's optimal_io_size and discard_granularity."""
+    align = MIN_ALIGN
+    for value in (info.get("optimal_io_size"), info.get("discard_granularity")):
+        if value and value <= MAX_ALIGN:
+            align = math.lcm(align, value)
+    return align if align <= MAX_ALIGN else MIN_ALIGN
+
+
+def align_up(value, align):
+    return -(-value // align) * align
+
+
+def plan_partitions(disk_size, sizes, align, sector_size=512, gpt=True, first=0):
+    """
+    Aligned (start, size) byte ranges for partitions of the given sizes,
+    starting after byte first; a size of None takes the rest of the disk.
+    The room GPT needs for its backup at the end of the disk is left free.
+    """
+    end = disk_size - (gpt_reserved(sector_size) if gpt else 0)
+    ranges = []
+    start = max(align, align_up(first, align))
+    for size in sizes:
+        if size is None:
+            stop = end // align * align
+        else:
+            stop = start + align_up(size, align)
+        if stop > end or stop <= start:
+            raise OSError(f"a {disk_size} byte disk has no room for the requested partitions")
+        ranges.append((start, stop - start))
+        start = stop
+    return ranges
+
+
+def gpt_reserved(sector_size):
+    """Bytes taken by one GPT header and entry array."""
+    return sector_size + align_up(GPT_ENTRIES * GPT_ENTRY_SIZE, sector_size)
+
+
+def mbr_entry(status, kind, first_lba, num_lbas):
+    # CHS fields are unused on disks this size; FE FF FF means "see LBA"
+    chs = b"\xfe\xff\xff"
+    return struct.pack("<B3sB3sII", status, chs, kind, chs, first_lba, min(num_lbas, 0xFFFFFFFF))
+
+
+def mbr_sector(entries, sector_size, signature=None):
+    """MBR with up to four entries, no boot code."""
+    sector = bytearray(sector_size)
+    struct.pack_into("<I", sector, 440, signature if signature is not None else int.from_bytes(os.urandom(4), "little"))
+    for index, entry in enumerate(entries):
+        sector[446 + 16 * index:462 + 16 * index] = entry
+    sector[510:512] = b"\x55\xaa"
+    return bytes(sector)
+
+
+def gpt_entries(partitions, sector_size):
+    table = bytearray(GPT_ENTRIES * GPT_ENTRY_SIZE)
+    for index, part in enumerate(partitions):
+        first = part.start // sector_size
+        last = (part.start + part.size) // sector_size - 1
+        name = part.name.encode("utf-16-le")[:72].ljust(72, b"\0")
+        struct.pack_into("<16s16sQQQ72s", table, index * GPT_ENTRY_SIZE,
+                         part.type_guid.bytes_le, uuid.uuid4().bytes_le, first, last, 0, name)
+    return bytes(table)
+
+
+GPT_HEADER_FORMAT = "<8sIIIIQQQQ16sQIII"
+
+
+def gpt_header(current, backup, first_usable, last_usable, disk_guid, entries_lba, entries_crc, sector_size,
+               entry_count=GPT_ENTRIES, entry_size=GPT_ENTRY_SIZE):
+    fields = [b"EFI PART", GPT_REVISION, GPT_HEADER_SIZE, 0, 0, current, backup,
+              first_usable, last_usable, disk_guid.bytes_le, entries_lba, entry_count,
+              entry_size, entries_crc]
+    fmt = GPT_HEADER_FORMAT
+    header = struct.pack(fmt, *fields)
+    fields[3] = zlib.crc32(header)
+    return struct.pack(fmt, *fields).ljust(sector_size, b"\0")
+
+
+def gpt_table(disk_size, partitions, sector_size=512, disk_guid=None):
+    """(offset, bytes) writes for a protective MBR, primary GPT and backup GPT."""
+    disk_guid = disk_guid or uuid.uuid4()
+    last_lba = disk_size // sector_size - 1
+    entry_sectors = align_up(GPT_ENTRIES * GPT_ENTRY_SIZE, sector_size) // sector_size
+    first_usable = 2 + entry_sectors
+    last_usable = last_lba - 1 - entry_sectors
+    entries = gpt_entries(partitions, sector_size)
+    crc = zlib.crc32(entries)
+    backup_entries_lba = last_lba - entry_sectors
+
+    mbr = mbr_sector([mbr_entry(0, MBR_PROTECTIVE, 1, last_lba)], sector_size, signature=0)
+    primary = gpt_header(1, last_lba, first_usable, last_usable, disk_guid, 2, crc, sector_size)
+    backup = gpt_header(last_lba, 1, first_usable, last_usable, disk_guid, backup_entries_lba, crc, sector_size)
+    return [
+        (0, mbr + primary + entries),
+        (backup_entries_lba * sector_size, entries + backup),
+    ]
+
+
+def mbr_table(partitions, sector_size=512):
+    """(offset, bytes) writes for a plain MBR; only the first partition is marked bootable."""
+    entries = [mbr_entry(0x80 if part.bootable else 0, part.mbr_type,
+                         part.start // sector_size, part.size // sector_size)
+               for part in partitions]
+    return [(0, mbr_sector(entries, sector_size))]
+
+
+def clear_regions(disk_size, partitions):
+    """
+    Zeroed (offset, bytes) writes over the gap before the first partition,
+    the start of every partition and the end of the disk, so blkid finds
+    no stale ISO9660, filesystem or GPT signatures. This is what wipefs
+    was there for.
+    """
+    writes = [(0, bytes(partitions[0].start))]
+    for part in partitions:
+        writes.append((part.start, bytes(min(part.size, MIN_ALIGN))))
+    tail = min(MIN_ALIGN, disk_size)
+    writes.append((disk_size - tail, bytes(tail)))
+    return writes
+
+
+def write_table(device, partitions, gpt=True):
+    """
+    Wipe old signatures, write a GPT (with protective MBR) or MBR holding
+    partitions, and make the kernel re-read it.
+    """
+    info = get_device_info(device) if device.startswith("/dev/") else {}
+    sector_size = info.get("logical_block_size") or 512
+    fd = os.open(device, os.O_RDWR)
+    try:
+        disk_size = os.lseek(fd, 0, os.SEEK_END)
+        table = gpt_table(disk_size, partitions, sector_size) if gpt else mbr_table(partitions, sector_size)
+        for offset, data in clear_regions(disk_size, partitions) + table:
+            os.pwrite(fd, data, offset)
+        os.fsync(fd)
+        if device.startswith("/dev/"):
+            reread_partitions(fd)
+    finally:
+        os.close(fd)
+
+
+def add_partition(device, used, size, type_guid, mbr_type, name):
+    """
+    Add a partition after the first used bytes of a disk that already
+    has a partition table, such as a freshly written hybrid ISO, without
+    touching the existing partitions. size None takes the rest of the
+    disk. A GPT is extended to the end of the disk first, as `sgdisk -e`
+    would. Returns the new partition's number; raises OSError.
+    """
+    info = get_device_info(device) if device.startswith("/dev/") else {}
+    sector_size = info.get("logical_block_size") or 512
+    fd = os.open(device, os.O_RDWR)
+    try:
+        disk_size = os.lseek(fd, 0, os.SEEK_END)
+        head = os.pread(fd, 2 * sector_size, 0)
+        if head[510:512] != b"\x55\xaa":
+            raise OSError("the image has no partition table to add a partition to")
+        if head[sector_size:sector_size + 8] == b"EFI PART":
+            number, start, length, writes = gpt_append(fd, head, disk_size, used, size, type_guid, name,
+                                                       alignment(info), sector_size)
+        else:
+            number, start, length, writes = mbr_append(head, disk_size, used, size, mbr_type,
+                                                       alignment(info), sector_size)
+        # Old signatures at the new partition's start would confuse blkid
+        writes.insert(0, (start, bytes(min(length, MIN_ALIGN))))
+        for offset, data in writes:
+            os.pwrite(fd, data, offset)
+        os.fsync(fd)
+        if device.startswith("/dev/"):
+            announce_partition(fd, number, start, length)
+        return number
+    finally:
+        os.close(fd)
+
+
+def gpt_append(fd, head, disk_size, used, size, type_guid, name, align, sector_size):
+    """Number, range and (offset, bytes) writes that add a partition to a GPT."""
+    fields = struct.unpack_from(GPT_HEADER_FORMAT, head, sector_size)
+    first_usable, disk_guid = fields[7], uuid.UUID(bytes_le=fields[9])
+    entries_lba, count, entry_size = fields[10], fields[11], fields[12]
+    entries = bytearray(os.pread(fd, count * entry_size, entries_lba * sector_size))
+    free = None
+    for index in range(count):
+        entry = entries[index * entry_size:index * entry_size + GPT_ENTRY_SIZE]
+        if entry[:16] == bytes(16):
+            free = index if free is None else free
+        else:
+            last = struct.unpack_from("<Q", entry, 40)[0]
+            used = max(used, (last + 1) * sector_size)
+    if free is None:
+        raise OSError("the partition table has no free entry")
+    (start, length), = plan_partitions(disk_size, [size], align, sector_size, True, used)
+    name = name.encode("utf-16-le")[:72].ljust(72, b"\0")
+    struct.pack_into("<16s16sQQQ72s", entries, free * entry_size, type_guid.bytes_le, uuid.uuid4().bytes_le,
+                     start // sector_size, (start + length) // sector_size - 1, 0, name)
+
+    last_lba = disk_size // sector_size - 1
+    entry_sectors = align_up(count * entry_size, sector_size) // sector_size
+    backup_entries_lba = last_lba - entry_sectors
+    crc = zlib.crc32(entries)
+    primary = gpt_header(1, last_lba, first_usable, backup_entries_lba - 1, disk_guid, entries_lba, crc,
+                         sector_size, count, entry_size)
+    backup = gpt_header(last_lba, 1, first_usable, backup_entries_lba - 1, disk_guid, backup_entries_lba, crc,
+                        sector_size, count, entry_size)
+    writes = [(sector_size, primary), (entries_lba * sector_size, bytes(entries)),
+              (backup_entries_lba * sector_size, bytes(entries) + backup)]
+    # A purely protective MBR has to cover the disk's new size as well
+    kinds = [head[446 + 16 * index + 4] for index in range(4)]
+    if kinds == [MBR_PROTECTIVE, 0, 0, 0]:
+        writes.append((446, mbr_entry(0, MBR_PROTECTIVE, 1, last_lba)))
+    return free + 1, start, length, writes
+
+
+def mbr_append(head, disk_size, used, size, mbr_type, align, sector_size):
+    """Number, range and (offset, bytes) writes that add a partition to an MBR."""
+    free = None
+    for index in range(4):
+        first, num = struct.unpack_from("<II", head, 446 + 16 * index + 8)
+        # isohybrid images put a bootable type 0x00 entry over the ISO, so
+        # a slot is only free when its type and its range are all empty
+        if head[446 + 16 * index + 4] == 0 and first == 0 and num == 0:
+            free = index if free is None else free
+        else:
+            used = max(used, (first + num) * sector_size)
+    if free is None:
+        raise OSError("all four MBR partition slots are in use")
+    # MBR entries cannot address past 2 TiB
+    disk_size = min(disk_size, 0xFFFFFFFF * sector_size)
+    (start, length), = plan_partitions(disk_size, [size], align, sector_size, False, used)
+    entry = mbr_entry(0, mbr_type, start // sector_size, length // sector_size)
+    return free + 1, start, length, [(446 + 16 * free, entry)]
+
+
+def announce_partition(fd, number, start, length):
+    """
+    Tell the kernel about a partition added to a disk. A re-read of the
+    whole table fails while a partition of the image is mounted, which
+    desktops do right after a burn, so only the new one is added then.
+    """
+    try:
+        fcntl.ioctl(fd, BLKRRPART)
+        return
+    except OSError:
+        pass
+    # struct blkpg_partition, padded to its 8-byte alignment
+    data = struct.pack("qqi64s64s4x", start, length, number, b"", b"")
+    part = ctypes.create_string_buffer(data, len(data))
+    request = struct.pack("iiiP", BLKPG_ADD_PARTITION, 0, len(data), ctypes.addressof(part))
+    try:
+        fcntl.ioctl(fd, BLKPG, request)
+    except OSError as e:
+        # EBUSY: udev already re-read the table and the partition exists
+        if e.errno != errno.EBUSY:
+            raise OSError(f"the kernel did not pick up the new partition: {e.strerror}")
+
+
+def reread_partitions(fd):
+    for attempt in range(REREAD_ATTEMPTS):
+        try:
+            fcntl.ioctl(fd, BLKRRPART)
+            return
+        except OSError as e:
+            # EBUSY while something still has an old partition open
+            if attempt == REREAD_ATTEMPTS - 1:
+                raise OSError(f"the kernel did not re-read the partition table: {e.strerror}")
+            time.sleep(0.5)
+
+
+def disk_layout(device, sizes, gpt=True):
+    """Aligned (start, size) ranges for partitions of sizes on device; see plan_partitions()."""
+    info = get_device_info(device) if device.startswith("/dev/") else {}
+    with open(device, "rb") as f:
+        disk_size = f.seek(0, os.SEEK_END)
+    return plan_partitions(disk_size, sizes, alignment(info), info.get("logical_block_size") or 512, gpt)
+
+
+def settle(device, *numbers):
+    """Wait until udev has created the nodes of device's partitions with the given numbers."""
+    try:
+        subprocess.run(["udevadm", "settle"], stderr=subprocess.DEVNULL)
+    except FileNotFoundError:
+        pass
+    deadline = time.monotonic() + SETTLE_TIMEOUT
+    paths = [partition_path(device, number) for number in numbers]
+    while not all(os.path.exists(path) for path in paths):
+        if time.monotonic() > deadline:
+            raise OSError(f"{paths[-1]} did not appear after partitioning")
+        time.sleep(0.2)
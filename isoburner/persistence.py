@@ -0,0 +1,123 @@
+"""
+Persistence partitions for live Linux images.
+
+After a hybrid ISO has been written, the free space behind it becomes an
+ext4 partition that the live system stores its changes on: labelled
+writable for Ubuntu's casper (casper-rw before 19.10), or persistence
+(with a persistence.conf) for Debian's live-boot. The image's boot menu
+is read-only, so the kernel parameter that turns persistence on has to
+be added at the boot prompt; add_persistence() logs which. mkfs leaves the inode tables and journal to be
+initialised lazily and discards the partition instead of zero-filling
+it, so even a large partition is ready in seconds.
+"""
+import os
+import re
+import struct
+import subprocess
+import tempfile
+
+from . import partition
+from .devices import partition_path
+
+ISO_SECTOR = 2048
+# Primary volume descriptor of an ISO9660 image
+PVD_OFFSET = 16 * ISO_SECTOR
+# Top-level directory of the live system -> (partition label, persistence.conf contents, kernel parameter)
+FLAVORS = {
+    "CASPER": ("casper-rw", None, "persistent"),
+    "LIVE": ("persistence", "/ union\n", "persistence"),
+}
+# casper looks for this label instead of casper-rw from Ubuntu 19.10 on
+CASPER_LABEL = "writable"
+CASPER_LABEL_SINCE = (19, 10)
+MKFS_OPTIONS = "lazy_itable_init=1,lazy_journal_init=1,discard"
+# Less than this is not worth booting with persistence
+MIN_SIZE = 64 * 1024 * 1024
+
+
+def root_names(iso):
+    """Upper-case names in the root directory of an ISO9660 image; empty if it is not one."""
+    with open(iso, "rb") as f:
+        f.seek(PVD_OFFSET)
+        pvd = f.read(ISO_SECTOR)
+        if pvd[1:6] != b"CD001":
+            return set()
+        extent, length = struct.unpack_from("<I4xI", pvd, 156 + 2)
+        f.seek(extent * ISO_SECTOR)
+        directory = f.read(min(length, 1024 * 1024))
+    names = set()
+    offset = 0
+    while offset < len(directory):
+        size = directory[offset]
+        if size == 0:
+            # Records never span sectors; the rest of this one is padding
+            offset = (offset // ISO_SECTOR + 1) * ISO_SECTOR
+            continue
+        name_length = directory[offset + 32]
+        name = directory[offset + 33:offset + 33 + name_length].decode("ascii", "replace")
+        names.add(name.split(";")[0].rstrip(".").upper())
+        offset += size
+    return names
+
+
+def volume_id(iso):
+    """The volume identifier of an ISO9660 image, e.g. "Ubuntu 22.04.3 LTS amd64"."""
+    with open(iso, "rb") as f:
+        f.seek(PVD_OFFSET + 40)
+        return f.read(32).decode("ascii", "replace").strip()
+
+
+def live_flavor(iso):
+    """
+    (label, persistence.conf contents or None, kernel parameter) for a
+    live image that supports persistence, else None.
+    """
+    try:
+        names = root_names(iso)
+        volume = volume_id(iso)
+    except OSError:
+        return None
+    for directory, flavor in FLAVORS.items():
+        if directory in names:
+            if directory == "CASPER":
+                # Images without a version in their name are taken to be recent
+                match = re.search(r"\b(\d+)\.(\d+)", volume)
+                if match is None or (int(match.group(1)), int(match.group(2))) >= CASPER_LABEL_SINCE:
+                    flavor = (CASPER_LABEL,) + flavor[1:]
+            return flavor
+    return None
+
+
+def add_persistence(iso, device, size=None, log=None):
+    """
+    Add a persistence partition of size bytes (None for the rest of the
+    stick) behind the live image written to device and create its ext4
+    filesystem. Raises OSError.
+    """
+    log = log or (lambda text: None)
+    flavor = live_flavor(iso)
+    if flavor is None:
+        raise OSError(f"{os.path.basename(iso)} is not a live image with persistence support")
+    label, conf, parameter = flavor
+    used = os.path.getsize(iso)
+    with open(device, "rb") as f:
+        free = f.seek(0, os.SEEK_END) - used
+    if (size if size is not None else free) < MIN_SIZE or (size or 0) > free:
+        raise OSError(f"{free // 2 ** 20} MiB is free behind the image; "
+                      f"a persistence partition needs at least {MIN_SIZE // 2 ** 20} MiB")
+    number = partition.add_partition(device, used, size, partition.LINUX_DATA_GUID, partition.MBR_LINUX, label)
+    partition.settle(device, number)
+    path = partition_path(device, number)
+    log(f"Creating the ext4 persistence partition {path} labelled {label}...")
+    with tempfile.TemporaryDirectory(prefix="isoburner-") as root:
+        cmd = ["mkfs.ext4", "-F", "-q", "-L", label, "-E", MKFS_OPTIONS]
+        if conf:
+            with open(os.path.join(root, "persistence.conf"), "w") as f:
+                f.write(conf)
+            # Populate at mkfs time instead of mounting the new filesystem
+            cmd += ["-d", root]
+        result = subprocess.run(cmd + [path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if result.returncode != 0:
+        raise OSError(f"mkfs.ext4 failed: {result.stdout.strip()}")
+    log(f"To use it, add '{parameter}' to the kernel command line at boot: press e on the GRUB "
+        "menu entry and append it to the linux line (Tab opens the line in an isolinux menu).")
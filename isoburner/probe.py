@@ -0,0 +1,131 @@
+import hashlib
+import os
+
+from . import blockio
+from .devices import format_size
+
+PROBE_MAGIC = b"ISOBURNER-PROBE\0"
+PROBE_BLOCK = 4096
+PROBE_SAMPLES = 64
+# Skip the first MiB; partition tables live there and every stick handles it
+PROBE_START = 1024 * 1024
+
+
+def sample_offsets(size, samples=PROBE_SAMPLES, block=PROBE_BLOCK):
+    """
+    Block-aligned offsets spaced logarithmically from PROBE_START to the last
+    block of the device. Counterfeit sticks usually wrap or drop writes past
+    some power-of-two boundary, so dense coverage of every order of magnitude
+    finds the real capacity without touching the whole surface.
+    """
+    last = blockio.align_down(size - block, block)
+    if last <= PROBE_START:
+        return [0] if size >= block else []
+    offsets = set()
+    ratio = (last / PROBE_START) ** (1.0 / max(1, samples - 1))
+    value = float(PROBE_START)
+    for _ in range(samples):
+        offsets.add(blockio.align_down(int(value), block))
+        value *= ratio
+    offsets.add(last)
+    return sorted(o for o in offsets if o <= last)
+
+
+def signed_block(nonce, offset, block=PROBE_BLOCK):
+    """Pattern unique to this probe run and offset, so aliased writes are caught."""
+    header = PROBE_MAGIC + nonce + offset.to_bytes(8, "little")
+    digest = hashlib.blake2b(offset.to_bytes(8, "little"), key=nonce, digest_size=64).digest()
+    body = (digest * (block // len(digest) + 1))[:block - len(header)]
+    return header + body
+
+
+def probe_capacity(path, progress=None, samples=PROBE_SAMPLES):
+    """
+    Write signed blocks at sample offsets, read them all back and check each
+    still holds its own signature. An offset that cannot be read or written
+    fails like one that lost its data, since fake sticks often answer EIO
+    past their real capacity. The original contents of every sampled block
+    are restored afterwards.
+
+    Returns a dict with ok, the reported size, the largest verified offset
+    (a lower bound on real capacity) and the list of offsets that failed.
+    Raises OSError only when the device cannot be opened.
+    """
+    log = progress or (lambda msg: None)
+    nonce = os.urandom(16)
+    fd, direct = blockio.open_device(path, write=True)
+    try:
+        size = blockio.device_size(fd)
+        offsets = sample_offsets(size, samples)
+        buf = blockio.aligned_buffer(PROBE_BLOCK)
+        saved = {}
+        failed = set()
+
+        log(f"Probing capacity at {len(offsets)} offsets...")
+        for offset in offsets:
+            try:
+                if blockio.pread_full(fd, buf, offset) < PROBE_BLOCK:
+                    raise OSError(f"short read at byte {offset}")
+                saved[offset] = bytes(buf[:PROBE_BLOCK])
+            except OSError as e:
+                log(f"Cannot read byte {offset}: {e}")
+                failed.add(offset)
+
+        try:
+            for offset in saved:
+                buf[:PROBE_BLOCK] = signed_block(nonce, offset)
+                try:
+                    blockio.pwrite_full(fd, buf, offset)
+                except OSError as e:
+                    log(f"Cannot write byte {offset}: {e}")
+                    failed.add(offset)
+            try:
+                os.fsync(fd)
+            except OSError as e:
+                # Whatever did not reach the device fails the read-back below
+                log(f"Flushing the probe blocks failed: {e}")
+            blockio.drop_cache(fd)
+
+            for offset in saved:
+                if offset in failed:
+                    continue
+                try:
+                    got = blockio.pread_full(fd, buf, offset)
+                    if got < PROBE_BLOCK or bytes(buf[:PROBE_BLOCK]) != signed_block(nonce, offset):
+                        failed.add(offset)
+                except OSError:
+                    failed.add(offset)
+        finally:
+            # Restore in reverse so that if blocks alias, the lowest offset
+            # (the one that really exists) ends up with its original data.
+            # One offset that fails must not leave the rest overwritten.
+            for offset in reversed(list(saved)):
+                buf[:PROBE_BLOCK] = saved[offset]
+                try:
+                    blockio.pwrite_full(fd, buf, offset)
+                except OSError as e:
+                    log(f"Could not restore byte {offset}: {e}")
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass
+
+        failed = sorted(failed)
+        verified = [o for o in offsets if o not in failed and (not failed or o < failed[0])]
+        return {
+            "ok": not failed,
+            "size": size,
+            "verified_bytes": (verified[-1] + PROBE_BLOCK) if verified else 0,
+            "failed_offsets": failed,
+            "direct_io": direct,
+        }
+    finally:
+        os.close(fd)
+
+
+def describe_result(result):
+    if result["ok"]:
+        return f"Capacity check passed: {format_size(result['size'])} verified."
+    return (f"Capacity check failed: device reports {format_size(result['size'])} but only "
+            f"{format_size(result['verified_bytes'])} could be verified. This stick is likely counterfeit.")
+
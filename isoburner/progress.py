@@ -0,0 +1,125 @@
+import os
+import time
+
+from . import storage
+from .devices import read_sysfs
+
+TIMINGS_FILE = "timings.json"
+
+# Used until a device model has burn history: bytes/s for phases that move
+# data, seconds for phases that don't (formatting, partitioning).
+DEFAULT_RATES = {
+    "copy": 20e6,
+    "files": 15e6,
+    "sync": 20e6,
+    "verify": 60e6,
+}
+DEFAULT_SECONDS = {
+    "partition": 5.0,
+    "persistence": 5.0,
+}
+FALLBACK_SECONDS = 1.0
+# Weight of a new observation when updating stored rates
+CALIBRATION_ALPHA = 0.3
+
+
+def model_key(info):
+    """vendor:product, shared by every stick of the same model."""
+    return f"{info.get('id_vendor') or 'unknown'}:{info.get('id_product') or 'unknown'}"
+
+
+def device_written_bytes(device):
+    """
+    Bytes the kernel has actually sent to the device since boot, from the
+    write-sectors field of /sys/block/<dev>/stat. Unlike tool output this
+    keeps moving while dirty pages are written back during sync.
+    """
+    fields = read_sysfs(os.path.join("/sys/block", os.path.basename(device), "stat")).split()
+    try:
+        return int(fields[6]) * 512
+    except (IndexError, ValueError):
+        return None
+
+
+class TimingStore:
+    """Per-model phase rates learned from previous burns."""
+
+    def __init__(self, filename=TIMINGS_FILE):
+        self.filename = filename
+        self.timings = storage.load_json(filename)
+
+    def rate(self, key, phase):
+        return self.timings.get(key, {}).get(phase, {}).get("bps")
+
+    def seconds(self, key, phase):
+        return self.timings.get(key, {}).get(phase, {}).get("seconds")
+
+    def record(self, key, phase, num_bytes, seconds):
+        entry = self.timings.setdefault(key, {}).setdefault(phase, {"count": 0})
+        if num_bytes and seconds > 0:
+            entry["bps"] = self._blend(entry.get("bps"), num_bytes / seconds)
+        else:
+            entry["seconds"] = self._blend(entry.get("seconds"), seconds)
+        entry["count"] += 1
+
+    def _blend(self, old, new):
+        return new if old is None else (1 - CALIBRATION_ALPHA) * old + CALIBRATION_ALPHA * new
+
+    def save(self):
+        storage.save_json(self.filename, self.timings)
+
+
+class ProgressModel:
+    """
+    Overall progress of a burn as a sequence of phases, each with a known
+    amount of work in bytes (or none, for fixed-cost steps).
+
+    Each phase is weighted by its expected duration: bytes divided by the
+    rate previous burns on the same device model achieved for that phase,
+    or a learned/default duration for fixed-cost steps. Within a phase the
+    position follows the real byte count, so the bar moves at the speed
+    the device is actually going.
+    """
+
+    def __init__(self, key, phases, timings=None):
+        self.key = key
+        self.timings = timings or TimingStore()
+        self.phases = [name for name, _ in phases]
+        self.work = dict(phases)
+        self.weights = {name: self._expected_seconds(name, work) for name, work in phases}
+        self.total_weight = sum(self.weights.values()) or 1.0
+        self.fraction = {name: 0.0 for name in self.phases}
+        self.started = {}
+
+    def _expected_seconds(self, name, work):
+        if work:
+            rate = self.timings.rate(self.key, name) or DEFAULT_RATES.get(name, DEFAULT_RATES["copy"])
+            return work / rate
+        return self.timings.seconds(self.key, name) or DEFAULT_SECONDS.get(name, FALLBACK_SECONDS)
+
+    def start(self, name):
+        self.started[name] = time.monotonic()
+
+    def set_work(self, name, work):
+        """Adjust a phase's size once it is known, e.g. dirty bytes left to sync."""
+        self.work[name] = work
+
+    def update(self, name, done):
+        work = self.work.get(name)
+        if work:
+            self.fraction[name] = min(1.0, max(0.0, done / work))
+        return self.percent()
+
+    def update_fraction(self, name, fraction):
+        self.fraction[name] = min(1.0, max(0.0, fraction))
+        return self.percent()
+
+    def finish(self, name, record=True):
+        self.fraction[name] = 1.0
+        if record and name in self.started:
+            self.timings.record(self.key, name, self.work.get(name), time.monotonic() - self.started[name])
+        return self.percent()
+
+    def percent(self):
+        done = sum(self.weights[name] * self.fraction[name] for name in self.phases)
+        return 100.0 * done / self.total_weight
@@ -0,0 +1,58 @@
+from collections import deque
+
+# Seconds between rate samples; also the horizontal step of the rate graph
+SAMPLE_INTERVAL = 0.5
+EWMA_ALPHA = 0.2
+HISTORY_SAMPLES = 120
+
+
+class RateMeter:
+    """
+    Throughput from a byte counter: instantaneous and EWMA rate, ETA and
+    a fixed-length history for graphing. Samples are taken at most every
+    SAMPLE_INTERVAL seconds however often update() is called.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL, alpha=EWMA_ALPHA, history=HISTORY_SAMPLES):
+        self.interval = interval
+        self.alpha = alpha
+        self.history = deque(maxlen=history)
+        self.reset()
+
+    def reset(self, phase=None):
+        self.phase = phase
+        self.history.clear()
+        self.last_time = None
+        self.last_done = 0
+        self.done = 0
+        self.total = 0
+        self.rate = 0.0
+        self.ewma = None
+
+    def update(self, done, total, now):
+        """Feed the current byte count. Returns True when a new sample was taken."""
+        self.done = done
+        self.total = total
+        if self.last_time is None or done < self.last_done:
+            self.last_time = now
+            self.last_done = done
+            return False
+        elapsed = now - self.last_time
+        if elapsed < self.interval:
+            return False
+        self.rate = (done - self.last_done) / elapsed
+        self.ewma = self.rate if self.ewma is None else self.alpha * self.rate + (1 - self.alpha) * self.ewma
+        self.history.append(self.rate)
+        self.last_time = now
+        self.last_done = done
+        return True
+
+    def eta(self):
+        """Seconds left at the EWMA rate, or None when unknown."""
+        if not self.total or not self.ewma:
+            return None
+        return max(0.0, (self.total - self.done) / self.ewma)
+
+
+def format_rate(bytes_per_second):
+    return f"{bytes_per_second / 1e6:.1f} MB/s"
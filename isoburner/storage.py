@@ -0,0 +1,34 @@
+import json
+import os
+import tempfile
+
+
+def config_dir():
+    """Directory for persisted results, created on first use."""
+    base = os.environ.get("XDG_CONFIG_HOME") or os.path.join(os.path.expanduser("~"), ".config")
+    path = os.path.join(base, "isoburner")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def load_json(name, default=None):
+    path = os.path.join(config_dir(), name)
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {} if default is None else default
+
+
+def save_json(name, data):
+    """Write data atomically so a crash never leaves a truncated file behind."""
+    directory = config_dir()
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{name}.")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, os.path.join(directory, name))
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
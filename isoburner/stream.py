@@ -0,0 +1,143 @@
+"""
+Streamed images: stdin, a named pipe or any other source that can only
+be read once, front to back, and whose size is unknown until it ends.
+
+A reader thread keeps up to READ_AHEAD bytes buffered so a bursty
+producer (a decompressor, tar, a build step) and the stick can each run
+at their own pace, and hashes the data as it arrives. Verification then
+compares the stick against that hash, since the stream cannot be read
+a second time.
+"""
+import hashlib
+import os
+import queue
+import re
+import stat
+import sys
+from threading import Thread
+
+# The image path that means standard input
+STDIN = "-"
+READ_AHEAD = 64 * 1024 * 1024
+PIECE_SIZE = 4 * 1024 * 1024
+DIGEST = "sha256"
+# Seconds between checks for a closed source while the buffer is full
+PUT_TIMEOUT = 0.5
+
+_DIGEST_RE = re.compile(r"^stream (\d+) bytes sha256 ([0-9a-f]{64})$")
+
+
+def is_stream(path):
+    """True for "-" and for paths that are pipes, sockets or character devices."""
+    if path == STDIN:
+        return True
+    try:
+        mode = os.stat(path).st_mode
+    except (OSError, ValueError):
+        return False
+    return stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode) or stat.S_ISCHR(mode)
+
+
+def format_progress(done, seconds):
+    """Progress record in dd's format, which needs no total."""
+    return f"{done} bytes copied, {seconds:.1f} s"
+
+
+def format_digest(size, digest):
+    """Output record carrying a stream's size and hash back from the helper."""
+    return f"stream {size} bytes sha256 {digest}"
+
+
+def parse_digest(line):
+    """(size, digest) from a format_digest() record, or None."""
+    match = _DIGEST_RE.match(line)
+    return (int(match.group(1)), match.group(2)) if match else None
+
+
+class PipeSource:
+    """
+    Image source over a stream, for Engine.write_stream(). size is None
+    until the stream has ended; then size and digest are known.
+    """
+
+    sequential = True
+    extents = None
+
+    def __init__(self, path, read_ahead=READ_AHEAD, piece_size=PIECE_SIZE):
+        self.fd = sys.stdin.fileno() if path == STDIN else os.open(path, os.O_RDONLY)
+        self.owned = path != STDIN
+        self.piece_size = piece_size
+        self.pieces = queue.Queue(maxsize=max(1, read_ahead // piece_size))
+        self.sha = hashlib.new(DIGEST)
+        self.size = None
+        self.digest = None
+        self.position = 0
+        self.finished = False
+        self.closed = False
+        self.leftover = memoryview(b"")
+        Thread(target=self._read_ahead, daemon=True).start()
+
+    def _put(self, item):
+        while not self.closed:
+            try:
+                self.pieces.put(item, timeout=PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read_ahead(self):
+        try:
+            while True:
+                # Pipes return at most their buffer per read; gather whole pieces
+                piece = bytearray(self.piece_size)
+                view = memoryview(piece)
+                filled = 0
+                while filled < len(piece):
+                    n = os.readv(self.fd, [view[filled:]])
+                    if not n:
+                        break
+                    filled += n
+                view.release()
+                del piece[filled:]
+                if piece:
+                    self.sha.update(piece)
+                    if not self._put(piece):
+                        return
+                if filled < self.piece_size:
+                    break
+            self._put(None)
+        except OSError as e:
+            self._put(e)
+        finally:
+            # Closed here, not in close(), so a blocked read never sees a reused descriptor
+            if self.owned:
+                os.close(self.fd)
+
+    def read_into(self, view, offset):
+        """Fill view with the next bytes of the stream; offset must be where the last read ended."""
+        if offset != self.position:
+            raise OSError("a stream can only be read front to back, once")
+        view = memoryview(view)
+        done = 0
+        while done < len(view) and not self.finished:
+            if not self.leftover:
+                piece = self.pieces.get()
+                if isinstance(piece, OSError):
+                    raise piece
+                if piece is None:
+                    self.finished = True
+                    break
+                self.leftover = memoryview(piece)
+            n = min(len(view) - done, len(self.leftover))
+            view[done:done + n] = self.leftover[:n]
+            self.leftover = self.leftover[n:]
+            done += n
+        self.position += done
+        if self.finished:
+            self.size = self.position
+            self.digest = self.sha.hexdigest()
+        return done
+
+    def close(self):
+        self.closed = True
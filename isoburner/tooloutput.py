@@ -0,0 +1,111 @@
+import os
+import re
+import selectors
+from collections import namedtuple
+
+# Bytes taken from the pipe per wakeup. One read never hands the caller
+# more than this, so a flooding tool cannot monopolise the worker.
+READ_SIZE = 64 * 1024
+# Records longer than this (a tool printing without any line breaks) are
+# cut rather than buffered without bound.
+MAX_RECORD = 16 * 1024
+
+ToolProgress = namedtuple("ToolProgress", "tool done total percent rate")
+
+_SIZE_UNITS = {"B": 1, "KiB": 1024, "MiB": 1024 ** 2, "GiB": 1024 ** 3, "TiB": 1024 ** 4,
+               "kB": 1000, "KB": 1000, "MB": 1000 ** 2, "GB": 1000 ** 3, "TB": 1000 ** 4}
+
+_DD = re.compile(r"^(\d+) bytes .*copied, ([\d.,]+) s(?:, ([\d.,]+ \S+/s))?")
+_WIMLIB_BYTES = re.compile(r"(\d+(?:\.\d+)?) (\w?i?B) of (\d+(?:\.\d+)?) (\w?i?B) \((\d+)%\)")
+_WIMLIB_COUNT = re.compile(r"(\d+) of (\d+) \((\d+)%\)")
+
+
+class RecordSplitter:
+    """
+    Incrementally split a byte stream into records on either \\r or \\n.
+    dd status=progress rewrites its line with \\r, so splitting on \\n
+    alone only sees the updates once dd exits.
+    """
+
+    def __init__(self, max_record=MAX_RECORD):
+        self.pending = b""
+        self.max_record = max_record
+
+    def feed(self, data):
+        data = self.pending + data
+        parts = re.split(b"[\r\n]", data)
+        self.pending = parts.pop()
+        if len(self.pending) > self.max_record:
+            parts.append(self.pending)
+            self.pending = b""
+        return [self.decode(p) for p in parts if p.strip()]
+
+    def flush(self):
+        rest, self.pending = self.pending, b""
+        return [self.decode(rest)] if rest.strip() else []
+
+    def decode(self, record):
+        return record.decode("utf-8", errors="replace").strip()
+
+
+def iter_output(stream, poll=None, timeout=0.2, read_size=READ_SIZE):
+    """
+    Read a subprocess pipe without blocking and yield lists of records,
+    one list per bounded read. poll() is called whenever the pipe is idle
+    for `timeout` seconds, giving the caller a chance to give up.
+    """
+    fd = stream.fileno()
+    os.set_blocking(fd, False)
+    splitter = RecordSplitter()
+    with selectors.DefaultSelector() as selector:
+        selector.register(fd, selectors.EVENT_READ)
+        while True:
+            if not selector.select(timeout):
+                if poll:
+                    poll()
+                continue
+            try:
+                data = os.read(fd, read_size)
+            except BlockingIOError:
+                continue
+            if not data:
+                break
+            records = splitter.feed(data)
+            if records:
+                yield records
+    rest = splitter.flush()
+    if rest:
+        yield rest
+
+
+def _size(value, unit):
+    return int(float(value) * _SIZE_UNITS.get(unit, 1))
+
+
+def parse_dd(line):
+    match = _DD.match(line)
+    if not match:
+        return None
+    return ToolProgress("dd", int(match.group(1)), None, None, match.group(3))
+
+
+def parse_wimlib(line):
+    # "Extracting file data: 1234 MiB of 4567 MiB (27%) done"
+    match = _WIMLIB_BYTES.search(line)
+    if match:
+        return ToolProgress("wimlib", _size(match.group(1), match.group(2)),
+                            _size(match.group(3), match.group(4)), float(match.group(5)), None)
+    # "Creating files: 1234 of 5678 (22%) done"
+    match = _WIMLIB_COUNT.search(line)
+    if match:
+        return ToolProgress("wimlib", None, None, float(match.group(3)), None)
+    return None
+
+
+def parse_line(tool, line):
+    """Turn one output record into a ToolProgress, or None for plain log text."""
+    if tool == "dd":
+        return parse_dd(line)
+    if tool == "wimlib":
+        return parse_wimlib(line)
+    return None
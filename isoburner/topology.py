@@ -0,0 +1,97 @@
+import os
+import threading
+from contextlib import contextmanager
+
+from .devices import read_sysfs
+
+# Fraction of the negotiated signalling rate that bulk transfers actually
+# achieve once protocol and encoding overhead are paid.
+LINK_EFFICIENCY = 0.65
+
+# Write speed assumed for sticks that have never been benchmarked (bytes/s)
+DEFAULT_DEVICE_BPS = 30e6
+
+
+def link_speed_bps(usb_dir):
+    """Usable bytes/s of the link a USB device negotiated (sysfs speed is Mbit/s)."""
+    try:
+        mbps = float(read_sysfs(os.path.join(usb_dir, "speed"), "0"))
+    except ValueError:
+        mbps = 0
+    return mbps * 1e6 / 8 * LINK_EFFICIENCY
+
+
+def upstream_links(usb_dir):
+    """
+    Return the chain of upstream USB devices (hubs, then the root hub) that a
+    device's traffic passes through, nearest first, as (sysfs dir, bytes/s).
+    Every entry is a link that may be shared with other sticks.
+    """
+    links = []
+    path = os.path.dirname(usb_dir)
+    while path and path != "/":
+        if os.path.exists(os.path.join(path, "idVendor")):
+            links.append((path, link_speed_bps(path)))
+        path = os.path.dirname(path)
+    return links
+
+
+def describe_topology(info):
+    """Human readable path such as 'usb2 > 2-1 > 2-1.3 (5000 Mbit/s)'."""
+    usb = info.get("usb_path")
+    if not usb:
+        return "not attached over USB"
+    chain = [os.path.basename(p) for p, _ in reversed(upstream_links(usb))]
+    chain.append(os.path.basename(usb))
+    speed = read_sysfs(os.path.join(usb, "speed"), "?")
+    return f"{' > '.join(chain)} ({speed} Mbit/s)"
+
+
+class LinkScheduler:
+    """
+    Caps how many burns run at once behind each shared USB link.
+
+    Every burn thread wraps its I/O in `with scheduler.slot(info, bps):`.
+    A slot is granted only when every upstream link (hub and root hub) the
+    device sits behind still has room, so sticks on a saturated hub queue
+    up and run back to back instead of slowing each other down.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.active = {}
+
+    def limit(self, link_bps, device_bps):
+        if link_bps <= 0 or device_bps <= 0:
+            return 1
+        return max(1, int(link_bps // device_bps))
+
+    def _plan(self, info, device_bps):
+        usb = info.get("usb_path")
+        if not usb:
+            return []
+        # A stick can never move data faster than its own negotiated link
+        own = link_speed_bps(usb)
+        demand = min(device_bps or DEFAULT_DEVICE_BPS, own) if own else (device_bps or DEFAULT_DEVICE_BPS)
+        return [(path, self.limit(bps, demand)) for path, bps in upstream_links(usb)]
+
+    def _has_room(self, plan):
+        return all(self.active.get(path, 0) < limit for path, limit in plan)
+
+    @contextmanager
+    def slot(self, info, device_bps=None, on_wait=None):
+        plan = self._plan(info, device_bps)
+        with self.cond:
+            if not self._has_room(plan) and on_wait:
+                on_wait()
+            while not self._has_room(plan):
+                self.cond.wait()
+            for path, _ in plan:
+                self.active[path] = self.active.get(path, 0) + 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                for path, _ in plan:
+                    self.active[path] -= 1
+                self.cond.notify_all()
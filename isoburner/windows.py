@@ -0,0 +1,263 @@
+"""
+File-level writer for Windows installer ISOs.
+
+The stick gets one FAT32 partition (GPT for UEFI, MBR otherwise) and the
+ISO's file tree is copied onto it. FAT32 cannot hold files of 4 GiB or
+more, so an install.wim that large is split into install.swm parts,
+which Windows Setup reads directly.
+
+The ISO is loop-mounted read-only rather than parsed, so the kernel's UDF
+driver does the extent lookups. The stick's filesystem is built in memory
+and written in one sequential pass; see fat32.
+"""
+import os
+import re
+import shutil
+import struct
+import subprocess
+import tempfile
+from contextlib import contextmanager
+
+from . import libwim, partition
+from .cancel import CancelToken, stop_process
+from .devices import partition_start
+from .engine import Engine
+from .fat32 import Fat32Image
+
+VOLUME_LABEL = "WINSETUP"
+# Largest file FAT32 can store
+FAT32_MAX_FILE = 4 * 1024 ** 3 - 1
+# Size of the install.swm parts, in MiB, safely below the FAT32 limit
+WIM_PART_MB = 3800
+# Seconds between progress reports while a WIM is being split
+SPLIT_POLL = 0.5
+COPY_CHUNK = 8 * 1024 * 1024
+WIM_NAMES = ("install.wim", "install.esd")
+WIM_MAGIC = b"MSWIM\0\0\0"
+# Header fields up to total_parts: magic, size, version, flags, chunk size, GUID, part number, total parts
+WIM_HEADER = struct.Struct("<8sIIII16sHH")
+_SWM_RE = re.compile(r"^install(\d*)\.swm$", re.IGNORECASE)
+
+
+def prepare_stick(device, uefi=True, log=None):
+    """
+    Give device one partition for the installer (GPT for UEFI, MBR
+    otherwise), aligned to its erase block. The FAT32 filesystem itself
+    is written with the files. Raises OSError.
+    """
+    log = log or (lambda text: None)
+    (start, size), = partition.disk_layout(device, [None], gpt=uefi)
+    part = partition.Partition(start, size, partition.BASIC_DATA_GUID, partition.MBR_FAT32_LBA,
+                               VOLUME_LABEL, True)
+    log(f"Writing {'GPT' if uefi else 'MBR'} partition table, partition at {start // 1024} KiB...")
+    partition.write_table(device, [part], gpt=uefi)
+    partition.settle(device, 1)
+
+
+@contextmanager
+def mounted(source, options):
+    """Mount source on a temporary directory, always unmounting on the way out."""
+    path = tempfile.mkdtemp(prefix="isoburner-")
+    try:
+        result = subprocess.run(["mount", "-o", options, source, path],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            raise OSError(f"could not mount {source}: {result.stderr.strip()}")
+        try:
+            yield path
+        finally:
+            subprocess.run(["umount", path], stderr=subprocess.DEVNULL)
+    finally:
+        os.rmdir(path)
+
+
+def list_tree(root):
+    """(relative path, size) of every file under root, in directory order."""
+    files = []
+    for directory, dirs, names in os.walk(root):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(directory, name)
+            files.append((os.path.relpath(path, root), os.path.getsize(path)))
+    return files
+
+
+def needs_split(rel, size):
+    return os.path.basename(rel).lower() in WIM_NAMES and size > FAT32_MAX_FILE
+
+
+def split_wim(source, target_dir, cancel, report=None):
+    """
+    Split a WIM into install.swm, install2.swm, ... in one pass from the
+    ISO straight to the target, with no temporary copy. In-process
+    through libwim when it is installed; otherwise wimlib-imagex runs and
+    report(bytes) follows the parts as they grow, since the command only
+    reports progress once per part.
+    """
+    report = report or (lambda done: None)
+    swm_name = os.path.join(target_dir, "install.swm")
+    if libwim.available():
+        libwim.split(source, swm_name, WIM_PART_MB * 1024 * 1024, cancel, report)
+        return
+    cmd = ["wimlib-imagex", "split", source, swm_name, str(WIM_PART_MB)]
+    process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, start_new_session=True)
+    with cancel.watch(lambda: stop_process(process)):
+        while True:
+            try:
+                _, errors = process.communicate(timeout=SPLIT_POLL)
+                break
+            except subprocess.TimeoutExpired:
+                report(swm_bytes(target_dir))
+    cancel.check()
+    if process.returncode != 0:
+        raise OSError(f"wimlib-imagex split failed: {errors.decode(errors='replace').strip()}")
+    report(swm_bytes(target_dir))
+
+
+def swm_bytes(target_dir):
+    """Bytes written so far to the install*.swm parts in target_dir."""
+    total = 0
+    for entry in os.scandir(target_dir):
+        name = entry.name.lower()
+        if name.startswith("install") and name.endswith(".swm"):
+            total += entry.stat().st_size
+    return total
+
+
+def copy_iso_tree(iso, partition, progress=None, log=None, cancel=None):
+    """
+    Write the file tree of a Windows ISO onto a partition as a FAT32
+    filesystem. progress(done, total) is in bytes written. Raises
+    BurnCancelled from `cancel` between chunks, after unmounting.
+
+    Everything but an oversized WIM goes out as one sequential write of
+    a Fat32Image; the WIM is then split onto the mounted filesystem.
+    """
+    progress = progress or (lambda done, total: None)
+    log = log or (lambda text: None)
+    cancel = cancel or CancelToken()
+    with mounted(iso, "loop,ro") as src:
+        files = list_tree(src)
+        split = [(rel, size) for rel, size in files if needs_split(rel, size)]
+        image = Fat32Image(src, device_bytes(partition), VOLUME_LABEL, partition_start(partition),
+                           skip={rel for rel, _ in split})
+        total = image.size + sum(size for _, size in split)
+        log("Writing the FAT32 filesystem...")
+        Engine(progress=lambda done, _: progress(done, total), cancel=cancel).write_image(image, partition)
+        if split:
+            with mounted(partition, "rw") as dst:
+                done = image.size
+                for rel, size in split:
+                    log(f"Splitting {rel} into FAT32-sized parts...")
+                    target_dir = os.path.dirname(os.path.join(dst, rel))
+                    os.makedirs(target_dir, exist_ok=True)
+                    split_wim(os.path.join(src, rel), target_dir, cancel,
+                              lambda part, done=done, size=size: progress(done + min(part, size), total))
+                    done += size
+                log("Flushing files to the USB drive...")
+                os.sync()
+    progress(total, total)
+    return total
+
+
+def device_bytes(path):
+    with open(path, "rb") as f:
+        return f.seek(0, os.SEEK_END)
+
+
+def verify_iso_tree(iso, partition, progress=None, log=None, cancel=None):
+    """
+    Compare every copied file with the ISO. A split WIM is checked part
+    by part (see check_swm_parts()). Returns the relative paths that
+    differ.
+    """
+    progress = progress or (lambda done, total: None)
+    log = log or (lambda text: None)
+    cancel = cancel or CancelToken()
+    bad = []
+    with mounted(iso, "loop,ro") as src, mounted(partition, "ro") as dst:
+        files = list_tree(src)
+        total = sum(size for _, size in files)
+        done = 0
+        for rel, size in files:
+            cancel.check()
+            source = os.path.join(src, rel)
+            target = os.path.join(dst, rel)
+            if needs_split(rel, size):
+                problem = check_swm_parts(os.path.dirname(target), cancel)
+                if problem:
+                    log(f"{rel}: {problem}")
+                    bad.append(rel)
+            elif not same_file(source, target, cancel):
+                bad.append(rel)
+            done += size
+            progress(done, total)
+    for rel in bad:
+        log(f"Mismatch: {rel}")
+    return bad
+
+
+def check_swm_parts(target_dir, cancel):
+    """
+    Check the install*.swm parts of a split WIM: every part present and
+    within FAT32's file size limit, all from the same split, numbered 1
+    to the total each header records. With wimlib-imagex installed the
+    parts' resources are also read and checked against their hashes.
+    Returns a description of the first problem, or None.
+    """
+    parts = {}
+    for name in os.listdir(target_dir):
+        match = _SWM_RE.match(name)
+        if match:
+            parts[int(match.group(1) or 1)] = os.path.join(target_dir, name)
+    if not parts:
+        return "the install.swm parts are missing"
+    missing = [number for number in range(1, max(parts) + 1) if number not in parts]
+    if missing:
+        return f"part {missing[0]} of the split WIM is missing"
+    guids = set()
+    for number, path in sorted(parts.items()):
+        if os.path.getsize(path) > FAT32_MAX_FILE:
+            return f"{os.path.basename(path)} is too large for FAT32"
+        with open(path, "rb") as f:
+            header = f.read(WIM_HEADER.size)
+        if len(header) < WIM_HEADER.size:
+            return f"{os.path.basename(path)} is truncated"
+        magic, _, _, _, _, guid, part, total = WIM_HEADER.unpack(header)
+        if magic != WIM_MAGIC or part != number or total != len(parts):
+            return f"{os.path.basename(path)} is not part {number} of {len(parts)} of the split WIM"
+        guids.add(guid)
+    if len(guids) != 1:
+        return "the parts come from different splits"
+    if shutil.which("wimlib-imagex") is None:
+        return None
+    cmd = ["wimlib-imagex", "verify", parts[1], f"--ref={os.path.join(target_dir, 'install*.swm')}"]
+    process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, start_new_session=True)
+    with cancel.watch(lambda: stop_process(process)):
+        _, errors = process.communicate()
+    cancel.check()
+    if process.returncode != 0:
+        return f"wimlib-imagex verify failed: {errors.decode(errors='replace').strip()}"
+    return None
+
+
+def same_file(a, b, cancel):
+    try:
+        if os.path.getsize(a) != os.path.getsize(b):
+            return False
+        with open(a, "rb") as fa, open(b, "rb") as fb:
+            while True:
+                cancel.check()
+                chunk = fa.read(COPY_CHUNK)
+                if chunk != fb.read(COPY_CHUNK):
+                    return False
+                if not chunk:
+                    return True
+    except FileNotFoundError:
+        return False
+
+
+def format_progress(verb, done, total):
+    """Progress record in the wimlib format parse_wimlib() understands."""
+    percent = int(done * 100 / total) if total else 100
+    return f"{verb} files: {done} B of {total} B ({percent}%) done"